@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmark of the raw statement fast path (database/fastpath.py) against the equivalent peewee queries
+#
+# Run from the repository root: python3 -m benchmarks.fastpath [--songs N] [--calls N]
+# A temporary database is created and removed afterwards, nothing else is touched.
+#
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime
+
+import database.common
+from database import fastpath
+from database.common import *
+
+
+def populate(song_count):
+    current_time = datetime.now()
+    rows = [{'uuri': 'yt:song{}'.format(i), 'title': 'Song {}'.format(i), 'duration': 180 + i % 120,
+             'last_played': datetime.utcfromtimestamp(0), 'credit_count': 5, 'credit_timestamp': current_time}
+            for i in range(song_count)]
+    with database.common._database.atomic():
+        for chunk in chunked(rows, MAX_VARIABLES // len(rows[0])):
+            Song.insert_many(chunk).execute()
+        user = User.create(id=1)
+        playlist = Playlist.create(user=user.id, name='bench')
+        User.update(active_playlist=playlist.id).where(User.id == user.id).execute()
+        links = [{'playlist': playlist.id, 'song': song_id, 'position': position}
+                 for position, (song_id,) in enumerate(Song.select(Song.id).tuples())]
+        for chunk in chunked(links, MAX_VARIABLES // 3):
+            Link.insert_many(chunk).execute()
+        fix_song_counts()
+    return user.id, playlist.id
+
+
+def peewee_front_song(playlist_id):
+    linked = Song.alias()
+    return Song.select(Song, Link.id.alias('link_id')).join(linked, on=(linked.canonical == Song.id)) \
+        .join(Link, on=(Link.song == linked.id)).where(Link.playlist == playlist_id) \
+        .order_by(Link.position, Link.id).naive().get()
+
+
+def peewee_rotate(playlist_id, link_id):
+    back = Link.select(peewee.fn.MAX(Link.position)).where(Link.playlist == playlist_id).scalar()
+    Link.update(position=back + 1).where(Link.id == link_id).execute()
+
+
+def peewee_played(song_id, current_time):
+    credit_count, credit_timestamp = Song.select(Song.credit_count, Song.credit_timestamp) \
+        .where(Song.id == song_id).tuples().get()
+    Song.update(last_played=current_time, credit_count=credit_count, credit_timestamp=credit_timestamp) \
+        .where(Song.id == song_id).execute()
+
+
+def fastpath_played(db, song_id, current_time):
+    credit_count, credit_timestamp = fastpath.get_credits(db, song_id)
+    fastpath.update_played(db, song_id, current_time, credit_count, credit_timestamp)
+
+
+def measure(function, calls):
+    # returns average time per call [microseconds]
+    start = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the fast path to the peewee queries it replaces')
+    parser.add_argument('--songs', type=int, default=10000, help='number of songs in the synthetic database')
+    parser.add_argument('--calls', type=int, default=2000, help='number of calls per operation')
+    arguments = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    database.common.initialize(os.path.join(directory, 'bench.sqlite'))
+    try:
+        db = database.common._database
+        user_id, playlist_id = populate(arguments.songs)
+        link_id, song = fastpath.get_front_song(db, playlist_id)
+        current_time = datetime.now()
+
+        cases = [
+            ('interaction_check', lambda: User.get_or_create(id=user_id),
+             lambda: fastpath.check_user(db, user_id)),
+            ('active playlist', lambda: Playlist.select(Playlist.id, Playlist.repeat, Playlist.name)
+                .join(User, on=(User.active_playlist == Playlist.id)).where(User.id == user_id).get(),
+             lambda: fastpath.get_active_playlist(db, user_id)),
+            ('playlist front song', lambda: peewee_front_song(playlist_id),
+             lambda: fastpath.get_front_song(db, playlist_id)),
+            ('link rotation', lambda: peewee_rotate(playlist_id, link_id),
+             lambda: fastpath.rotate_link(db, playlist_id, link_id)),
+            ('song by id', lambda: Song.get(Song.id == song.id),
+             lambda: fastpath.get_song(db, song.id)),
+            ('played song update', lambda: peewee_played(song.id, current_time),
+             lambda: fastpath_played(db, song.id, current_time)),
+            ('user song count', lambda: Link.select().join(Playlist, on=(Link.playlist == Playlist.id))
+                .where(Playlist.user == user_id).count(),
+             lambda: fastpath.count_user_songs(db, user_id)),
+            ('playlist back position', lambda: Link.select(peewee.fn.MAX(Link.position))
+                .where(Link.playlist == playlist_id).scalar(),
+             lambda: fastpath.get_back_position(db, playlist_id)),
+        ]
+
+        print('{:<24} {:>12} {:>12} {:>8}'.format('operation', 'peewee [us]', 'fast [us]', 'speedup'))
+        for name, peewee_function, fastpath_function in cases:
+            peewee_time = measure(peewee_function, arguments.calls)
+            fastpath_time = measure(fastpath_function, arguments.calls)
+            print('{:<24} {:>12.1f} {:>12.1f} {:>7.1f}x'.format(name, peewee_time, fastpath_time,
+                                                                peewee_time / fastpath_time))
+    finally:
+        database.common.close()
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main()
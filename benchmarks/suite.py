@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+#
+# Benchmark suite of the database layer
+#
+# Synthetic databases of the given scales are generated and every public method of the database interfaces is timed
+# there, called the same way the bot calls them (through the executors). Extraction (youtube_dl) is replaced by a stub,
+# so there is no network access. Latency percentiles and numbers of SQL statements per call are written as JSON.
+#
+# Run from the repository root:
+#   python3 -m benchmarks.suite [--scale SONGS:USERS:PLAYLISTS:LINKS ...] [--calls N] [--output FILE]
+#
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import database.bot
+import database.common
+import database.player
+import database.playlist
+import database.song
+import database.user
+from database import fastpath
+from database.common import *
+
+DEFAULT_SCALES = ['1000:50:100:2000', '10000:200:400:20000', '100000:1000:2000:200000']
+WORDS = ['love', 'night', 'dance', 'heart', 'fire', 'dream', 'summer', 'remix', 'live', 'official', 'feat', 'blue',
+         'rain', 'star', 'road', 'home', 'light', 'wild', 'gold', 'time']
+
+
+class StubYoutubeDL:
+    def extract_info(self, url, download=True, process=True):
+        return {'title': 'Stub {}'.format(url), 'duration': 200, 'url': 'http://localhost/stub.aac',
+                'extractor': 'generic'}
+
+
+class StatementCounter:
+    # counts the statements of all the connections, installed as the sqlite3 trace callback
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, statement):
+        with self._lock:
+            self.count += 1
+
+
+def install_hooks(counter):
+    # every connection peewee opens (one per thread) is traced
+    db = database.common._database
+    connect = db._connect
+
+    def traced_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(counter)
+        return conn
+
+    db._connect = traced_connect
+    DBSongUtil._get_ytdl = classmethod(lambda cls: StubYoutubeDL())
+
+
+#
+# Synthetic database
+#
+def generate(rng, song_count, user_count, playlist_count, link_count):
+    current_time = datetime.now()
+    db = database.common._database
+    context = {'songs': list(range(1, song_count + 1)), 'failed': list(), 'users': list(), 'playlists': dict()}
+
+    roots = list()
+    rows = list()
+    for song_id in context['songs']:
+        # about 5 % of songs are duplicates (never chained), 2 % blacklisted and 2 % failed
+        duplicate = rng.choice(roots) if roots and rng.random() < 0.05 else None
+        if duplicate is None:
+            roots.append(song_id)
+        failed = rng.random() < 0.02
+        if failed:
+            context['failed'].append(song_id)
+        listeners = rng.randint(0, 50)
+        rows.append({'id': song_id, 'uuri': 'yt:synthetic{}'.format(song_id),
+                     'title': ' '.join(rng.sample(WORDS, 3) + [str(song_id)]), 'duration': rng.randint(60, 600),
+                     'is_blacklisted': rng.random() < 0.02, 'has_failed': failed,
+                     'last_played': current_time - timedelta(hours=rng.randint(0, 24 * 30)),
+                     'credit_count': rng.randint(0, 5),
+                     'credit_timestamp': current_time - timedelta(hours=rng.randint(0, 48)),
+                     'listener_count': listeners, 'skip_vote_count': rng.randint(0, listeners // 2),
+                     'duplicate': duplicate})
+
+    with db.atomic():
+        for chunk in chunked(rows, MAX_VARIABLES // len(rows[0])):
+            Song.insert_many(chunk).execute()
+
+        users = [{'id': 10 ** 17 + index, 'play_count': 0, 'listen_count': 0, 'is_ignored': False}
+                 for index in range(user_count)]
+        for chunk in chunked(users, MAX_VARIABLES // len(users[0])):
+            User.insert_many(chunk).execute()
+        context['users'] = [user['id'] for user in users]
+
+        for index in range(playlist_count):
+            user_id = context['users'][index % user_count]
+            playlist = Playlist.create(user=user_id, name='playlist{}'.format(index), repeat=rng.random() < 0.8)
+            context['playlists'].setdefault(user_id, list()).append((playlist.id, playlist.name))
+        for user_id, playlists in context['playlists'].items():
+            User.update(active_playlist=playlists[0][0]).where(User.id == user_id).execute()
+
+        playlist_ids = [playlist_id for playlists in context['playlists'].values() for playlist_id, name in playlists]
+        pairs = set()
+        positions = dict()
+        links = list()
+        while len(links) < min(link_count, len(playlist_ids) * song_count):
+            pair = rng.choice(playlist_ids), rng.randint(1, song_count)
+            if pair in pairs:
+                continue
+            pairs.add(pair)
+            position = positions.get(pair[0], 0)
+            positions[pair[0]] = position + 1
+            links.append({'playlist': pair[0], 'song': pair[1], 'position': position})
+        for chunk in chunked(links, MAX_VARIABLES // 3):
+            Link.insert_many(chunk).execute()
+        fix_song_counts()
+
+    return context
+
+
+def fill_playlist(rng, context, user_id, name, size):
+    # creates a playlist with the given number of songs, used as a setup of the destructive calls
+    playlist = Playlist.create(user=user_id, name=name)
+    songs = rng.sample(context['songs'], size)
+    Link.insert_many([{'playlist': playlist.id, 'song': song_id, 'position': position}
+                      for position, song_id in enumerate(songs)]).execute()
+    fastpath.update_song_counts(database.common._database, playlist.id, size)
+    return playlist
+
+
+#
+# Benchmark cases, every case is (name, setup, call, tolerated exceptions), setup returns the call arguments
+#
+def make_cases(rng, context, interfaces):
+    bot, playlist, player, song, user = interfaces
+    counter = iter(range(10 ** 9))
+
+    def random_user():
+        return rng.choice(context['users'])
+
+    owners = list(context['playlists'].keys())
+
+    def random_playlist():
+        user_id = rng.choice(owners)
+        return user_id, rng.choice(context['playlists'][user_id])[1]
+
+    def random_song():
+        return rng.choice(context['songs'])
+
+    def fresh_playlist(size=20):
+        user_id = random_user()
+        name = 'bench{}'.format(next(counter))
+        fill_playlist(rng, context, user_id, name, min(size, len(context['songs'])))
+        return user_id, name
+
+    def song_context():
+        ctx = database.player.SongContext(random_user(), random_song(), 'title', 200, 'http://localhost/stub.aac')
+        ctx.update_listeners(set(rng.sample(context['users'], min(5, len(context['users'])))))
+        if rng.random() < 0.3:
+            ctx.skip_vote(next(iter(ctx.listeners)))
+        return ctx,
+
+    def insert_arguments():
+        user_id, name = random_playlist()
+        uris = [str(random_song()) for _ in range(10)]
+        uris.append('https://www.youtube.com/watch?v=bench{}'.format(next(counter)))
+        return user_id, name, rng.random() < 0.5, uris
+
+    def show_arguments():
+        user_id, name = random_playlist()
+        return user_id, 0, 20, name
+
+    def repeat_arguments():
+        user_id, name = random_playlist()
+        return user_id, rng.random() < 0.5, name
+
+    def pop_arguments():
+        user_id, name = fresh_playlist(5)
+        return user_id, 1, name
+
+    def pop_id_arguments():
+        user_id, name = fresh_playlist(5)
+        playlist_id = Playlist.get(Playlist.user == user_id, Playlist.name == name).id
+        return user_id, Link.select(Link.song).where(Link.playlist == playlist_id).first().song_id, name
+
+    unavailable = (LookupError, RuntimeError, ValueError, database.player.UnavailableSongError)
+    return [
+        ('BotInterface.interaction_check', lambda: (random_user(),), bot.interaction_check, ()),
+
+        ('PlaylistInterface.exists', random_playlist, playlist.exists, ()),
+        ('PlaylistInterface.get_active', lambda: (random_user(),), playlist.get_active, (LookupError,)),
+        ('PlaylistInterface.set_active', random_playlist, playlist.set_active, ()),
+        ('PlaylistInterface.create', lambda: (random_user(), 'new{}'.format(next(counter))), playlist.create, ()),
+        ('PlaylistInterface.clear', fresh_playlist, playlist.clear, ()),
+        ('PlaylistInterface.list', lambda: (random_user(),), playlist.list, ()),
+        ('PlaylistInterface.show', show_arguments, playlist.show, ()),
+        ('PlaylistInterface.shuffle', random_playlist, playlist.shuffle, ()),
+        ('PlaylistInterface.delete', fresh_playlist, playlist.delete, ()),
+        ('PlaylistInterface.repeat', repeat_arguments, playlist.repeat, ()),
+        ('PlaylistInterface.insert', insert_arguments, playlist.insert, ()),
+        ('PlaylistInterface.pop', pop_arguments, playlist.pop, ()),
+        ('PlaylistInterface.pop_id', pop_id_arguments, playlist.pop_id, ()),
+
+        ('PlayerInterface.get_next_song', lambda: (random_user(),), player.get_next_song, unavailable),
+        ('PlayerInterface.get_autoplaylist_song', lambda: (), player.get_autoplaylist_song, unavailable),
+        ('PlayerInterface.update_stats', song_context, player.update_stats, ()),
+        ('PlayerInterface.flush_stats', lambda: (), player.flush_stats, ()),
+
+        ('SongInterface.blacklist', lambda: (random_song(),), song.blacklist, (ValueError,)),
+        ('SongInterface.permit', lambda: (random_song(),), song.permit, (ValueError,)),
+        ('SongInterface.search', lambda: (rng.sample(WORDS, 2), 20), song.search, ()),
+        ('SongInterface.get_info', lambda: (random_song(),), song.get_info, ()),
+        ('SongInterface.merge', lambda: (random_song(), random_song()), song.merge, (ValueError,)),
+        ('SongInterface.rename', lambda: (random_song(), 'renamed {}'.format(next(counter))), song.rename, ()),
+        ('SongInterface.list_failed', lambda: (20,), song.list_failed, ()),
+        ('SongInterface.clear_failed', lambda: (rng.choice(context['failed'] or context['songs']),),
+         song.clear_failed, ()),
+
+        ('UserInterface.info', lambda: (random_user(),), user.info, ()),
+        ('UserInterface.ignore', lambda: (random_user(),), user.ignore, (ValueError,)),
+        ('UserInterface.grace', lambda: (random_user(),), user.grace, (ValueError,)),
+    ]
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run_scale(loop, config, counter, scale, calls, seed):
+    song_count, user_count, playlist_count, link_count = scale
+    rng = random.Random(seed)
+    directory = tempfile.mkdtemp()
+    database.common.initialize(os.path.join(directory, 'benchmark.sqlite'))
+    try:
+        start = time.perf_counter()
+        context = generate(rng, song_count, user_count, playlist_count, link_count)
+        generation_time = time.perf_counter() - start
+
+        interfaces = (database.bot.BotInterface(loop), database.playlist.PlaylistInterface(loop, config),
+                      database.player.PlayerInterface(loop, config), database.song.SongInterface(loop, config),
+                      database.user.UserInterface(loop))
+        results = dict()
+        for name, setup, call, tolerated in make_cases(rng, context, interfaces):
+            latencies = list()
+            statements = 0
+            errors = 0
+            for _ in range(calls):
+                arguments = setup()
+                before = counter.count
+                start = time.perf_counter()
+                try:
+                    loop.run_until_complete(call(*arguments))
+                except tolerated:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+                statements += counter.count - before
+            latencies.sort()
+            results[name] = {'p50_ms': percentile(latencies, 0.5) * 1000, 'p99_ms': percentile(latencies, 0.99) * 1000,
+                             'mean_ms': sum(latencies) / calls * 1000, 'statements_per_call': statements / calls,
+                             'expected_errors': errors}
+            print('{:<40} p50 {:>8.3f} ms   p99 {:>8.3f} ms   {:>6.1f} statements'
+                  .format(name, results[name]['p50_ms'], results[name]['p99_ms'], statements / calls),
+                  file=sys.stderr)
+    finally:
+        database.common.close()
+        for file_name in os.listdir(directory):
+            os.remove(os.path.join(directory, file_name))
+        os.rmdir(directory)
+
+    return {'songs': song_count, 'users': user_count, 'playlists': playlist_count, 'links': link_count,
+            'generation_s': generation_time, 'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the database interfaces on synthetic databases')
+    parser.add_argument('--scale', action='append', metavar='SONGS:USERS:PLAYLISTS:LINKS',
+                        help='size of the synthetic database, may be repeated (default: {})'
+                        .format(', '.join(DEFAULT_SCALES)))
+    parser.add_argument('--calls', type=int, default=200, help='number of calls per method')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the generator')
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config.ini'),
+                        help='configuration file providing the limits and thresholds')
+    parser.add_argument('--output', help='file to write the JSON results to (default: standard output)')
+    arguments = parser.parse_args()
+
+    config_parser = configparser.ConfigParser()
+    config_parser.read(arguments.config)
+    config = dict(config_parser['ddmbot'])
+    # limits would only make the calls fail after a while
+    config['playlist_count_limit'] = config['song_count_limit'] = str(10 ** 9)
+
+    counter = StatementCounter()
+    install_hooks(counter)
+    loop = asyncio.new_event_loop()
+    report = {'timestamp': datetime.now().isoformat(), 'calls': arguments.calls, 'seed': arguments.seed,
+              'scales': list()}
+    try:
+        for scale in arguments.scale or DEFAULT_SCALES:
+            scale = tuple(int(value) for value in scale.split(':'))
+            print('Scale {} songs, {} users, {} playlists, {} links'.format(*scale), file=sys.stderr)
+            report['scales'].append(run_scale(loop, config, counter, scale, arguments.calls, arguments.seed))
+    finally:
+        loop.close()
+
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
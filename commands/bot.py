@@ -1,5 +1,7 @@
 import discord.ext.commands as dec
 
+import database.common
+import database.maintenance
 from commands.common import *
 
 
@@ -11,6 +13,17 @@ class Bot:
     _help_messages = {
         'group': 'Bot controls (player modes, status, title, volume)',
 
+        'backup': '* Makes a backup of the database\n\n'
+        'A consistent snapshot of the database is made while the bot keeps running, then compressed and stored in the '
+        'configured backup directory. Only a limited number of the most recent snapshots is kept. Backups are also '
+        'made automatically in the configured interval.',
+
+        'dbstats': '* Displays the database and extraction pool statistics\n\n'
+        'For every pool, number of workers, jobs waiting in the queue and jobs being run is shown, together with the '
+        'average and maximum time the jobs had to wait before being started. Size of the automatic playlist candidate '
+        'pool, the read cache usage and the result of the last database maintenance are included as well. Mainly for '
+        'debugging purposes, as an aid for the bot operators.',
+
         'djmode': '* Switches the player to the DJ mode\n\n'
         'In the DJ mode, users can join a DJ queue and play music from their playlists. Automatic playlist is used '
         'when no DJs are present and someone is listening. Listeners can vote to skip songs played.',
@@ -50,6 +63,33 @@ class Bot:
                                  'available subcommands.'
                                  .format(subcommand, self._bot.config['ddmbot']['delimiter']))
 
+    @privileged
+    @bot.command(ignore_extra=False, help=_help_messages['backup'])
+    async def backup(self):
+        await self._bot.whisper('Database backup was started, it may take a while')
+        path = await self._bot.backup.backup()
+        await self._bot.whisper('Database backup was saved as {}'.format(path))
+
+    @privileged
+    @bot.command(ignore_extra=False, help=_help_messages['dbstats'])
+    async def dbstats(self):
+        reply = '**Database statistics:**'
+        for stats in database.common.executor_stats():
+            reply += '\n    **{name}:** {workers} worker(s), {queued} queued, {running} running, {completed} done, ' \
+                     'wait {wait_avg:.3f}s on average, {wait_max:.3f}s at most'.format_map(stats)
+        pool_size = database.common.autoplaylist_size()
+        reply += '\n    **Automatic playlist candidates:** {}'.format('not built yet' if pool_size is None
+                                                                      else pool_size)
+        reply += '\n    **Read cache:** {size}/{capacity} entries, {hits} hit(s), {misses} miss(es), {evictions} ' \
+                 'evicted, hit rate {hit_rate:.1%}'.format_map(database.common.cache_stats())
+        report = database.maintenance.last_report()
+        if report is None:
+            reply += '\n    **Maintenance:** not done yet'
+        else:
+            reply += '\n    **Maintenance:** {:%Y-%m-%d %H:%M}, took {total_time:.3f}s, WAL size {wal_before} -> ' \
+                     '{wal_after} bytes'.format(report['timestamp'], **report)
+        await self._bot.whisper(reply)
+
     @privileged
     @bot.command(ignore_extra=False, help=_help_messages['djmode'])
     async def djmode(self):
@@ -1,7 +1,12 @@
+import io
+import tempfile
+
+import aiohttp
 import discord.ext.commands as dec
 import discord.ext.commands.view as decw
 
 import database.playlist
+import database.transfer
 
 
 class Playlist:
@@ -34,6 +39,17 @@ class Playlist:
         'delete': 'Removes the specified playlist\n\n'
         'Playlist is removed along with all the songs in it. This cannot be undone.',
 
+        'export': 'Sends you your playlist as a file\n\n'
+        'Songs are exported either as JSON Lines (\'jsonl\', default) or as an M3U playlist (\'m3u\'), including '
+        'their titles and durations. You can specify the format with an optional argument. Exported files can be '
+        'imported back with \'playlist import\' command, even to a different bot.',
+
+        'import': 'Inserts the songs from the attached file into your playlist\n\n'
+        'Attach a file made by \'playlist export\' command (or any other M3U playlist) to the message. Songs are '
+        'inserted *at the end* of your playlist. Titles and durations stored in the file are used, so even large '
+        'playlists are imported quickly. Songs without them are looked up the same way as the ones you append, which '
+        'takes longer, and they are inserted after the rest.',
+
         'list': 'Lists the available playlists\n\n'
         'List of your playlist is be returned along with the number of songs and their repeat setting.',
 
@@ -149,6 +165,59 @@ class Playlist:
         await self._db.delete(int(ctx.message.author.id), playlist_name)
         await self._bot.whisper('**Playlist** {} **was removed**'.format(playlist_name))
 
+    @playlist.command(pass_context=True, ignore_extra=False, help=_help_messages['export'])
+    async def export(self, ctx, song_format: str='jsonl'):
+        return await self._export(ctx.message.author, song_format)
+
+    @playlist.command(pass_context=True, ignore_extra=False, hidden=True)
+    async def export_explicit(self, ctx, playlist_name: str, song_format: str='jsonl'):
+        return await self._export(ctx.message.author, song_format, playlist_name)
+
+    async def _export(self, user, song_format, playlist_name=None):
+        song_format = song_format.lower()
+        if song_format not in database.transfer.FORMATS:
+            raise dec.UserInputError('Supported formats are: {}'.format(', '.join(database.transfer.FORMATS)))
+
+        # playlist is written to a temporary file by the database reader, so it is never held in memory as a whole
+        with tempfile.TemporaryFile() as file:
+            output = io.TextIOWrapper(file, encoding='utf-8')
+            playlist_name, count = await self._db.export_songs(int(user.id), playlist_name, output, song_format)
+            output.detach()
+            file.seek(0)
+            await self._bot.client.send_file(user, file, filename='{}.{}'.format(playlist_name, song_format),
+                                             content='**{} song(s) exported from** {}'.format(count, playlist_name))
+
+    @playlist.command(name='import', pass_context=True, ignore_extra=False, help=_help_messages['import'])
+    async def import_(self, ctx):
+        return await self._import(ctx.message)
+
+    @playlist.command(pass_context=True, ignore_extra=False, hidden=True)
+    async def import_explicit(self, ctx, playlist_name: str):
+        return await self._import(ctx.message, playlist_name)
+
+    async def _import(self, message, playlist_name=None):
+        if len(message.attachments) != 1:
+            raise dec.UserInputError('Please attach a single file exported by the \'playlist export\' command')
+        attachment = message.attachments[0]
+
+        with tempfile.TemporaryFile() as file:
+            async with aiohttp.ClientSession(loop=self._bot.loop) as session:
+                async with session.get(attachment['url']) as response:
+                    if response.status != 200:
+                        raise RuntimeError('Failed to download the attached file')
+                    while True:
+                        data = await response.content.read(65536)
+                        if not data:
+                            break
+                        file.write(data)
+            file.seek(0)
+            lines = io.TextIOWrapper(file, encoding='utf-8', errors='replace')
+            result = await self._db.import_songs(int(message.author.id), playlist_name, lines,
+                                                 database.transfer.format_from_name(attachment['filename']))
+            lines.detach()
+
+        await self._report_insert(*result)
+
     @playlist.command(pass_context=True, ignore_extra=False, aliases=['l'], help=_help_messages['list'])
     async def list(self, ctx):
         items = await self._db.list(int(ctx.message.author.id))
@@ -274,9 +343,9 @@ class Playlist:
         await self._bot.whisper('Please note that inserting new songs can take a while. Be patient and wait for the '
                                 'result. You can run other commands, but **avoid manipulating your playlist**.')
         # now do the operation
-        playlist_name, inserted, failed, truncated, messages = await self._db.insert(user_id, playlist_name, prepend,
-                                                                                     uris)
+        await self._report_insert(*await self._db.insert(user_id, playlist_name, prepend, uris))
 
+    async def _report_insert(self, playlist_name, inserted, failed, truncated, messages):
         reply = '**{} song(s) inserted to** {}\n{} insertion(s) failed'.format(inserted, playlist_name, failed)
         if messages:
             reply += '\n **>** ' + '\n **>** '.join(messages[:10])
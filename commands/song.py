@@ -1,6 +1,7 @@
 import discord.ext.commands as dec
 
 import database.song
+from database.player import PlayEndReason
 from commands.common import *
 
 
@@ -8,7 +9,7 @@ class Song:
     """Song insertion, querying and manipulation"""
     def __init__(self, bot):
         self._bot = bot
-        self._db = database.song.SongInterface(bot.loop)
+        self._db = database.song.SongInterface(bot.loop, bot.config['ddmbot'])
 
     _help_messages = {
         'group': 'Song information, querying and manipulation',
@@ -36,6 +37,11 @@ class Song:
         'playlist. Bot operators are expected to investigate download issues and provide an alternative source for '
         'the songs if necessary.',
 
+        'history': 'Lists the most recently played songs\n\n'
+        'Up to 20 songs are returned, along with the time the song was started, for how long it was played, the '
+        'number of listeners and the reason the playback ended.\nIndividual plays are kept only for a limited time, '
+        'as configured by the bot operators.',
+
         'info': 'Displays information about the song stored in the database\n\n'
         'Mainly for debugging purposes, as an aid for the bot operators.',
 
@@ -50,14 +56,19 @@ class Song:
 
         'search': 'Queries the database for songs\n\n'
         'Title and UURI are matched against the specified keywords. All the keywords must match either the title or '
-        'UURI. Up to 20 results are returned.\nThis command can be used to lookup song IDs.',
+        'UURI, partial words are matched from their beginning. Up to 20 best matching results are returned.\nThis '
+        'command can be used to lookup song IDs.',
 
         'split': '* Marks a given song as an original\n\n'
         'This command can be used to fix duplication status of the song. After this command is issued, the song '
         'specified won\'t be marked as a duplicate anymore.\nThis is the inverse command to the \'deduplicate\'. '
         'Just like the \'deduplicate\', this command does not manipulate with timestamps nor credit counts.\nSong ID '
         'can be located in the square brackets just before the song title. It is included in the status message and '
-        'all the listings.'
+        'all the listings.',
+
+        'top': 'Lists the most played songs\n\n'
+        'Up to 20 songs played the most times over the given number of days (7 by default, today included) are '
+        'returned, along with the number of times they were skipped.'
     }
 
     @dec.group(invoke_without_command=True, aliases=['s'], help=_help_messages['group'])
@@ -97,6 +108,18 @@ class Song:
                 '\n **>** '.join(['[{}] {}'.format(*item) for item in items])
         await self._bot.whisper(reply)
 
+    @song.command(ignore_extra=False, help=_help_messages['history'])
+    async def history(self):
+        items = await self._db.history(20)
+        if not items:
+            await self._bot.whisper('There are no songs in the play history')
+            return
+        reply = '**{} most recently played songs:**\n **>** '.format(len(items)) + '\n **>** '.join(
+            ['[{}] {} ({:%Y-%m-%d %H:%M}, {}s, {} listeners, {})'
+             .format(song_id, title, started, duration, listeners, PlayEndReason(reason).name.lower().replace('_', ' '))
+             for song_id, title, started, duration, listeners, reason in items])
+        await self._bot.whisper(reply)
+
     @song.command(ignore_extra=False, aliases=['i'], help=_help_messages['info'])
     async def info(self, song_id: int):
         info = await self._db.get_info(song_id)
@@ -141,3 +164,15 @@ class Song:
     async def split(self, song_id: int):
         await self._db.merge(song_id, song_id)
         await self._bot.message('Song [{}] has been marked as unique'.format(song_id))
+
+    @song.command(ignore_extra=False, help=_help_messages['top'])
+    async def top(self, days: int = 7):
+        if days < 1:
+            raise dec.UserInputError('Number of days must be a positive number')
+        items = await self._db.top(days, 20)
+        if not items:
+            await self._bot.whisper('No songs were played in the last {} day(s)'.format(days))
+            return
+        reply = '**{} most played songs in the last {} day(s):**\n **>** '.format(len(items), days) + \
+                '\n **>** '.join(['[{}] {} (played {} times, skipped {} times)'.format(*item) for item in items])
+        await self._bot.whisper(reply)
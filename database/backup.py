@@ -0,0 +1,159 @@
+import asyncio
+import gzip
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import suppress
+from datetime import datetime
+from urllib.request import pathname2url
+
+from database.common import *
+
+
+# Online backup of the database into rotated, compressed snapshots
+#
+# A dedicated read-only connection copies a consistent snapshot of the database, read in a single transaction. It is
+# written into a new file by VACUUM INTO if the SQLite library supports it (3.27.0 or newer), or copied table by table
+# in batches of rows otherwise, pausing between the batches in both cases. Thanks to the WAL journal, readers and
+# writers do not block each other, so the bot keeps writing during the whole backup. The copy is checked, compressed
+# and the oldest snapshots over the limit are removed.
+class BackupInterface(DBInterface):
+    _suffix = '.sqlite.gz'
+    # number of SQLite virtual machine instructions between the pauses of VACUUM INTO
+    _vacuum_steps = 100000
+
+    def __init__(self, loop, config):
+        self._config_interval = int(config['backup_interval'])
+        self._config_directory = config['backup_directory']
+        self._config_keep = max(int(config['backup_keep']), 1)
+        self._config_batch_rows = int(config['backup_batch_rows'])
+        self._config_batch_pause = int(config['backup_batch_pause']) / 1000
+        DBInterface.__init__(self, loop)
+
+        self._lock = asyncio.Lock(loop=loop)
+        self._abort = threading.Event()
+
+    async def backup(self):
+        # returns the path of the snapshot created
+        if self._lock.locked():
+            raise RuntimeError('Database backup is in progress already')
+        with (await self._lock):
+            self._abort.clear()
+            try:
+                return await self._loop.run_in_executor(None, self._create_snapshot)
+            except asyncio.CancelledError:
+                # the copy runs in a thread of its own, it is stopped at the next batch
+                self._abort.set()
+                raise
+
+    async def task_backup(self):
+        if not self._config_interval:
+            return
+        while True:
+            await asyncio.sleep(self._config_interval * 3600, loop=self._loop)
+            try:
+                path = await self.backup()
+            except (RuntimeError, OSError, sqlite3.Error):
+                log.exception('Scheduled database backup failed')
+            else:
+                log.info('Scheduled database backup was saved as {}'.format(path))
+
+    #
+    # Internally used methods, run in a thread of their own
+    #
+    def _create_snapshot(self):
+        os.makedirs(self._config_directory, exist_ok=True)
+        prefix = os.path.splitext(os.path.basename(self._database.database))[0] + '-'
+        path = os.path.join(self._config_directory, prefix + datetime.now().strftime('%Y%m%d-%H%M%S'))
+
+        try:
+            self._copy(path + '.sqlite')
+            with open(path + '.sqlite', 'rb') as source, gzip.open(path + self._suffix, 'wb') as destination:
+                shutil.copyfileobj(source, destination)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.remove(path + self._suffix)
+            raise
+        finally:
+            with suppress(FileNotFoundError):
+                os.remove(path + '.sqlite')
+
+        self._rotate(prefix)
+        return path + self._suffix
+
+    def _copy(self, filename):
+        uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(self._database.database)))
+        source = sqlite3.connect(uri, uri=True, isolation_level=None)
+        try:
+            if sqlite3.sqlite_version_info >= (3, 27, 0):
+                # VACUUM INTO reads a snapshot of its own, the handler returning True interrupts the statement
+                source.set_progress_handler(self._progress, self._vacuum_steps)
+                try:
+                    source.execute('VACUUM INTO ?;', (filename,))
+                except sqlite3.OperationalError:
+                    if self._abort.is_set():
+                        raise RuntimeError('Database backup was aborted')
+                    raise
+            else:
+                source.execute('BEGIN;')
+                source.execute('SELECT COUNT(*) FROM sqlite_master;')  # read transaction starts with the first read
+                self._dump(source, filename)
+        finally:
+            source.close()
+
+        destination = sqlite3.connect(filename)
+        try:
+            result = destination.execute('PRAGMA quick_check;').fetchone()[0]
+            if result != 'ok':
+                raise RuntimeError('Database backup is corrupted: {}'.format(result))
+        finally:
+            destination.close()
+
+    def _dump(self, source, filename):
+        # tables are copied in batches of rows, virtual tables (the full-text index of songs) are created afterwards and
+        # rebuilt from their content tables, so their shadow tables are skipped, followed by the indexes and triggers
+        schema = source.execute('SELECT type, name, sql FROM sqlite_master '
+                                'WHERE sql NOT NULL AND substr(name, 1, 7) != \'sqlite_\';').fetchall()
+        virtual = [name for kind, name, sql in schema if sql.upper().startswith('CREATE VIRTUAL TABLE')]
+        tables = [(name, sql) for kind, name, sql in schema if kind == 'table' and name not in virtual and
+                  not any(name.startswith(prefix + '_') for prefix in virtual)]
+
+        destination = sqlite3.connect(filename, isolation_level=None)
+        try:
+            destination.execute('BEGIN;')
+            for name, sql in tables:
+                destination.execute(sql)
+                rows = source.execute('SELECT * FROM "{}";'.format(name))
+                batch = rows.fetchmany(self._config_batch_rows)
+                while batch:
+                    destination.executemany('INSERT INTO "{}" VALUES ({});'
+                                            .format(name, ', '.join('?' * len(batch[0]))), batch)
+                    if self._progress():
+                        raise RuntimeError('Database backup was aborted')
+                    batch = rows.fetchmany(self._config_batch_rows)
+            for kind, name, sql in schema:
+                if name in virtual:
+                    destination.execute(sql)
+                    destination.execute('INSERT INTO "{0}" ("{0}") VALUES (\'rebuild\');'.format(name))
+                elif kind != 'table':
+                    destination.execute(sql)
+            destination.execute('COMMIT;')
+        finally:
+            destination.close()
+
+    def _progress(self):
+        # pauses the copy, returns True if it should be aborted instead
+        if self._abort.is_set():
+            return True
+        time.sleep(self._config_batch_pause)
+        return self._abort.is_set()
+
+    def _rotate(self, prefix):
+        # timestamps in the names are sorted the same way as the snapshots were made
+        snapshots = sorted(name for name in os.listdir(self._config_directory)
+                           if name.startswith(prefix) and name.endswith(self._suffix))
+        for name in snapshots[:max(len(snapshots) - self._config_keep, 0)]:
+            os.remove(os.path.join(self._config_directory, name))
+            log.debug('Database snapshot {} was removed'.format(name))
@@ -0,0 +1,80 @@
+import collections
+import threading
+
+
+# Read-through cache of the user-facing reads (playlist listings, song and user information)
+#
+# Every value is stored under a key and any number of groups, invalidating a group removes all the values stored under
+# it. Writers invalidate the groups they affect once their changes are committed. Least recently used values are
+# evicted when the cache is full, size of zero disables the cache. Values loaded while an invalidation took place are
+# not stored, as they may be outdated already. Thread-safe, values are shared and must not be modified by the callers.
+class ReadCache:
+    def __init__(self, size=0):
+        self._lock = threading.Lock()
+        self.reset(size)
+
+    def reset(self, size):
+        with self._lock:
+            self._size = size
+            self._values = collections.OrderedDict()  # key -> (value, groups)
+            self._groups = collections.defaultdict(set)  # group -> keys
+            self._version = 0
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
+
+    async def get(self, key, loader, *args, groups):
+        # groups may be given as a function of the value loaded
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                self._hits += 1
+                return self._values[key][0]
+            self._misses += 1
+            version = self._version
+
+        value = await loader(*args)
+        if callable(groups):
+            groups = groups(value)
+
+        with self._lock:
+            if self._size > 0 and version == self._version:
+                self._remove(key)
+                self._values[key] = value, tuple(groups)
+                for group in groups:
+                    self._groups[group].add(key)
+                while len(self._values) > self._size:
+                    self._remove(next(iter(self._values)))
+                    self._evictions += 1
+        return value
+
+    def invalidate(self, *groups):
+        with self._lock:
+            self._version += 1
+            for group in groups:
+                for key in self._groups.pop(group, ()):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._values.clear()
+            self._groups.clear()
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {'size': len(self._values), 'capacity': self._size, 'hits': self._hits, 'misses': self._misses,
+                    'evictions': self._evictions, 'hit_rate': self._hits / lookups if lookups else 0.0}
+
+    def _remove(self, key):
+        # lock must be held
+        entry = self._values.pop(key, None)
+        if entry is None:
+            return
+        for group in entry[1]:
+            keys = self._groups.get(group)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._groups[group]
@@ -1,15 +1,26 @@
+import concurrent.futures
 import functools
 import logging
+import random
 import re
+import threading
+import time
+from datetime import datetime, timedelta
 
 import peewee
 import youtube_dl
 
+from database.cache import ReadCache
+
 # set up the logger
 log = logging.getLogger('ddmbot.database')
 
-# database object
-_database = peewee.SqliteDatabase(None, pragmas=[('journal_mode', 'WAL'), ('foreign_keys', 'ON')])
+# database object, the pragma list is shared with it and applied to every connection opened, see initialize()
+_default_pragmas = [('journal_mode', 'WAL'), ('foreign_keys', 'ON')]
+_pragmas = list(_default_pragmas)
+_database = peewee.SqliteDatabase(None, pragmas=_pragmas)
+_pragma_regex = re.compile(r'^[a-z_]+$')
+_pragma_value_regex = re.compile(r'^-?[0-9]+$|^[A-Za-z]+$')
 
 
 class DdmBotSchema(peewee.Model):
@@ -17,11 +28,6 @@ class DdmBotSchema(peewee.Model):
         database = _database
 
 
-# Class to store timestamp in the database
-class CreditTimestamp(DdmBotSchema):
-    last = peewee.DateTimeField()
-
-
 # Class representing a song table in the database
 class Song(DdmBotSchema):
     # we use integer primary keys to represent songs in the database
@@ -36,9 +42,10 @@ class Song(DdmBotSchema):
     duration = peewee.IntegerField()
     is_blacklisted = peewee.BooleanField(default=False)
 
-    # overplaying protection
+    # overplaying protection, credit count is valid at the credit timestamp, see CreditPolicy
     last_played = peewee.DateTimeField()
     credit_count = peewee.IntegerField()
+    credit_timestamp = peewee.DateTimeField()
 
     # automatic playlist
     listener_count = peewee.IntegerField(default=0)
@@ -46,12 +53,16 @@ class Song(DdmBotSchema):
     has_failed = peewee.BooleanField(default=False)
 
     # song may be duplicated using multiple sources
-    duplicate = peewee.ForeignKeyField('self', null=True)
+    duplicate = peewee.ForeignKeyField('self', null=True, index=True)
+    # root of the duplicates (the song itself if not a duplicate) and the counts aggregated over all of them (kept on
+    # the root only), all maintained by triggers, see _canonical_songs migration
+    canonical = peewee.ForeignKeyField('self', null=True, index=True, related_name='canonical_set')
+    total_listener_count = peewee.IntegerField(default=0)
+    total_skip_vote_count = peewee.IntegerField(default=0)
 
 
 # we will need this to resolve a foreign key loop
 DeferredUser = peewee.DeferredRelation()
-DeferredLink = peewee.DeferredRelation()
 
 
 # Table for storing playlists, as many as user wants
@@ -59,28 +70,32 @@ class Playlist(DdmBotSchema):
     id = peewee.PrimaryKeyField()
 
     # playlist is owned by a user
-    user = peewee.ForeignKeyField(DeferredUser)
+    user = peewee.ForeignKeyField(DeferredUser, index=True)
     # for an identifier, we choose a "nice enough" name
     name = peewee.CharField()
-    # the first song of the playlist
-    head = peewee.ForeignKeyField(DeferredLink, null=True, default=None)
     # playlist may be set to repeat itself, this is default except to implicit one
     repeat = peewee.BooleanField(default=True)
+    # number of links, maintained by the writers, see _song_counts migration
+    song_count = peewee.IntegerField(default=0)
 
     class Meta:
         # we want the couple (user, name) to be unique (so no user has two playlists with the same name)
         constraints = [peewee.SQL('UNIQUE(user_id, name)')]
 
 
-# Table for storing songs in playlist -- linked list approach
+# Table for storing songs in playlist -- ordered by an indexed position key
+#
+# Songs are only ever inserted at either end of the playlist, so the front gets (minimum - 1) and the back gets
+# (maximum + 1), both are index lookups. Ties (e.g. after shuffling) are resolved by the link id.
 class Link(DdmBotSchema):
     id = peewee.PrimaryKeyField()
 
     playlist = peewee.ForeignKeyField(Playlist)
     song = peewee.ForeignKeyField(Song)
-    next = peewee.ForeignKeyField('self', null=True)
+    position = peewee.BigIntegerField()
 
-DeferredLink.set_model(Link)
+    class Meta:
+        indexes = ((('playlist', 'position'), False), (('playlist', 'song'), False))
 
 
 # Finally, table for storing information about users
@@ -92,6 +107,8 @@ class User(DdmBotSchema):
     active_playlist = peewee.ForeignKeyField(Playlist, null=True, default=None)
     play_count = peewee.IntegerField(default=0)
     listen_count = peewee.IntegerField(default=0)
+    # number of links in all the playlists of the user, maintained by the writers, see _song_counts migration
+    song_count = peewee.IntegerField(default=0)
 
     # for checking if the user should be ignored by the ddmbot
     is_ignored = peewee.BooleanField(default=False)
@@ -99,6 +116,77 @@ class User(DdmBotSchema):
 DeferredUser.set_model(User)
 
 
+# Table caching the results of the extractor (youtube_dl), including the failures
+class ExtractorCache(DdmBotSchema):
+    # unique URI of a song or normalized list URL, see DBSongUtil._make_list_key
+    key = peewee.CharField(primary_key=True)
+
+    # song metadata
+    title = peewee.CharField(null=True)
+    duration = peewee.IntegerField(null=True)
+    # list expansion, JSON encoded list of [url, title, duration] entries
+    entries = peewee.TextField(null=True)
+    # error message if the extraction has failed
+    error = peewee.CharField(null=True)
+
+    timestamp = peewee.DateTimeField(index=True)
+
+
+# Journal of the play statistics not yet applied to the Song and User tables, see StatsAggregator
+class StatsJournal(DdmBotSchema):
+    id = peewee.PrimaryKeyField()
+
+    song_id = peewee.IntegerField()
+    dj_id = peewee.BigIntegerField(null=True)
+    # JSON encoded list of the listener IDs
+    listeners = peewee.TextField()
+    skip_vote_count = peewee.IntegerField()
+    # for the play history, see PlayHistory (missing for the entries journaled before the history was introduced)
+    started = peewee.DateTimeField(null=True)
+    duration = peewee.IntegerField(default=0)
+    end_reason = peewee.SmallIntegerField(default=0)
+
+
+# Log of the individual plays, append-only, pruned after the retention period (see MaintenanceInterface)
+#
+# Written in batches by the StatsAggregator, which rolls the plays up into DailyPlayStats at the same time.
+class PlayHistory(DdmBotSchema):
+    id = peewee.PrimaryKeyField()
+
+    # plain integers, no foreign key checks needed for the appends
+    song_id = peewee.IntegerField()
+    dj_id = peewee.BigIntegerField(null=True)
+    started = peewee.DateTimeField(index=True)
+    # number of seconds the song was actually played
+    duration = peewee.IntegerField()
+    listener_count = peewee.IntegerField()
+    skip_vote_count = peewee.IntegerField()
+    # see database.player.PlayEndReason
+    end_reason = peewee.SmallIntegerField()
+
+
+# Plays aggregated per song and day, kept forever (queries should use this table instead of the PlayHistory)
+class DailyPlayStats(DdmBotSchema):
+    day = peewee.DateField()
+    song_id = peewee.IntegerField()
+
+    play_count = peewee.IntegerField()
+    skip_count = peewee.IntegerField()
+    listener_count = peewee.IntegerField()
+    skip_vote_count = peewee.IntegerField()
+    # total number of seconds played
+    duration = peewee.IntegerField()
+
+    class Meta:
+        primary_key = peewee.CompositeKey('day', 'song_id')
+
+
+# Table for keeping track of the applied schema migrations
+class SchemaVersion(DdmBotSchema):
+    version = peewee.IntegerField(primary_key=True)
+    applied = peewee.DateTimeField()
+
+
 # Model to retrieve failed foreign key constrains
 class ForeignKeyCheckModel(DdmBotSchema):
     table = peewee.CharField()
@@ -107,36 +195,242 @@ class ForeignKeyCheckModel(DdmBotSchema):
     fkid = peewee.IntegerField()
 
 
+#
+# Executors
+#
+# Database writes are serialized by a single thread (and thus a single connection), reads are served by a small pool of
+# read-only connections running concurrently thanks to the WAL journal. Network extraction has a pool of its own, so
+# slow services cannot hold up the database access. Extraction the playback is waiting for (stream URL of the next
+# song) has a dedicated worker, so it is never queued behind bulk imports filling the resolver pool. All of them are
+# created by initialize().
+#
+class MonitoredExecutor(concurrent.futures.Executor):
+    def __init__(self, name, max_workers, *, read_only=False):
+        self._name = name
+        self._max_workers = max_workers
+        self._read_only = read_only
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._local = threading.local()
+
+        # statistics, wait time is measured from the submission to the start of the job [seconds]
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    @property
+    def name(self):
+        return self._name
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            self._queued += 1
+        try:
+            return self._executor.submit(self._run, time.monotonic(), fn, args, kwargs)
+        except RuntimeError:  # executor has been shut down
+            with self._lock:
+                self._queued -= 1
+            raise
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def get_stats(self):
+        with self._lock:
+            return {'name': self._name, 'workers': self._max_workers, 'queued': self._queued,
+                    'running': self._running, 'completed': self._completed,
+                    'wait_avg': self._wait_total / self._completed if self._completed else 0.0,
+                    'wait_max': self._wait_max}
+
+    def _run(self, submitted, fn, args, kwargs):
+        wait = time.monotonic() - submitted
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+        try:
+            if self._read_only and not getattr(self._local, 'read_only', False):
+                # connections are thread-local, make sure the ones of this pool are never used for writing
+                _database.execute_sql('PRAGMA query_only = ON;')
+                self._local.read_only = True
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+
+
+_writer = None
+_reader = None
+_resolver = None
+_playback = None
+
+
+def executor_stats():
+    return [executor.get_stats() for executor in (_writer, _reader, _resolver, _playback) if executor is not None]
+
+
+#
+# Candidate pool of the automatic playlist
+#
+# Eligible song IDs are kept in a list for O(1) random picks, together with their positions for O(1) removals (the
+# last item is moved to the place of the removed one). Interfaces changing the song eligibility (blacklist, failures,
+# merges, statistics, ...) only mark the songs affected by invalidate() once the change is committed. The player
+# interface, which knows the criteria, brings the pool up to date before picking, see PlayerInterface.
+#
+class AutoplaylistPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._songs = list()
+        self._positions = dict()
+        # set of songs to check again, None if the whole pool has to be rebuilt
+        self._dirty = None
+
+    def __len__(self):
+        return len(self._songs)
+
+    @property
+    def built(self):
+        return self._dirty is not None
+
+    def invalidate(self, song_ids=None):
+        with self._lock:
+            if song_ids is None:
+                self._dirty = None
+            elif self._dirty is not None:
+                self._dirty.update(song_ids)
+
+    def take_dirty(self):
+        # returns a set of songs to check again or None if the pool has to be rebuilt, marks are cleared
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = set()
+            return dirty
+
+    def rebuild(self, song_ids):
+        with self._lock:
+            self._songs = list(song_ids)
+            self._positions = {song_id: position for position, song_id in enumerate(self._songs)}
+
+    def update(self, checked_ids, eligible_ids):
+        with self._lock:
+            for song_id in checked_ids:
+                if song_id in eligible_ids:
+                    if song_id not in self._positions:
+                        self._positions[song_id] = len(self._songs)
+                        self._songs.append(song_id)
+                elif song_id in self._positions:
+                    position = self._positions.pop(song_id)
+                    last = self._songs.pop()
+                    if last != song_id:
+                        self._songs[position] = last
+                        self._positions[last] = position
+
+    def pick(self):
+        with self._lock:
+            return random.choice(self._songs) if self._songs else None
+
+
+_autoplaylist = AutoplaylistPool()
+
+
+def autoplaylist_size():
+    # returns None if the pool is not built yet (it is built on the next pick)
+    return len(_autoplaylist) if _autoplaylist.built else None
+
+
+#
+# Cache of the user-facing reads, shared by all the interfaces, see database.cache.ReadCache
+#
+# Groups used for the invalidation:
+#   ('user', user_id) -- playlist listing and user information (counts, flags)
+#   ('active', user_id) -- active playlist and the listing of it (playlist name not given)
+#   ('playlist', user_id, playlist_name) -- listings of the playlist
+#   ('song', song_id) -- information about the song and the songs it duplicates or is duplicated by
+#   ('songs',) -- information about all the songs
+#
+_cache = ReadCache()
+
+
+def cache_stats():
+    return _cache.get_stats()
+
+
 class DBInterface:
     def __init__(self, loop):
         if _database.is_closed():
             raise RuntimeError('Database must be initialized and opened before instantiating interfaces')
         self._loop = loop
         self._database = _database
+        self._autoplaylist = _autoplaylist
+        self._cache = _cache
+
+    def run_in_reader(self, func, *args):
+        return self._loop.run_in_executor(_reader, functools.partial(func, *args))
+
+    def run_in_resolver(self, func, *args):
+        # for the network (youtube_dl) operations, database must not be accessed
+        return self._loop.run_in_executor(_resolver, functools.partial(func, *args))
+
+    def run_in_playback(self, func, *args):
+        # for the network operations the playback is waiting for, database must not be accessed
+        return self._loop.run_in_executor(_playback, functools.partial(func, *args))
 
 
-# decorator for DBInterface methods
+# decorator for DBInterface methods, method is run by the (only) writer thread
 def in_executor(method):
     def wrapped_method(self, *args, **kwargs):
         func = functools.partial(method, self, *args, **kwargs)
-        return self._loop.run_in_executor(None, func)
+        return self._loop.run_in_executor(_writer, func)
 
     return wrapped_method
 
 
+# decorator for DBInterface methods which only read from the database
+def in_read_executor(method):
+    def wrapped_method(self, *args, **kwargs):
+        func = functools.partial(method, self, *args, **kwargs)
+        return self._loop.run_in_executor(_reader, func)
+
+    return wrapped_method
+
+
+# SQLite limits the number of host parameters in a single statement (999 in the default build)
+MAX_VARIABLES = 999
+
+
+# helper splitting a list into parts small enough to be used as query parameters
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
 class DBSongUtil:
     # some class (static) constant variables
     _yt_regex = re.compile(r'^(https?://)?(www\.)?youtu(\.be/|be.com/.+?[?&]v=)(?P<id>[a-zA-Z0-9_-]+)')
     _sc_regex = re.compile(r'^(https?://)?soundcloud.com/(?P<artist>[^/]+)/(?P<track>[^/?]+)')
     _bc_regex = re.compile(r'^(https?://)?(?P<artist>[^.]+).bandcamp.com/track/(?P<track>[^/?]+)')
-    _list_regex = re.compile(
-        r'^(https?://)?(www\.youtube\.com/.*[?&]list=.+|soundcloud\.com/[^/]+/sets/.+|[^.:/]+\.bandcamp.com/album/.+)$')
+    _list_regex = re.compile(r'^(https?://)?(?:(?P<yt>www\.youtube\.com/.*[?&]list=.+)|'
+                             r'(?P<sc>soundcloud\.com/[^/]+/sets/.+)|(?P<bc>[^.:/]+\.bandcamp.com/album/.+))$')
+    _yt_list_regex = re.compile(r'[?&]list=(?P<id>[^&#]+)')
     _url_base = {'yt': 'https://www.youtube.com/watch?v={}',
                  'sc': 'https://soundcloud.com/{}/{}',
                  'bc': 'https://{}.bandcamp.com/track/{}'}
 
-    _ytdl = youtube_dl.YoutubeDL({'extract_flat': 'in_playlist', 'format': 'bestaudio/best', 'quiet': True,
-                                  'no_color': True})
+    _ytdl_options = {'extract_flat': 'in_playlist', 'format': 'bestaudio/best', 'quiet': True, 'no_color': True}
+    _ytdl_local = threading.local()
+
+    @classmethod
+    def _get_ytdl(cls):
+        # youtube_dl objects are not meant to be shared between the threads, must be called by the worker using it
+        ytdl = getattr(cls._ytdl_local, 'ytdl', None)
+        if ytdl is None:
+            ytdl = youtube_dl.YoutubeDL(cls._ytdl_options)
+            cls._ytdl_local.ytdl = ytdl
+        return ytdl
 
     @staticmethod
     def _make_url(song_uuri):
@@ -147,6 +441,28 @@ class DBSongUtil:
     def _is_list(input_url):
         return DBSongUtil._list_regex.match(input_url) is not None
 
+    @staticmethod
+    def _make_list_key(list_url):
+        # makes a normalized key of the list URL suitable for database storage
+        # method will return the key in one of the following formats:
+        #   yt:list:<list_id> for youtube playlist
+        #   sc:list:<path> for soundcloud set
+        #   bc:list:<path> for bandcamp album
+        match = DBSongUtil._list_regex.match(list_url)
+        if match is None:
+            return None
+        service = match.lastgroup
+        path = match.group(service)
+        if service == 'yt':
+            return 'yt:list:{}'.format(DBSongUtil._yt_list_regex.search(path).group('id'))
+        return '{}:list:{}'.format(service, path.split('?')[0].rstrip('/'))
+
+    @staticmethod
+    def _get_list_service(input_url):
+        # returns the service prefix (as used in unique URIs) of the list URL
+        match = DBSongUtil._list_regex.match(input_url)
+        return match.lastgroup if match else None
+
     @staticmethod
     def _make_uuri(song_url):
         # makes unique URI from URLs suitable for database storage
@@ -166,6 +482,36 @@ class DBSongUtil:
         return None
 
 
+# Overplay protection credits are renewed lazily
+#
+# Every song stores the credit count valid at its credit timestamp, credits renewed since then are added when needed.
+# Renewal period is given by op_credit_renew [hours], credit count never exceeds op_credit_cap.
+class CreditPolicy:
+    def __init__(self, config):
+        self._cap = int(config['op_credit_cap'])
+        self._renew = timedelta(hours=int(config['op_credit_renew']))
+
+    @property
+    def cap(self):
+        return self._cap
+
+    def available(self, credit_count, credit_timestamp, current_time):
+        renewed = max((current_time - credit_timestamp) // self._renew, 0)
+        return min(credit_count + renewed, self._cap)
+
+    def consume(self, credit_count, credit_timestamp, current_time):
+        # returns a new (credit_count, credit_timestamp) couple after a single credit is used
+        renewed = max((current_time - credit_timestamp) // self._renew, 0)
+        if credit_count + renewed >= self._cap:
+            # the period in progress does not matter when the cap is reached
+            return self._cap - 1, current_time
+        return max(credit_count + renewed - 1, 0), credit_timestamp + renewed * self._renew
+
+    def condition(self, current_time):
+        # SQL predicate selecting the songs with at least one credit available
+        return (Song.credit_count > 0) | (Song.credit_timestamp <= current_time - self._renew)
+
+
 class DBPlaylistUtil:
     _playlist_regex = re.compile(r'^[a-zA-Z0-9_-]{1,32}$')
 
@@ -200,28 +546,279 @@ class DBPlaylistUtil:
             return playlist, created
 
 
+#
+# Schema migrations
+#
+# Migrations are applied at startup in the order of their versions, each one in its own transaction, and recorded in
+# the SchemaVersion table. They are run on freshly created databases too, so every migration must cope with the schema
+# created by create_tables() as well.
+#
+_migrations = list()
+
+
+def migration(version):
+    def decorator(function):
+        _migrations.append((version, function))
+        return function
+
+    return decorator
+
+
+def _get_columns(table):
+    return [row[1] for row in _database.execute_sql('PRAGMA table_info({});'.format(table)).fetchall()]
+
+
+def _migrate():
+    current = SchemaVersion.select(peewee.fn.MAX(SchemaVersion.version)).scalar() or 0
+    for version, function in sorted(_migrations, key=lambda item: item[0]):
+        if version <= current:
+            continue
+        log.info('Applying database migration {} ({})'.format(version, function.__name__))
+        with _database.atomic():
+            function()
+            SchemaVersion.create(version=version, applied=datetime.now())
+
+
+#
+# Playlists stored as linked lists (Playlist.head, Link.next) are converted to ordered positions
+#
+# Legacy columns are left in place, but cleared, as SQLite cannot drop columns used in foreign key constrains.
+#
+@migration(1)
+def _link_positions():
+    if 'position' in _get_columns('link'):
+        return
+
+    log.info('Converting playlists to the ordered position representation')
+    _database.execute_sql('ALTER TABLE link ADD COLUMN position INTEGER NOT NULL DEFAULT 0;')
+    _database.execute_sql('CREATE TEMP TABLE link_position (id INTEGER PRIMARY KEY, position INTEGER NOT NULL);')
+    # walk all the chains at once, starting from the playlist heads
+    _database.execute_sql('INSERT INTO temp.link_position (id, position) '
+                          'WITH RECURSIVE chain (id, position) AS ('
+                          'SELECT head_id, 0 FROM playlist WHERE head_id IS NOT NULL '
+                          'UNION ALL '
+                          'SELECT link.next_id, chain.position + 1 FROM chain JOIN link ON link.id == chain.id '
+                          '  WHERE link.next_id IS NOT NULL) '
+                          'SELECT id, position FROM chain;')
+    _database.execute_sql('UPDATE link SET position = (SELECT position FROM temp.link_position '
+                          '  WHERE link_position.id == link.id) WHERE id IN (SELECT id FROM temp.link_position);')
+    # clear the legacy pointers, links unreachable from the head were never played nor listed, drop them
+    _database.execute_sql('UPDATE link SET next_id = NULL;')
+    _database.execute_sql('UPDATE playlist SET head_id = NULL;')
+    orphaned = _database.execute_sql('DELETE FROM link WHERE id NOT IN (SELECT id FROM temp.link_position);') \
+        .rowcount
+    if orphaned:
+        log.warning('{} unreachable playlist link(s) were removed'.format(orphaned))
+    _database.execute_sql('DROP TABLE temp.link_position;')
+    _database.execute_sql('CREATE INDEX IF NOT EXISTS link_playlist_id_position ON link (playlist_id, position);')
+
+
+#
+# Indexes supporting the hot predicates (duplicate checks, duplicate resolution and per-user limit counts)
+#
+# Names match the ones peewee generates, so the statements are no-ops for databases created with the indexes.
+#
+@migration(2)
+def _hot_path_indexes():
+    _database.execute_sql('CREATE INDEX IF NOT EXISTS link_playlist_id_song_id ON link (playlist_id, song_id);')
+    _database.execute_sql('CREATE INDEX IF NOT EXISTS song_duplicate_id ON song (duplicate_id);')
+    _database.execute_sql('CREATE INDEX IF NOT EXISTS playlist_user_id ON playlist (user_id);')
+    # the legacy pointer is still a foreign key, every link deletion looks it up
+    if 'next_id' in _get_columns('link'):
+        _database.execute_sql('CREATE INDEX IF NOT EXISTS link_next_id ON link (next_id);')
+
+
+#
+# Full-text index of song titles and unique URIs, kept in sync by triggers
+#
+# If the SQLite library is built without FTS5, the index is not created and the search falls back to LIKE predicates.
+#
+@migration(3)
+def _song_full_text_index():
+    try:
+        _database.execute_sql('CREATE VIRTUAL TABLE IF NOT EXISTS song_fts USING fts5(title, uuri, content=\'song\', '
+                              'content_rowid=\'id\');')
+    except peewee.OperationalError:
+        log.warning('SQLite library does not support FTS5, song search will not use a full-text index')
+        return
+
+    _database.execute_sql('CREATE TRIGGER IF NOT EXISTS song_fts_insert AFTER INSERT ON song BEGIN '
+                          'INSERT INTO song_fts (rowid, title, uuri) VALUES (new.id, new.title, new.uuri); END;')
+    _database.execute_sql('CREATE TRIGGER IF NOT EXISTS song_fts_delete AFTER DELETE ON song BEGIN '
+                          'INSERT INTO song_fts (song_fts, rowid, title, uuri) '
+                          '  VALUES (\'delete\', old.id, old.title, old.uuri); END;')
+    _database.execute_sql('CREATE TRIGGER IF NOT EXISTS song_fts_update AFTER UPDATE OF title, uuri ON song BEGIN '
+                          'INSERT INTO song_fts (song_fts, rowid, title, uuri) '
+                          '  VALUES (\'delete\', old.id, old.title, old.uuri); '
+                          'INSERT INTO song_fts (rowid, title, uuri) VALUES (new.id, new.title, new.uuri); END;')
+    _database.execute_sql('INSERT INTO song_fts (song_fts) VALUES (\'rebuild\');')
+
+
+#
+# Credits are stored per song together with a timestamp instead of being renewed by rewriting the whole table
+#
+# Credit counts were valid at the time recorded in the (now dropped) CreditTimestamp table.
+#
+@migration(4)
+def _lazy_credits():
+    if 'credit_timestamp' not in _get_columns('song'):
+        _database.execute_sql('ALTER TABLE song ADD COLUMN credit_timestamp DATETIME NOT NULL '
+                              'DEFAULT \'1970-01-01 00:00:00\';')
+        timestamp = None
+        if 'credittimestamp' in _database.get_tables():
+            timestamp = _database.execute_sql('SELECT MAX(last) FROM credittimestamp;').fetchone()[0]
+        _database.execute_sql('UPDATE song SET credit_timestamp = ?;', (timestamp or datetime.now(),))
+    _database.execute_sql('DROP TABLE IF EXISTS credittimestamp;')
+
+
+#
+# Every song refers to its canonical (root) song, so the duplicates are resolved by a single join
+#
+# Duplicates are never chained (see SongInterface.merge), the root of a song is thus either the song it duplicates or
+# the song itself. Listener and skip vote counts of all the duplicates are aggregated on the root.
+#
+@migration(5)
+def _canonical_songs():
+    columns = _get_columns('song')
+    if 'canonical_id' not in columns:
+        _database.execute_sql('ALTER TABLE song ADD COLUMN canonical_id INTEGER REFERENCES song (id);')
+    if 'total_listener_count' not in columns:
+        _database.execute_sql('ALTER TABLE song ADD COLUMN total_listener_count INTEGER NOT NULL DEFAULT 0;')
+        _database.execute_sql('ALTER TABLE song ADD COLUMN total_skip_vote_count INTEGER NOT NULL DEFAULT 0;')
+    _database.execute_sql('CREATE INDEX IF NOT EXISTS song_canonical_id ON song (canonical_id);')
+
+    # fill in the values before the triggers are in place
+    _database.execute_sql('UPDATE song SET canonical_id = COALESCE(duplicate_id, id);')
+    _database.execute_sql('UPDATE song SET '
+                          'total_listener_count = (SELECT COALESCE(SUM(listener_count), 0) FROM song AS member '
+                          '  WHERE member.canonical_id == song.id), '
+                          'total_skip_vote_count = (SELECT COALESCE(SUM(skip_vote_count), 0) FROM song AS member '
+                          '  WHERE member.canonical_id == song.id);')
+
+    _database.execute_sql('CREATE TRIGGER IF NOT EXISTS song_canonical_insert AFTER INSERT ON song BEGIN '
+                          'UPDATE song SET canonical_id = COALESCE(new.duplicate_id, new.id) WHERE id == new.id; END;')
+    _database.execute_sql('CREATE TRIGGER IF NOT EXISTS song_canonical_update AFTER UPDATE OF duplicate_id ON song '
+                          'BEGIN UPDATE song SET canonical_id = COALESCE(new.duplicate_id, new.id) WHERE id == new.id; '
+                          'END;')
+    # counts are moved along with the song to another root
+    _database.execute_sql('CREATE TRIGGER IF NOT EXISTS song_totals_move AFTER UPDATE OF canonical_id ON song '
+                          'WHEN old.canonical_id IS NOT new.canonical_id BEGIN '
+                          'UPDATE song SET total_listener_count = total_listener_count - old.listener_count, '
+                          '  total_skip_vote_count = total_skip_vote_count - old.skip_vote_count '
+                          '  WHERE id == old.canonical_id; '
+                          'UPDATE song SET total_listener_count = total_listener_count + new.listener_count, '
+                          '  total_skip_vote_count = total_skip_vote_count + new.skip_vote_count '
+                          '  WHERE id == new.canonical_id; END;')
+    _database.execute_sql('CREATE TRIGGER IF NOT EXISTS song_totals_update '
+                          'AFTER UPDATE OF listener_count, skip_vote_count ON song BEGIN '
+                          'UPDATE song SET '
+                          '  total_listener_count = total_listener_count + new.listener_count - old.listener_count, '
+                          '  total_skip_vote_count = total_skip_vote_count + new.skip_vote_count - old.skip_vote_count '
+                          '  WHERE id == new.canonical_id; END;')
+
+
+#
+# Song counts of playlists and users are kept in the tables instead of being counted on every use
+#
+# They are updated by the writers, with a single statement per operation whatever the number of links affected (see
+# PlaylistInterface and fastpath). Counts are recounted from scratch only here and during the maintenance.
+#
+@migration(6)
+def _song_counts():
+    if 'song_count' not in _get_columns('playlist'):
+        _database.execute_sql('ALTER TABLE playlist ADD COLUMN song_count INTEGER NOT NULL DEFAULT 0;')
+    if 'song_count' not in _get_columns('user'):
+        _database.execute_sql('ALTER TABLE "user" ADD COLUMN song_count INTEGER NOT NULL DEFAULT 0;')
+    fix_song_counts()
+
+
+# Recounts the songs of all the playlists and users, returns the number of counts that had to be fixed
+def fix_song_counts():
+    fixed = _database.execute_sql('UPDATE playlist SET song_count = (SELECT COUNT(*) FROM link '
+                                  '  WHERE link.playlist_id == playlist.id) '
+                                  'WHERE song_count != (SELECT COUNT(*) FROM link '
+                                  '  WHERE link.playlist_id == playlist.id);').rowcount
+    fixed += _database.execute_sql('UPDATE "user" SET song_count = (SELECT COALESCE(SUM(song_count), 0) '
+                                   '  FROM playlist WHERE playlist.user_id == "user".id) '
+                                   'WHERE song_count != (SELECT COALESCE(SUM(song_count), 0) '
+                                   '  FROM playlist WHERE playlist.user_id == "user".id);').rowcount
+    return fixed
+
+
+#
+# Play history fields are added to the statistics journal, see PlayHistory
+#
+@migration(7)
+def _play_history():
+    columns = _get_columns('statsjournal')
+    if 'started' not in columns:
+        _database.execute_sql('ALTER TABLE statsjournal ADD COLUMN started DATETIME;')
+        _database.execute_sql('ALTER TABLE statsjournal ADD COLUMN duration INTEGER NOT NULL DEFAULT 0;')
+        _database.execute_sql('ALTER TABLE statsjournal ADD COLUMN end_reason SMALLINT NOT NULL DEFAULT 0;')
+
+
+#
+# Song counts used to be maintained by triggers on the link table, which cost a statement per link for bulk operations
+#
+@migration(8)
+def _drop_link_count_triggers():
+    for trigger in ('link_count_insert', 'link_count_delete', 'link_count_move'):
+        _database.execute_sql('DROP TRIGGER IF EXISTS {};'.format(trigger))
+
+
 #
 # Function to initialize and open database connection to a given file
 #
-# Integrity check is performed.
+# Integrity check is performed. Sizes of the read and resolver pools and the read cache are given by the arguments.
+# Additional pragmas (e.g. synchronous, cache_size) may be given as a dictionary, these apply to all the connections.
 #
-def initialize(filename):
+def initialize(filename, *, read_workers=4, resolver_workers=8, cache_size=0, pragmas=None):
+        global _writer, _reader, _resolver, _playback
         if not _database.is_closed():
             raise RuntimeError('Database is opened already')
 
+        # pragmas are formatted into the statements, only plain names and values are accepted
+        pragmas = list((pragmas or dict()).items())
+        for name, value in pragmas:
+            if not _pragma_regex.match(name) or not _pragma_value_regex.match(str(value)):
+                raise ValueError('Invalid database pragma {} = {}'.format(name, value))
+        _pragmas[:] = _default_pragmas + pragmas
+
         _database.init(filename)
         _database.connect()
-        _database.create_tables([CreditTimestamp, Song, Playlist, Link, User], safe=True)
+        _database.create_tables([Song, Playlist, Link, User, ExtractorCache, StatsJournal, PlayHistory, DailyPlayStats,
+                                 SchemaVersion], safe=True)
+        _migrate()
 
         # check for the failed foreign key constrains
         failed_query = ForeignKeyCheckModel.raw('PRAGMA foreign_key_check;')
         if len(failed_query.execute()):
             _database.close()
             raise RuntimeError('Foreign key constrains check failed, database is corrupted and needs to be fixed')
+        _autoplaylist.invalidate()
+        _autoplaylist.rebuild([])
+        _cache.reset(cache_size)
+        _writer = MonitoredExecutor('writer', 1)
+        _reader = MonitoredExecutor('reader', read_workers, read_only=True)
+        _resolver = MonitoredExecutor('resolver', resolver_workers)
+        # the player waits for a single extraction at a time
+        _playback = MonitoredExecutor('playback', 1)
+
+
+def _close_connection():
+    if not _database.is_closed():
+        _database.close()
 
 
 #
 # Function taking care of properly closing database
 #
 def close():
+        global _writer, _reader, _resolver, _playback
+        if _writer is not None:
+            # the writer connection is closed by its own thread, pending writes are finished first
+            _writer.submit(_close_connection).result()
+            for executor in (_writer, _reader, _resolver, _playback):
+                executor.shutdown()
+            _writer = _reader = _resolver = _playback = None
         _database.close()
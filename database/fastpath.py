@@ -0,0 +1,140 @@
+import collections
+
+from database.common import *
+
+
+#
+# Hot database operations executed through the sqlite3 connection directly
+#
+# sqlite3 keeps a cache of prepared statements for every connection (keyed by the SQL text), so with the constant
+# statements below only the parameters are bound on every call. No query objects nor model instances are created and
+# results are plain tuples. The connection is the one peewee uses in the current thread, statements are thus part of the
+# transaction in progress (if any). Schema changes must be reflected here, the statements are not generated.
+#
+_select_user = 'SELECT is_ignored FROM "user" WHERE id == ?;'
+_insert_user = 'INSERT INTO "user" (id, active_playlist_id, play_count, listen_count, song_count, is_ignored) ' \
+               'VALUES (?, NULL, 0, 0, 0, 0);'
+
+_select_active_playlist = 'SELECT playlist.id, playlist.repeat, playlist.name FROM playlist ' \
+                          'JOIN "user" ON "user".active_playlist_id == playlist.id WHERE "user".id == ?;'
+_song_columns = 'song.id, song.uuri, song.title, song.duration, song.is_blacklisted, song.last_played, ' \
+                'song.credit_count, song.credit_timestamp, song.has_failed'
+_select_front_song = 'SELECT link.id, ' + _song_columns + ' FROM link ' \
+                     'JOIN song AS linked ON linked.id == link.song_id JOIN song ON song.id == linked.canonical_id ' \
+                     'WHERE link.playlist_id == ? ORDER BY link.position, link.id LIMIT 1;'
+_select_song = 'SELECT ' + _song_columns + ' FROM song WHERE song.id == ?;'
+_delete_link = 'DELETE FROM link WHERE id == ?;'
+_rotate_link = 'UPDATE link SET position = (SELECT MAX(position) FROM link WHERE playlist_id == ?) + 1 WHERE id == ?;'
+
+_select_credits = 'SELECT credit_count, credit_timestamp FROM song WHERE id == ?;'
+_update_played = 'UPDATE song SET last_played = ?, credit_count = ?, credit_timestamp = ? WHERE id == ?;'
+_insert_journal = 'INSERT INTO statsjournal (song_id, dj_id, listeners, skip_vote_count, started, duration, ' \
+                  'end_reason) VALUES (?, ?, ?, ?, ?, ?, ?);'
+
+_select_front_position = 'SELECT MIN(position) FROM link WHERE playlist_id == ?;'
+_select_back_position = 'SELECT MAX(position) FROM link WHERE playlist_id == ?;'
+_count_user_songs = 'SELECT song_count FROM "user" WHERE id == ?;'
+_insert_link = 'INSERT INTO link (playlist_id, song_id, position) VALUES (?, ?, ?);'
+_update_playlist_songs = 'UPDATE playlist SET song_count = song_count + ? WHERE id == ?;'
+_update_user_songs = 'UPDATE "user" SET song_count = song_count + ? ' \
+                     'WHERE id == (SELECT user_id FROM playlist WHERE id == ?);'
+
+
+# same attributes as the Song model has, so both can be used interchangeably for reading
+SongRow = collections.namedtuple('SongRow', ['id', 'uuri', 'title', 'duration', 'is_blacklisted', 'last_played',
+                                             'credit_count', 'credit_timestamp', 'has_failed'])
+
+
+def _make_song(row):
+    return SongRow(row[0], row[1], row[2], row[3], bool(row[4]), Song.last_played.python_value(row[5]), row[6],
+                   Song.credit_timestamp.python_value(row[7]), bool(row[8]))
+
+
+def _execute(database, sql, parameters):
+    return database.get_conn().execute(sql, parameters)
+
+
+#
+# BotInterface
+#
+def check_user(database, user_id):
+    # returns (is_ignored, created) couple, the user is created if not present
+    row = _execute(database, _select_user, (user_id,)).fetchone()
+    if row is not None:
+        return bool(row[0]), False
+    _execute(database, _insert_user, (user_id,))
+    return False, True
+
+
+#
+# PlayerInterface
+#
+def get_active_playlist(database, user_id):
+    # returns (playlist_id, repeat, playlist_name) tuple or None
+    row = _execute(database, _select_active_playlist, (user_id,)).fetchone()
+    return None if row is None else (row[0], bool(row[1]), row[2])
+
+
+def get_front_song(database, playlist_id):
+    # returns (link_id, canonical song) couple or None if the playlist is empty
+    row = _execute(database, _select_front_song, (playlist_id,)).fetchone()
+    return None if row is None else (row[0], _make_song(row[1:]))
+
+
+def get_song(database, song_id):
+    row = _execute(database, _select_song, (song_id,)).fetchone()
+    return None if row is None else _make_song(row)
+
+
+def delete_link(database, playlist_id, link_id):
+    _execute(database, _delete_link, (link_id,))
+    update_song_counts(database, playlist_id, -1)
+
+
+def rotate_link(database, playlist_id, link_id):
+    _execute(database, _rotate_link, (playlist_id, link_id))
+
+
+def get_credits(database, song_id):
+    credit_count, credit_timestamp = _execute(database, _select_credits, (song_id,)).fetchone()
+    return credit_count, Song.credit_timestamp.python_value(credit_timestamp)
+
+
+def update_played(database, song_id, last_played, credit_count, credit_timestamp):
+    _execute(database, _update_played, (last_played, credit_count, credit_timestamp, song_id))
+
+
+def insert_journal(database, song_id, dj_id, listeners, skip_vote_count, started, duration, end_reason):
+    # returns the journal entry id
+    return _execute(database, _insert_journal, (song_id, dj_id, listeners, skip_vote_count, started, duration,
+                                                end_reason)).lastrowid
+
+
+#
+# PlaylistInterface
+#
+def get_front_position(database, playlist_id):
+    position = _execute(database, _select_front_position, (playlist_id,)).fetchone()[0]
+    return 0 if position is None else position - 1
+
+
+def get_back_position(database, playlist_id):
+    position = _execute(database, _select_back_position, (playlist_id,)).fetchone()[0]
+    return 0 if position is None else position + 1
+
+
+def count_user_songs(database, user_id):
+    row = _execute(database, _count_user_songs, (user_id,)).fetchone()
+    return 0 if row is None else row[0]
+
+
+def insert_links(database, rows):
+    # rows are (playlist_id, song_id, position) tuples
+    database.get_conn().executemany(_insert_link, rows)
+
+
+def update_song_counts(database, playlist_id, difference):
+    # song counts of the playlist and its owner are changed once per operation, see _song_counts migration
+    if difference:
+        _execute(database, _update_playlist_songs, (difference, playlist_id))
+        _execute(database, _update_user_songs, (difference, playlist_id))
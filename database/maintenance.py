@@ -0,0 +1,107 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+
+from database.common import *
+
+# report of the last maintenance run, see MaintenanceInterface.run
+_last_report = None
+
+
+def last_report():
+    return _last_report
+
+
+# Periodic database maintenance
+#
+# WAL journal is checkpointed and truncated, so it does not grow over time, query planner statistics are kept up to
+# date by PRAGMA optimize and a full ANALYZE is done once in a while (or if there are no statistics at all). Free pages
+# are released if the database uses an incremental auto-vacuum and the play history older than the retention period is
+# removed (daily statistics are kept). Song counts of the playlists and users are checked as well. All of this is done
+# by the writer, so the maintenance is only started when the player is idle, as given by the predicate passed to
+# task_maintenance().
+class MaintenanceInterface(DBInterface):
+    # delay between the checks if the player is idle [seconds]
+    _idle_poll_interval = 60
+
+    def __init__(self, loop, config):
+        self._config_interval = int(config['db_maintenance_interval'])
+        self._config_analyze_interval = int(config['db_analyze_interval']) * 3600
+        self._config_history_retention = timedelta(days=int(config['history_retention']))
+        DBInterface.__init__(self, loop)
+
+        self._next_analyze = None
+
+    @in_executor
+    def run(self):
+        global _last_report
+        report = {'wal_before': self._get_wal_size()}
+        start = time.monotonic()
+
+        report['history_pruned'] = PlayHistory.delete() \
+            .where(PlayHistory.started < datetime.now() - self._config_history_retention).execute()
+        # song counts are maintained by the writers, they only go wrong if the database is modified outside of the bot
+        with self._database.atomic():
+            report['song_counts_fixed'] = fix_song_counts()
+
+        busy, log_frames, checkpointed = self._database.execute_sql('PRAGMA wal_checkpoint(TRUNCATE);').fetchone()
+        report['checkpoint_time'] = time.monotonic() - start
+        report['checkpoint_complete'] = not busy
+
+        step = time.monotonic()
+        if self._next_analyze is None:
+            # full analysis is done right away only if there are no statistics yet
+            self._next_analyze = step if not self._has_statistics() else step + self._config_analyze_interval
+        report['analyze'] = step >= self._next_analyze
+        if report['analyze']:
+            self._database.execute_sql('ANALYZE;')
+            self._next_analyze = step + self._config_analyze_interval
+        else:
+            self._database.execute_sql('PRAGMA optimize;')
+        report['statistics_time'] = time.monotonic() - step
+
+        step = time.monotonic()
+        if self._database.execute_sql('PRAGMA auto_vacuum;').fetchone()[0] == 2:
+            self._database.execute_sql('PRAGMA incremental_vacuum;').fetchall()
+        report['vacuum_time'] = time.monotonic() - step
+
+        report['total_time'] = time.monotonic() - start
+        report['wal_after'] = self._get_wal_size()
+        report['timestamp'] = datetime.now()
+        _last_report = report
+        return report
+
+    async def task_maintenance(self, is_idle):
+        if not self._config_interval:
+            return
+        while True:
+            await asyncio.sleep(self._config_interval, loop=self._loop)
+            while not is_idle():
+                await asyncio.sleep(self._idle_poll_interval, loop=self._loop)
+
+            report = await self.run()
+            log.info('Database maintenance done in {total_time:.3f}s (checkpoint {checkpoint_time:.3f}s, '
+                     '{0} {statistics_time:.3f}s), WAL size {wal_before} -> {wal_after} bytes'
+                     .format('analyze' if report['analyze'] else 'optimize', **report))
+            if report['history_pruned']:
+                log.info('{} play history record(s) older than the retention period were removed'
+                         .format(report['history_pruned']))
+            if report['song_counts_fixed']:
+                log.warning('Song counts of {} playlist(s) and user(s) were inconsistent and had to be fixed'
+                            .format(report['song_counts_fixed']))
+            if not report['checkpoint_complete']:
+                log.warning('WAL checkpoint could not be completed, the database was in use')
+
+    #
+    # Internally used methods
+    #
+    def _get_wal_size(self):
+        try:
+            return os.path.getsize(self._database.database + '-wal')
+        except OSError:
+            return 0
+
+    def _has_statistics(self):
+        return 'sqlite_stat1' in [row[0] for row in self._database.execute_sql(
+            'SELECT name FROM sqlite_master WHERE type == \'table\';').fetchall()]
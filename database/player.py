@@ -1,5 +1,10 @@
+import asyncio
+import collections
+import enum
+import json
 from datetime import datetime, timedelta
 
+from database import fastpath
 from database.common import *
 
 
@@ -18,8 +23,22 @@ class UnavailableSongError(Exception):
         return self._song_title
 
 
+# Reason the song has stopped playing, recorded in the play history
+class PlayEndReason(enum.IntEnum):
+    INTERRUPTED = 0  # player was stopped or switched to another mode
+    FINISHED = 1
+    SKIPPED_BY_DJ = 2
+    SKIPPED_BY_VOTE = 3
+    SKIPPED_BY_OPERATOR = 4
+
+    @property
+    def skipped(self):
+        return self in (PlayEndReason.SKIPPED_BY_DJ, PlayEndReason.SKIPPED_BY_VOTE, PlayEndReason.SKIPPED_BY_OPERATOR)
+
+
 class SongContext:
-    __slots__ = ['_dj', '_song', '_title', '_duration', '_url', '_skip_voters', '_all_listeners', '_current_listeners']
+    __slots__ = ['_dj', '_song', '_title', '_duration', '_url', '_skip_voters', '_all_listeners', '_current_listeners',
+                 '_started', '_end_reason']
 
     def __init__(self, user_id, song_id, title, duration, url):
         self._dj = user_id
@@ -32,6 +51,9 @@ class SongContext:
         self._all_listeners = set()
         self._current_listeners = set()
 
+        self._started = None
+        self._end_reason = None
+
     @property
     def song_id(self):
         return self._song
@@ -56,6 +78,22 @@ class SongContext:
     def listeners(self):
         return self._all_listeners
 
+    @property
+    def started(self):
+        return self._started
+
+    @property
+    def end_reason(self):
+        return PlayEndReason.INTERRUPTED if self._end_reason is None else self._end_reason
+
+    def start(self):
+        self._started = datetime.now()
+
+    def end(self, reason):
+        # only the first reason is recorded, e.g. the playback may end while the skip is being processed
+        if self._end_reason is None:
+            self._end_reason = reason
+
     def get_current_counts(self):
         return len(self._skip_voters), len(self._skip_voters & self._current_listeners)
 
@@ -73,128 +111,305 @@ class SongContext:
         self._skip_voters.add(user_id)
 
 
+# Class accumulating the play statistics (song listener and skip vote counts, DJ play counts and user listen counts)
+#
+# Every play is journaled (StatsJournal) before being accumulated, so the counts survive a crash. Accumulated counts
+# are applied in batches by flush(), removing the journal entries at the same time. The plays are appended to the play
+# history and rolled up into the daily statistics by the same transaction. Entries journaled but not applied
+# yet (e.g. after a crash) are loaded on the first use. Not thread-safe, it is meant to be used by the writer only.
+class StatsAggregator:
+    def __init__(self, database, autoplaylist, cache):
+        self._database = database
+        self._autoplaylist = autoplaylist
+        self._cache = cache
+        self._loaded = False
+        self._reset()
+
+    def journal(self, song_id, dj_id, listeners, skip_vote_count, started, duration, end_reason):
+        # to be called in the same transaction as the related song update, returns a journal entry to accumulate
+        listeners = sorted(listeners)
+        entry_id = fastpath.insert_journal(self._database, song_id, dj_id, json.dumps(listeners), skip_vote_count,
+                                           started, duration, int(end_reason))
+        return entry_id, song_id, dj_id, listeners, skip_vote_count, started, duration, end_reason
+
+    def accumulate(self, entry):
+        # to be called once the journal entry is committed
+        self._load()
+        entry_id, song_id, dj_id, listeners, skip_vote_count, started, duration, end_reason = entry
+        if self._last_id is not None and entry_id <= self._last_id:
+            return  # loaded from the journal already
+        self._song_listeners[song_id] += len(listeners)
+        self._song_skips[song_id] += skip_vote_count
+        if dj_id is not None:
+            self._dj_plays[dj_id] += 1
+        self._user_listens.update(listeners)
+        if started is not None:
+            self._plays.append((song_id, dj_id, started, duration, len(listeners), skip_vote_count, int(end_reason)))
+        self._last_id = entry_id
+        self._record_count += 1
+
+    def flush(self):
+        self._load()
+        if self._last_id is None:
+            return 0
+
+        with self._database.atomic():
+            cursor = self._database.get_cursor()
+            cursor.executemany('UPDATE song SET listener_count = listener_count + ?, '
+                               'skip_vote_count = skip_vote_count + ? WHERE id == ?;',
+                               [(listeners, self._song_skips[song_id], song_id)
+                                for song_id, listeners in self._song_listeners.items()])
+            self._update_users(User.play_count, self._dj_plays)
+            self._update_users(User.listen_count, self._user_listens)
+            StatsJournal.delete().where(StatsJournal.id <= self._last_id).execute()
+            cursor.executemany('INSERT INTO playhistory (song_id, dj_id, started, duration, listener_count, '
+                               'skip_vote_count, end_reason) VALUES (?, ?, ?, ?, ?, ?, ?);', self._plays)
+            self._roll_up(cursor)
+            # aggregated listener and skip vote counts affect the automatic playlist eligibility
+            canonical_ids = set()
+            for chunk in chunked(list(self._song_listeners.keys()), MAX_VARIABLES):
+                canonical_ids.update(song_id for song_id, in Song.select(Song.canonical).where(Song.id << chunk)
+                                     .tuples())
+
+        self._autoplaylist.invalidate(canonical_ids)
+        # song information shows the counts of the canonical songs as well, user information the play and listen counts
+        self._cache.invalidate(*[('song', song_id) for song_id in canonical_ids.union(self._song_listeners)],
+                               *[('user', user_id) for user_id in set(self._dj_plays).union(self._user_listens)])
+        flushed = self._record_count
+        self._reset()
+        return flushed
+
+    def _reset(self):
+        self._song_listeners = collections.Counter()
+        self._song_skips = collections.Counter()
+        self._dj_plays = collections.Counter()
+        self._user_listens = collections.Counter()
+        self._plays = list()
+        self._last_id = None
+        self._record_count = 0
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        for entry in StatsJournal.select().order_by(StatsJournal.id):
+            self.accumulate((entry.id, entry.song_id, entry.dj_id, json.loads(entry.listeners), entry.skip_vote_count,
+                             entry.started, entry.duration, entry.end_reason))
+
+    def _roll_up(self, cursor):
+        # counts of the plays accumulated, per day and song
+        days = collections.defaultdict(lambda: [0, 0, 0, 0, 0])
+        for song_id, dj_id, started, duration, listener_count, skip_vote_count, end_reason in self._plays:
+            counts = days[started.date(), song_id]
+            counts[0] += 1
+            counts[1] += PlayEndReason(end_reason).skipped
+            counts[2] += listener_count
+            counts[3] += skip_vote_count
+            counts[4] += duration
+        cursor.executemany('INSERT OR IGNORE INTO dailyplaystats (day, song_id, play_count, skip_count, '
+                           'listener_count, skip_vote_count, duration) VALUES (?, ?, 0, 0, 0, 0, 0);',
+                           list(days.keys()))
+        cursor.executemany('UPDATE dailyplaystats SET play_count = play_count + ?, skip_count = skip_count + ?, '
+                           'listener_count = listener_count + ?, skip_vote_count = skip_vote_count + ?, '
+                           'duration = duration + ? WHERE day == ? AND song_id == ?;',
+                           [tuple(counts) + key for key, counts in days.items()])
+
+    @staticmethod
+    def _update_users(field, counter):
+        # users sharing the same increment are updated by a single statement
+        groups = collections.defaultdict(list)
+        for user_id, count in counter.items():
+            groups[count].append(user_id)
+        for count, user_ids in groups.items():
+            for chunk in chunked(user_ids, MAX_VARIABLES - 1):
+                User.update(**{field.name: field + count}).where(User.id << chunk).execute()
+
+
 class PlayerInterface(DBInterface, DBSongUtil):
+    # number of random pool candidates tried before falling back to the full filter
+    _pick_attempts = 8
+
     def __init__(self, loop, config):
         self._config_ap_threshold = int(config['ap_threshold'])
         self._config_ap_ratio = float(config['ap_skip_ratio'])
         self._config_max_duration = int(config['song_length_limit'])
         self._config_op_interval = int(config['op_interval'])
+        self._config_stats_interval = int(config['stats_flush_interval'])
+        self._credits = CreditPolicy(config)
         DBInterface.__init__(self, loop)
 
+        self._stats = StatsAggregator(self._database, self._autoplaylist, self._cache)
+
+    async def get_next_song(self, user_id):
+        song = await self._pop_next_song(user_id)
+        return await self._make_context(user_id, song)
+
+    async def get_autoplaylist_song(self):
+        song = await self._pick_autoplaylist_song()
+        if song is None:
+            return None
+        return await self._make_context(None, song)
+
     @in_executor
-    def get_next_song(self, user_id):
+    def update_stats(self, song_ctx: SongContext):
+        current_time = datetime.now()
+        listeners, skip_voters = song_ctx.get_final_sets()
+        # last played and credit count are needed by the overplay protection, they are updated right away
+        # counts are only journaled and applied later by the stats aggregator
+        with self._database.atomic():
+            credit_count, credit_timestamp = fastpath.get_credits(self._database, song_ctx.song_id)
+            credit_count, credit_timestamp = self._credits.consume(credit_count, credit_timestamp, current_time)
+            fastpath.update_played(self._database, song_ctx.song_id, current_time, credit_count, credit_timestamp)
+            started = song_ctx.started or current_time
+            entry = self._stats.journal(song_ctx.song_id, song_ctx.dj_id, listeners, len(skip_voters), started,
+                                        int((current_time - started).total_seconds()), song_ctx.end_reason)
+        self._cache.invalidate(('song', song_ctx.song_id))
+        self._stats.accumulate(entry)
+
+    @in_executor
+    def flush_stats(self):
+        flushed = self._stats.flush()
+        if flushed:
+            log.debug('Play statistics of {} songs were flushed'.format(flushed))
+
+    async def extract_stream(self, url):
+        # information about the stream given by the URL, extracted by the playback worker
+        return await self.run_in_playback(self._extract, url)
+
+    async def task_flush_stats(self):
+        # the first flush applies the statistics journaled before a crash
+        while True:
+            await self.flush_stats()
+            await asyncio.sleep(self._config_stats_interval, loop=self._loop)
+
+    #
+    # Internally used methods
+    #
+    @in_executor
+    def _pop_next_song(self, user_id):
         song = None
         with self._database.atomic():
             # check if there is an associated playlist
-            try:
-                playlist = Playlist.select(Playlist.id, Playlist.head, Playlist.repeat) \
-                    .join(User, on=(User.active_playlist == Playlist.id)).where(User.id == user_id).get()
-            except Playlist.DoesNotExist as e:
-                raise LookupError('You don\'t have an active playlist') from e
-
-            if playlist.head is None:
+            playlist = fastpath.get_active_playlist(self._database, user_id)
+            if playlist is None:
+                raise LookupError('You don\'t have an active playlist')
+            playlist_id, repeat, playlist_name = playlist
+
+            # obtain the front of the playlist, the linked song is replaced by its canonical song (duplicates)
+            front = fastpath.get_front_song(self._database, playlist_id)
+            if front is None:
                 raise LookupError('Your playlist is empty')
+            link_id, song = front
 
-            # join song link and song tables to obtain a result
-            link = Link.select(Link, Song).join(Song).where(Link.id == playlist.head).get()
-            song = link.song
-
-            # now check if the link should be re-appended or deleted, update the pointers
-            if not playlist.repeat:
-                # update next song "pointer", should work in any situation
-                Playlist.update(head=link.next_id).where(Playlist.id == playlist.id).execute()
-                # delete the link
-                link.delete_instance()
-            elif link.next_id is not None:  # we should repeat and playlist does consist of multiple songs
-                # update next song "pointer"
-                Playlist.update(head=link.next_id).where(Playlist.id == playlist.id).execute()
-                # append the link at the end
-                Link.update(next=link.id).where(Link.next >> None, Link.playlist == playlist.id).execute()
-                Link.update(next=None).where(Link.id == link.id, Link.playlist == playlist.id).execute()
-
-            # check duplicate song flag and do the replacement if necessary
-            if song.duplicate_id is not None:
-                song = song.duplicate
+            # now check if the link should be re-appended or deleted
+            if not repeat:
+                fastpath.delete_link(self._database, playlist_id, link_id)
+            else:
+                # rotate the link to the back of the playlist
+                fastpath.rotate_link(self._database, playlist_id, link_id)
+        self._cache.invalidate(('playlist', user_id, playlist_name), ('user', user_id))
 
         # check the constrains
         # -- blacklist
         if song.is_blacklisted:
             raise RuntimeError('Song [{}] was blacklisted by an operator'.format(song.id))
         # -- last played
-        time_diff = datetime.now() - song.last_played
+        current_time = datetime.now()
+        time_diff = current_time - song.last_played
         if time_diff.total_seconds() < self._config_op_interval:
             raise RuntimeError('Song [{}] has been played recently'.format(song.id))
         # -- credits remaining
-        if song.credit_count == 0:
+        if self._credits.available(song.credit_count, song.credit_timestamp, current_time) == 0:
             raise RuntimeError('Song [{}] is overplayed'.format(song.id))
         # -- check the song length
         if song.duration > self._config_max_duration:
             raise RuntimeError('Song [{}]\'s length exceeds the limit'.format(song.id))
 
-        # fetch the URL using youtube_dl
-        try:
-            result = self._ytdl.extract_info(self._make_url(song.uuri), download=False)
-        except youtube_dl.DownloadError as e:  # blacklist the song and raise an exception
-            if not song.has_failed:
-                log.warning('Download of the song [{}] failed'.format(song.id), exc_info=True)
-                Song.update(has_failed=True).where(Song.id == song.id).execute()
-            raise UnavailableSongError('Download of the song [{}] failed'.format(song.id), song_id=song.id,
-                                       song_title=song.title) from e
-
-        # there is a chance song was marked as failed before but it no longer applies, fix the flag
-        if song.has_failed:
-            log.info('Failed flag was removed from the song [{}] after a successful download'.format(song.id))
-            Song.update(has_failed=False).where(Song.id == song.id).execute()
-
-        return SongContext(user_id, song.id, song.title, song.duration, result['url'])
+        return song
 
-    @in_executor
-    def get_autoplaylist_song(self):
-        reference_time = datetime.now() - timedelta(seconds=self._config_op_interval)
+    @in_read_executor
+    def _pick_autoplaylist_song(self):
+        current_time = datetime.now()
+        reference_time = current_time - timedelta(seconds=self._config_op_interval)
+        self._refresh_autoplaylist()
+
+        # only the time-based conditions are left to be checked for the pool candidates
+        for _ in range(self._pick_attempts):
+            song_id = self._autoplaylist.pick()
+            if song_id is None:
+                return None
+            song = fastpath.get_song(self._database, song_id)
+            if song is None:
+                continue
+            if song.last_played < reference_time and \
+                    self._credits.available(song.credit_count, song.credit_timestamp, current_time) > 0:
+                return song
+
+        # most of the candidates were played recently, fall back to filtering them all
         query = Song.select(Song).where(
             Song.last_played < reference_time,  # overplay protection interval
-            Song.listener_count >= self._config_ap_threshold,  # listener threshold
-            Song.skip_vote_count < peewee.Passthrough(self._config_ap_ratio) * Song.listener_count,  # skip ratio
+            Song.total_listener_count >= self._config_ap_threshold,  # listener threshold
+            Song.total_skip_vote_count < peewee.Passthrough(self._config_ap_ratio) * Song.total_listener_count,
             Song.duration <= self._config_max_duration,  # song duration
-            Song.credit_count > 0,  # overplay protection
+            self._credits.condition(current_time),  # overplay protection
             ~Song.is_blacklisted,  # cannot be blacklisted
             ~Song.has_failed,  # probably unavailable
-            Song.duplicate >> None  # not fair + outdated information
+            Song.canonical == Song.id  # duplicates are represented by their canonical song, counts included
         ).order_by(peewee.fn.Random())
 
         try:
-            song = query.get()
+            return query.get()
         except Song.DoesNotExist:
             # there is no song conforming to the automatic playlist conditions
             return None
 
+    def _candidate_query(self):
+        # conditions of the automatic playlist independent of time, see _pick_autoplaylist_song
+        return Song.select(Song.id).where(
+            Song.total_listener_count >= self._config_ap_threshold,  # listener threshold
+            Song.total_skip_vote_count < peewee.Passthrough(self._config_ap_ratio) * Song.total_listener_count,
+            Song.duration <= self._config_max_duration,  # song duration
+            ~Song.is_blacklisted,  # cannot be blacklisted
+            ~Song.has_failed,  # probably unavailable
+            Song.canonical == Song.id  # duplicates are represented by their canonical song, counts included
+        )
+
+    def _refresh_autoplaylist(self):
+        dirty = self._autoplaylist.take_dirty()
+        if dirty is None:
+            self._autoplaylist.rebuild(song_id for song_id, in self._candidate_query().tuples())
+            log.info('Automatic playlist pool was built with {} songs'.format(len(self._autoplaylist)))
+            return
+        dirty = list(dirty)
+        for chunk in chunked(dirty, MAX_VARIABLES - 3):
+            eligible = {song_id for song_id, in self._candidate_query().where(Song.id << chunk).tuples()}
+            self._autoplaylist.update(chunk, eligible)
+
+    async def _make_context(self, user_id, song):
+        # fetch the URL using youtube_dl, this is done by the playback worker so neither the database access nor the
+        # playback is held up (e.g. by the resolver pool busy with an import)
         try:
-            result = self._ytdl.extract_info(self._make_url(song.uuri), download=False)
+            result = await self.run_in_playback(self._extract, self._make_url(song.uuri))
         except youtube_dl.DownloadError as e:  # blacklist the song and raise an exception
-            log.warning('Download of the song [{}] failed'.format(song.id), exc_info=True)
-            Song.update(has_failed=True).where(Song.id == song.id).execute()
+            if not song.has_failed:
+                log.warning('Download of the song [{}] failed'.format(song.id), exc_info=True)
+                await self._set_failed(song.id, True)
             raise UnavailableSongError('Download of the song [{}] failed'.format(song.id), song_id=song.id,
                                        song_title=song.title) from e
-        return SongContext(None, song.id, song.title, song.duration, result['url'])
 
-    @in_executor
-    def update_stats(self, song_ctx: SongContext):
-        current_time = datetime.now()
-        listeners, skip_voters = song_ctx.get_final_sets()
-        # update a song in the database -- listener and skip count, last played, credit count
-        song_query = Song.update(listener_count=Song.listener_count + len(listeners),
-                                 skip_vote_count=Song.skip_vote_count + len(skip_voters),
-                                 last_played=current_time, credit_count=Song.credit_count - 1) \
-            .where(Song.id == song_ctx.song_id)
-        # update the dj in the database -- play count
-        dj_query = User.update(play_count=User.play_count + 1).where(User.id == song_ctx.dj_id)
-        # update the listeners in the database -- listen count
-        condition = User.id == listeners.pop()
-        while listeners:
-            condition |= User.id == listeners.pop()
-        listener_query = User.update(listen_count=User.listen_count + 1).where(condition)
+        # there is a chance song was marked as failed before but it no longer applies, fix the flag
+        if song.has_failed:
+            log.info('Failed flag was removed from the song [{}] after a successful download'.format(song.id))
+            await self._set_failed(song.id, False)
 
-        with self._database.atomic():
-            song_query.execute()
-            dj_query.execute()
-            listener_query.execute()
+        return SongContext(user_id, song.id, song.title, song.duration, result['url'])
+
+    def _extract(self, url):
+        # run by the playback worker, youtube_dl object is the one of the worker thread
+        return self._get_ytdl().extract_info(url, download=False)
+
+    @in_executor
+    def _set_failed(self, song_id, has_failed):
+        Song.update(has_failed=has_failed).where(Song.id == song_id).execute()
+        self._autoplaylist.invalidate((song_id,))
+        self._cache.invalidate(('song', song_id))
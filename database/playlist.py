@@ -1,94 +1,247 @@
-import random
-from collections import deque
-from datetime import datetime
+import asyncio
+import itertools
+import json
+from datetime import datetime, timedelta
 
+from playhouse.shortcuts import case
+
+from database import fastpath, transfer
 from database.common import *
 
 
+# Class resolving the input URIs into songs, the database is only read here
+#
+# Lists are expanded first, reusing the metadata of the flat list entries where complete. Songs already present in the
+# database are then looked up at once, so only the remaining ones are queried over the network. Database lookups are
+# done by the read pool of the given interface, both the expansions and the metadata queries run concurrently in the
+# resolver pool, while the number of concurrent requests to a single service is limited by a semaphore. The semaphore
+# is taken by the event loop before the job is submitted, so the workers are never blocked by the jobs waiting for a
+# busy service. Results are returned in the input order, each one is either a tuple (song_id, uuri, title, duration)
+# or an exception describing the failure. Song_id is None if the song is not in the database yet.
+#
+# Extractor results are kept in the ExtractorCache table, failures included. Recent entries are used instead of
+# querying the services again, the validity is given by cache_ttl and negative_ttl [seconds] respectively. New records
+# are written by store_cached(), which has to be called by the database writer.
 class SongUriProcessor(DBSongUtil):
-    def __init__(self, database, credit_cap, uris, *, reverse=False):
-        self._database = database
-        self._credit_cap = credit_cap
-        self._uris = deque(uris)
-        self._reverse = reverse
+    def __init__(self, interface, uris, service_slots, *, cache_ttl=0, negative_ttl=0):
+        self._interface = interface
+        self._uris = list(uris)
+        self._service_slots = service_slots
+        self._cache_ttl = timedelta(seconds=cache_ttl)
+        self._negative_ttl = timedelta(seconds=negative_ttl)
+        # new cache records, written at once when the resolution is done
+        self._cache_records = dict()
+
+    async def resolve(self):
+        # submit all the list expansions first (unless cached), so they are processed concurrently
+        list_keys = {uri: self._make_list_key(uri) for uri in self._uris if self._is_list(uri)}
+        cached = await self._interface.run_in_reader(self._get_cached, list(list_keys.values()))
+        items = list()
+        for uri in self._uris:
+            if uri not in list_keys:
+                items.append((uri, None))
+            elif list_keys[uri] in cached:
+                items.append((uri, cached[list_keys[uri]]))
+            else:
+                future = self._limited(self._get_list_service(uri), self._expand_list, uri)
+                items.append((uri, future))
+
+        # now put together a flat list of (url, title, duration) entries in the input order
+        entries = list()
+        for uri, item in items:
+            if item is None:
+                entries.append((uri, None, None))
+                continue
+            try:
+                if isinstance(item, Exception):
+                    raise item
+                if isinstance(item, asyncio.Future):
+                    item = await self._cache_result(list_keys[uri], item)
+                # both the fresh and the cached records keep the entries encoded
+                entries.extend(tuple(entry) for entry in json.loads(item.entries))
+            except Exception as e:
+                entries.append(RuntimeError('Processing `{}` failed: {}'.format(uri, str(e))))
+
+        # look up all the songs present in the database with a single query (per chunk)
+        known = await self._interface.run_in_reader(self._get_known_songs, entries)
+        cached = await self._interface.run_in_reader(
+            self._get_cached, [self._make_uuri(entry[0]) for entry in entries
+                               if not isinstance(entry, Exception) and self._make_uuri(entry[0]) not in known])
+
+        # submit metadata queries for the songs the database does not know and flat entries are not sufficient for
+        pending = list()
+        for entry in entries:
+            if isinstance(entry, Exception):
+                pending.append((None, None, entry))
+            else:
+                song_uuri = self._make_uuri(entry[0])
+                pending.append((entry[0], song_uuri, self._resolve_entry(entry, known, cached)))
 
-    def __iter__(self):
-        return self
+        # and collect the results in order
+        results = list()
+        for url, song_uuri, item in pending:
+            if isinstance(item, asyncio.Future):
+                try:
+                    record = await self._cache_result(song_uuri, item)
+                    item = None, song_uuri, record.title, record.duration
+                except Exception as e:
+                    item = RuntimeError('Processing `{}` failed: {}'.format(url, str(e)))
+            results.append(item)
+
+        return results
+
+    def store_cached(self):
+        if not self._cache_records or not (self._cache_ttl or self._negative_ttl):
+            return
+        rows = [{'key': record.key, 'title': record.title, 'duration': record.duration, 'entries': record.entries,
+                 'error': record.error, 'timestamp': record.timestamp} for record in self._cache_records.values()]
+        expired = datetime.now() - max(self._cache_ttl, self._negative_ttl)
+        for chunk in chunked(rows, MAX_VARIABLES // len(rows[0])):
+            ExtractorCache.insert_many(chunk).on_conflict('REPLACE').execute()
+        ExtractorCache.delete().where(ExtractorCache.timestamp < expired).execute()
+
+    @classmethod
+    def _get_known_songs(cls, entries):
+        # maps both song IDs and unique URIs to song tuples
+        ids = [int(entry[0]) for entry in entries if not isinstance(entry, Exception) and entry[0].isdigit()]
+        uuris = [cls._make_uuri(entry[0]) for entry in entries if not isinstance(entry, Exception)]
+        uuris = list({uuri for uuri in uuris if uuri})
+
+        known = dict()
+        query = Song.select(Song.id, Song.uuri, Song.title, Song.duration)
+        for chunk in chunked(ids, MAX_VARIABLES):
+            for song in query.where(Song.id << chunk).tuples():
+                known[str(song[0])] = song
+        for chunk in chunked(uuris, MAX_VARIABLES):
+            for song in query.where(Song.uuri << chunk).tuples():
+                known[song[1]] = song
+        return known
+
+    def _resolve_entry(self, entry, known, cached):
+        url, title, duration = entry
+        # check if song id
+        if url.isdigit():
+            if url not in known:
+                return RuntimeError('Song [{}] cannot be found in the database'.format(url))
+            return known[url]
 
-    def _get_song(self, song_url):
-        song_uuri = self._make_uuri(song_url)
+        song_uuri = self._make_uuri(url)
         if not song_uuri:
-            raise ValueError('Malformed URL or unsupported service')
-        # potentially the first query of the song
+            return RuntimeError('Processing `{}` failed: Malformed URL or unsupported service'.format(url))
+        if song_uuri in known:
+            return known[song_uuri]
+        # flat list entries often come with all the information needed
+        if title is not None and duration is not None:
+            return None, song_uuri, title, duration
+        # the song may have been queried recently
+        if song_uuri in cached:
+            record = cached[song_uuri]
+            if isinstance(record, Exception):
+                return RuntimeError('Processing `{}` failed: {}'.format(url, str(record)))
+            return None, song_uuri, record.title, record.duration
+        # we need to create a new record, youtube_dl is necessary to obtain a title and a song length
+        return self._limited(song_uuri.split(':')[0], self._extract_song, song_uuri, title, duration)
+
+    #
+    # Extractor cache
+    #
+    def _get_cached(self, keys):
+        # returns a dictionary of valid records, failures are represented by exceptions
+        keys = list({key for key in keys if key})
+        if not keys or not (self._cache_ttl or self._negative_ttl):
+            return dict()
+
+        current_time = datetime.now()
+        cached = dict()
+        for chunk in chunked(keys, MAX_VARIABLES):
+            for record in ExtractorCache.select().where(ExtractorCache.key << chunk):
+                if record.error is not None:
+                    if current_time - record.timestamp < self._negative_ttl:
+                        cached[record.key] = RuntimeError(record.error)
+                elif current_time - record.timestamp < self._cache_ttl:
+                    cached[record.key] = record
+        return cached
+
+    async def _cache_result(self, key, future):
+        # waits for the result of the extraction and makes a new cache record out of it
+        # exceptions are re-raised, after being recorded
+        record = ExtractorCache(key=key, timestamp=datetime.now())
         try:
-            song = Song.get(Song.uuri == song_uuri)
-        except Song.DoesNotExist:
-            # we need to create a new record, youtube_dl is necessary to obtain a title and a song length
-            result = self._ytdl.extract_info(self._make_url(song_uuri), download=False, process=False)
+            result = await future
+        except Exception as e:
+            record.error = str(e)
+            self._cache_records[key] = record
+            raise
+        if isinstance(result, list):
+            record.entries = json.dumps(result)
+        else:
+            record.title, record.duration = result
+        self._cache_records[key] = record
+        return record
+
+    def _limited(self, service, function, *args):
+        # returns a future of the function run by the resolver pool once a slot of the service is available
+        async def run():
+            async with self._service_slots[service]:
+                return await self._interface.run_in_resolver(function, *args)
+
+        return asyncio.ensure_future(run())
+
+    #
+    # Methods run by the resolver pool
+    #
+
+    def _expand_list(self, list_url):
+        result = self._get_ytdl().extract_info(list_url, download=False)
+        if 'entries' not in result:
+            raise RuntimeError('Malformed URL or unsupported service')
+        # create a new entry list from the results, keeping the metadata if present
+        entries = list()
+        for entry in result['entries']:
+            if result['extractor'] == 'youtube:playlist':
+                url = self._url_base['yt'].format(entry['id'])
+            else:
+                url = entry['url']
+            try:
+                duration = int(entry['duration'])
+            except (KeyError, TypeError, ValueError):
+                duration = None
+            entries.append((url, entry.get('title') or None, duration))
+        return entries
+
+    def _extract_song(self, song_uuri, title=None, duration=None):
+        # only the fields missing are taken from the extracted information, returns (title, duration) tuple
+        result = self._get_ytdl().extract_info(self._make_url(song_uuri), download=False, process=False)
+        if title is None:
             try:
                 title = result['title']
             except KeyError as e:
                 raise RuntimeError('Failed to extract song title') from e
+        if duration is None:
             try:
                 duration = int(result['duration'])
-            except (KeyError, ValueError) as e:
+            except (KeyError, TypeError, ValueError) as e:
                 raise RuntimeError('Failed to extract song duration') from e
-            # since the song may be about to be added multiple times, check again and insert atomically
-            with self._database.atomic():
-                try:
-                    song = Song.create(uuri=song_uuri, title=title, last_played=datetime.utcfromtimestamp(0),
-                                       duration=duration, credit_count=self._credit_cap)
-                except peewee.IntegrityError:
-                    song = Song.get(Song.uuri == song_uuri)
-        return song
-
-    def __next__(self):
-        # get a new item
-        try:
-            uri = self._uris.pop() if self._reverse else self._uris.popleft()
-        except IndexError as e:
-            raise StopIteration from e
-        # check if song id
-        if uri.isdigit():
-            try:
-                return Song.get(Song.id == int(uri))
-            except Song.DoesNotExist as e:
-                raise RuntimeError('Song [{}] cannot be found in the database'.format(uri)) from e
-        # it can be a list otherwise
-        if self._is_list(uri):
-            try:
-                result = self._ytdl.extract_info(uri, download=False)
-                if 'entries' not in result:
-                    raise RuntimeError('Malformed URL or unsupported service')
-                # create a new uri list from the results
-                if result['extractor'] == 'youtube:playlist':
-                    list_uris = [self._url_base['yt'].format(entry['id']) for entry in result['entries']]
-                else:
-                    list_uris = [entry['url'] for entry in result['entries']]
-                # put back most of them and keep the first one
-                if self._reverse:
-                    self._uris.extend(list_uris[:-1])
-                    uri = list_uris[-1]
-                else:
-                    self._uris.extendleft(list_uris[:0:-1])
-                    uri = list_uris[0]
-            except Exception as e:
-                raise RuntimeError('Processing `{}` failed: {}'.format(uri, str(e))) from e
-        # now we have a single song, hopefully at least
-        try:
-            return self._get_song(uri)
-        except Exception as e:
-            raise RuntimeError('Processing `{}` failed: {}'.format(uri, str(e))) from e
+        return title, duration
 
 
 class PlaylistInterface(DBInterface, DBPlaylistUtil):
+    # number of imported songs stored and linked at once
+    _import_chunk = MAX_VARIABLES
+
     def __init__(self, loop, config):
         self._config_max_playlists = int(config['playlist_count_limit'])
         self._config_max_songs = int(config['song_count_limit'])
-        self._config_op_credit_cap = int(config['op_credit_cap'])
+        self._credits = CreditPolicy(config)
+        self._config_cache_ttl = int(config['extractor_cache_ttl'])
+        self._config_negative_ttl = int(config['extractor_negative_ttl'])
         DBInterface.__init__(self, loop)
 
-    @in_executor
+        # metadata requests are done by the resolver pool, these limit the load of a single service
+        self._service_slots = {service: asyncio.BoundedSemaphore(int(config['resolver_service_limit']), loop=loop)
+                               for service in DBSongUtil._url_base}
+
+    @in_read_executor
     def exists(self, user_id, playlist_name):
         try:
             self._get_playlist(user_id, playlist_name)
@@ -96,20 +249,15 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
             return False
         return True
 
-    @in_executor
-    def get_active(self, user_id):
-        try:
-            playlist = Playlist.select(Playlist).join(User, on=(User.active_playlist == Playlist.id)) \
-                .where(User.id == user_id).get()
-        except Playlist.DoesNotExist as e:
-            raise LookupError('You don\'t have an active playlist') from e
-        return playlist.name
+    async def get_active(self, user_id):
+        return await self._cache.get(('active', user_id), self._get_active, user_id, groups=(('active', user_id),))
 
     @in_executor
     def set_active(self, user_id, playlist_name):
         with self._database.atomic():
             playlist = self._get_playlist(user_id, playlist_name)
             User.update(active_playlist=playlist.id).where(User.id == user_id).execute()
+        self._cache.invalidate(('active', user_id))
 
     @in_executor
     def create(self, user_id, playlist_name):
@@ -128,55 +276,38 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
                 Playlist.create(user=user_id, name=playlist_name)
             except peewee.IntegrityError as e:
                 raise ValueError('You already have a playlist with the chosen name'.format(playlist_name)) from e
+        self._cache.invalidate(('user', user_id))
 
     @in_executor
     def clear(self, user_id, playlist_name):
         with self._database.atomic():
             playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name)
-
-            Playlist.update(head=None).where(Playlist.id == playlist.id).execute()
-            Link.delete().where(Link.playlist == playlist.id).execute()
+            deleted = Link.delete().where(Link.playlist == playlist.id).execute()
+            fastpath.update_song_counts(self._database, playlist.id, -deleted)
+        self._cache.invalidate(('playlist', user_id, playlist.name), ('user', user_id))
 
         return playlist.name
 
-    @in_executor
-    def list(self, user_id):
-        query = Playlist.select(Playlist.name, peewee.fn.COUNT(Link.id).alias('song_count'), Playlist.repeat) \
-            .join(Link, join_type=peewee.JOIN_LEFT_OUTER, on=(Link.playlist == Playlist.id)) \
-            .where(Playlist.user == user_id).group_by(Playlist.name)
+    async def list(self, user_id):
+        return await self._cache.get(('list', user_id), self._list, user_id, groups=(('user', user_id),))
 
-        return list(query.dicts())
+    async def show(self, user_id, offset, limit, playlist_name):
+        # listing of the active playlist (no name given) is also dropped when a different playlist is activated
+        def groups(result):
+            songs, name, total = result
+            return [('playlist', user_id, name), ('active', user_id)] + [('song', song_id) for song_id, title in songs]
 
-    @in_executor
-    def show(self, user_id, offset, limit, playlist_name):
-        with self._database.atomic():
-            playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name)
-
-            total = Link.select().where(Link.playlist == playlist.id).count()
-            query = Song.raw('WITH RECURSIVE cte (id, title, next) AS ('
-                             'SELECT song.id, song.title, link.next_id FROM song JOIN link ON song.id == link.song_id '
-                             '  WHERE link.id == ? '
-                             'UNION ALL '
-                             'SELECT song.id, song.title, link.next_id FROM cte, song JOIN link '
-                             '  ON song.id == link.song_id WHERE link.id == cte.next) '
-                             'SELECT id, title FROM cte LIMIT ? OFFSET ?;', playlist.head_id, limit, offset)
-            songs = list(query.tuples())
-
-        return songs, playlist.name, total
+        return await self._cache.get(('show', user_id, playlist_name, offset, limit), self._show, user_id, offset,
+                                     limit, playlist_name, groups=groups)
 
     @in_executor
     def shuffle(self, user_id, playlist_name):
         with self._database.atomic():
             playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name)
-            query = Link.select().where(Link.playlist == playlist.id)
-            song_list = list()
-
-            for item in query:
-                song_list.append(item.song_id)
-            random.shuffle(song_list)
-            for item, new_id in zip(query, song_list):
-                item.song_id = new_id
-                item.save()
+            # assign random positions to all the links at once, 32 bits leave enough room on both sides for
+            # appending and prepending while collisions are unlikely (and harmless, ties are ordered by ids)
+            Link.update(position=peewee.SQL('random() & 4294967295')).where(Link.playlist == playlist.id).execute()
+        self._cache.invalidate(('playlist', user_id, playlist.name))
 
         return playlist.name
 
@@ -185,8 +316,10 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
         with self._database.atomic():
             playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name)
             User.update(active_playlist=None).where(User.id == user_id, User.active_playlist == playlist.id).execute()
-            Link.delete().where(Link.playlist == playlist.id).execute()
+            deleted = Link.delete().where(Link.playlist == playlist.id).execute()
+            fastpath.update_song_counts(self._database, playlist.id, -deleted)
             playlist.delete_instance()
+        self._cache.invalidate(('playlist', user_id, playlist.name), ('user', user_id), ('active', user_id))
 
         return playlist.name
 
@@ -195,56 +328,36 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
         with self._database.atomic():
             playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name)
             Playlist.update(repeat=repeat).where(Playlist.id == playlist.id).execute()
+        self._cache.invalidate(('user', user_id))
 
         return playlist.name
 
-    @in_executor
-    def insert(self, user_id, playlist_name, prepend, uris):
+    async def insert(self, user_id, playlist_name, prepend, uris):
         # we will return a log of messages
         messages = list()
 
         # get a playlist
-        playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name, create_default=True)
+        playlist_name, created = await self._get_insert_playlist(user_id, playlist_name)
         if created:
             messages.append('Since you haven\'t had any playlist, a *default* one was created for you. Note that songs '
                             'will be removed from it after playing.')
-        # construct some iterator object from uris
-        song_list = SongUriProcessor(self._database, self._config_op_credit_cap, uris, reverse=prepend)
-
-        # compose "already present message"
-        present_message = 'The song [{}] {} was already present in your playlist.'
-        if prepend:
-            present_message += ' It was moved to the front.'
 
-        # counters
-        inserted = 0
+        # resolve the whole input first, the database is only read at this point
+        resolved = list()
         failed = 0
-        while True:
-            # get a next song to append
-            try:
-                song = next(song_list)
-            except StopIteration:
-                return playlist.name, inserted, failed, False, messages
-            except Exception as e:
+        song_list = SongUriProcessor(self, uris, self._service_slots, cache_ttl=self._config_cache_ttl,
+                                     negative_ttl=self._config_negative_ttl)
+        for result in await song_list.resolve():
+            if isinstance(result, Exception):
                 # append an error to the list
-                messages.append(str(e))
+                messages.append(str(result))
                 failed += 1
-                continue
-
-            # now insert it
-            try:
-                result = self._prepend_song(user_id, song.id, playlist.name) if prepend \
-                    else self._append_song(user_id, song.id, playlist.name)
+            else:
+                resolved.append(result)
 
-                if result:
-                    inserted += 1
-                else:  # song was in the playlist already
-                    messages.append(present_message.format(song.id, song.title))
-            except Exception as e:
-                # either reached the limit, or the playlist does not exist anymore -- either case we end return
-                messages.append(str(e))
-                failed += 1
-                return playlist.name, inserted, failed, True, messages
+        inserted, rejected, truncated = await self._insert_resolved(user_id, playlist_name, prepend, song_list,
+                                                                    resolved, messages)
+        return playlist_name, inserted, failed + rejected, truncated, messages
 
     @in_executor
     def pop(self, user_id, count, playlist_name):
@@ -255,16 +368,12 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
             # get the target playlist
             playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name)
 
-            deleted = 0
-            # remove *count* links
-            current_link = playlist.head_id
-            while deleted < count and current_link is not None:
-                next_link = Link.select(Link.next).where(Link.id == current_link).get().next_id
-                Link.delete().where(Link.id == current_link).execute()
-                current_link = next_link
-                deleted += 1
-            # update the playlist head
-            Playlist.update(head=current_link).where(Playlist.id == playlist.id).execute()
+            # remove *count* links from the front with a single range delete
+            front = Link.select(Link.id).where(Link.playlist == playlist.id).order_by(Link.position, Link.id) \
+                .limit(count)
+            deleted = Link.delete().where(Link.id << front).execute()
+            fastpath.update_song_counts(self._database, playlist.id, -deleted)
+        self._cache.invalidate(('playlist', user_id, playlist.name), ('user', user_id))
 
         return playlist.name, deleted
 
@@ -274,72 +383,225 @@ class PlaylistInterface(DBInterface, DBPlaylistUtil):
             # get the target playlist
             playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name)
 
-            # find the target link
-            try:
-                target_link = Link.get(Link.playlist == playlist.id, Link.song == song_id)
-            except Link.DoesNotExist as e:
-                raise LookupError('Specified song was not found in your playlist') from e
+            # there is no chain to fix, deleting the link is enough
+            deleted = Link.delete().where(Link.playlist == playlist.id, Link.song == song_id).execute()
+            if not deleted:
+                raise LookupError('Specified song was not found in your playlist')
+            fastpath.update_song_counts(self._database, playlist.id, -deleted)
+        self._cache.invalidate(('playlist', user_id, playlist.name), ('user', user_id))
 
-            # find the previous link to break up the chain
-            try:
-                previous_link = Link.get(Link.next == target_link.id)
-                Link.update(next=target_link.next_id).where(Link.id == previous_link.id).execute()
-            except Link.DoesNotExist:
-                # the song is in the front of the queue
-                Playlist.update(head=target_link.next_id).where(Playlist.id == playlist.id).execute()
+        return playlist.name
 
-            # finally, delete the target link
-            target_link.delete_instance()
+    @in_read_executor
+    def export_songs(self, user_id, playlist_name, output, song_format):
+        # writes the playlist to the text file given, see database.transfer for the formats
+        with self._database.atomic():
+            playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name)
+            query = Song.select(Song.uuri, Song.title, Song.duration).join(Link, on=(Link.song == Song.id)) \
+                .where(Link.playlist == playlist.id).order_by(Link.position, Link.id).tuples()
+            output.writelines(transfer.dump(query.iterator(), song_format))
+
+        return playlist.name, playlist.song_count
+
+    async def import_songs(self, user_id, playlist_name, lines, song_format):
+        # appends the songs read from the lines given to the playlist, see database.transfer for the formats
+        # songs unknown to the database are created from the metadata imported, the ones imported without metadata
+        # are resolved by the extractor afterwards (and thus appended after the rest)
+        playlist_name, inserted, failed, truncated, messages, unresolved = \
+            await self._import_songs(user_id, playlist_name, lines, song_format)
+        if unresolved and not truncated:
+            playlist_name, count, rejected, truncated, insert_messages = \
+                await self.insert(user_id, playlist_name, False, unresolved)
+            inserted += count
+            failed += rejected
+            messages.extend(insert_messages)
+        return playlist_name, inserted, failed, truncated, messages
 
-        return playlist.name
+    @in_executor
+    def _import_songs(self, user_id, playlist_name, lines, song_format):
+        messages = list()
+        unresolved = list()
+        playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name, create_default=True)
+        if created:
+            self._cache.invalidate(('active', user_id), ('user', user_id))
+            messages.append('Since you haven\'t had any playlist, a *default* one was created for you. Note that songs '
+                            'will be removed from it after playing.')
+
+        inserted = failed = 0
+        truncated = False
+        entries = transfer.load(lines, song_format)
+        for chunk in iter(lambda: list(itertools.islice(entries, self._import_chunk)), []):
+            uuris = [entry[0] for entry in chunk if not isinstance(entry, Exception)]
+            known = dict()
+            for uuri_chunk in chunked(uuris, MAX_VARIABLES):
+                for song_id, uuri, title, duration in Song.select(Song.id, Song.uuri, Song.title, Song.duration) \
+                        .where(Song.uuri << uuri_chunk).tuples():
+                    known[uuri] = song_id, uuri, title, duration
+
+            resolved = list()
+            for entry in chunk:
+                if isinstance(entry, Exception):
+                    messages.append(str(entry))
+                    failed += 1
+                elif entry[0] in known:
+                    # metadata in the database take precedence
+                    resolved.append(known[entry[0]])
+                elif entry[1] is None:
+                    unresolved.append(DBSongUtil._make_url(entry[0]))
+                else:
+                    resolved.append((None,) + entry)
+
+            songs = self._store_songs(resolved)
+            count, rejected, truncated = self._link_songs(user_id, playlist.name, songs, False, messages)
+            inserted += count
+            failed += rejected
+            if truncated:
+                break
+
+        self._cache.invalidate(('playlist', user_id, playlist.name), ('user', user_id))
+        return playlist.name, inserted, failed, truncated, messages, unresolved
 
     #
     # Internally used methods
     #
-    def _append_song(self, user_id, song_id, playlist_name):
+    @in_read_executor
+    def _get_active(self, user_id):
+        try:
+            playlist = Playlist.select(Playlist).join(User, on=(User.active_playlist == Playlist.id)) \
+                .where(User.id == user_id).get()
+        except Playlist.DoesNotExist as e:
+            raise LookupError('You don\'t have an active playlist') from e
+        return playlist.name
+
+    @in_read_executor
+    def _list(self, user_id):
+        query = Playlist.select(Playlist.name, Playlist.song_count, Playlist.repeat).where(Playlist.user == user_id) \
+            .order_by(Playlist.name)
+
+        return list(query.dicts())
+
+    @in_read_executor
+    def _show(self, user_id, offset, limit, playlist_name):
         with self._database.atomic():
-            # get a playlist
-            playlist = self._get_playlist(user_id, playlist_name)
+            playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name)
 
-            # check for duplicates, if present just return
-            if Link.select().where(Link.playlist == playlist.id, Link.song == song_id).count():
-                return False
-            # check for the song count limit
-            count = Link.select().join(Playlist, on=(Link.playlist == Playlist.id)).where(Playlist.user == user_id) \
-                .count()
-            if count >= self._config_max_songs:
-                raise RuntimeError('You\'ve reached the song count limit for your playlists')
-            # insert a new link
-            link = Link.create(playlist=playlist.id, song=song_id, next=None)
-            # modify the previous link to point to the new one
-            if playlist.head_id is None:
-                Playlist.update(head=link.id).where(Playlist.id == playlist.id).execute()
-            else:
-                Link.update(next=link.id).where(Link.playlist == playlist.id,
-                                                Link.next >> None, Link.id != link.id).execute()
-            return True
+            query = Song.select(Song.id, Song.title).join(Link, on=(Link.song == Song.id)) \
+                .where(Link.playlist == playlist.id).order_by(Link.position, Link.id).limit(limit).offset(offset)
+            songs = list(query.tuples())
+
+        return songs, playlist.name, playlist.song_count
+
+    @in_executor
+    def _get_insert_playlist(self, user_id, playlist_name):
+        playlist, created = self._get_playlist_ex(user_id, playlist_name=playlist_name, create_default=True)
+        if created:
+            self._cache.invalidate(('active', user_id), ('user', user_id))
+        return playlist.name, created
 
-    def _prepend_song(self, user_id, song_id, playlist_name):
+    @in_executor
+    def _insert_resolved(self, user_id, playlist_name, prepend, song_list, resolved, messages):
         with self._database.atomic():
-            # get a playlist
+            song_list.store_cached()
+
+        # create all the missing songs at once and link the whole batch in a single transaction
+        songs = self._store_songs(resolved)
+        try:
+            result = self._link_songs(user_id, playlist_name, songs, prepend, messages)
+            self._cache.invalidate(('playlist', user_id, playlist_name), ('user', user_id))
+            return result
+        except KeyError as e:
+            # the playlist does not exist anymore
+            messages.append(str(e))
+            return 0, len(songs), True
+
+    def _store_songs(self, resolved):
+        # returns a list of (song_id, title) tuples in the input order
+        new_songs = {uuri: (title, duration) for song_id, uuri, title, duration in resolved if song_id is None}
+
+        if new_songs:
+            current_time = datetime.now()
+            rows = [{'uuri': uuri, 'title': title, 'duration': duration, 'last_played': datetime.utcfromtimestamp(0),
+                     'credit_count': self._credits.cap, 'credit_timestamp': current_time}
+                    for uuri, (title, duration) in new_songs.items()]
+            uuris = list(new_songs.keys())
+            song_ids = dict()
+            # since the songs may be about to be added multiple times, ignore the ones inserted in the meantime
+            with self._database.atomic():
+                for chunk in chunked(rows, MAX_VARIABLES // len(rows[0])):
+                    Song.insert_many(chunk).on_conflict('IGNORE').execute()
+                for chunk in chunked(uuris, MAX_VARIABLES):
+                    song_ids.update(Song.select(Song.uuri, Song.id).where(Song.uuri << chunk).tuples())
+            resolved = [(song_ids[uuri] if song_id is None else song_id, uuri, title, duration)
+                        for song_id, uuri, title, duration in resolved]
+            # new songs may qualify for the automatic playlist if there is no listener threshold
+            self._autoplaylist.invalidate(song_ids.values())
+
+        return [(song_id, title) for song_id, uuri, title, duration in resolved]
+
+    def _link_songs(self, user_id, playlist_name, songs, prepend, messages):
+        # drop repeated songs from the input, keeping the first occurrence (the later ones are reported as present)
+        input_songs = songs
+        songs = list()
+        seen = set()
+        for song_id, title in input_songs:
+            if song_id not in seen:
+                seen.add(song_id)
+                songs.append((song_id, title))
+        song_ids = [song_id for song_id, title in songs]
+
+        with self._database.atomic():
+            # get a playlist, raises KeyError if it does not exist anymore
             playlist = self._get_playlist(user_id, playlist_name)
 
-            try:
-                # if there is a duplicate, we won't insert a new link
-                duplicate = Link.get(Link.playlist == playlist.id, Link.song == song_id)
-                # we will reuse the link and push it to the front
-                if Link.update(next=duplicate.next_id).where(Link.next == duplicate.id).execute():
-                    # we are not the first link if the statement above modified something
-                    Link.update(next=playlist.head_id).where(Link.id == duplicate.id).execute()
-                    Playlist.update(head=duplicate.id).where(Playlist.id == playlist.id).execute()
-                return False
-            except Link.DoesNotExist:  # can be only raised by the previous Link.get()
-                # do the "normal insert" -- we need to check for length in this case
-                count = Link.select().join(Playlist, on=(Link.playlist == Playlist.id)) \
-                    .where(Playlist.user == user_id).count()
-                if count >= self._config_max_songs:
-                    raise RuntimeError('You\'ve reached the song count limit for your playlists')
-
-                link = Link.create(playlist=playlist.id, song=song_id, next=playlist.head_id)
-                Playlist.update(head=link.id).where(Playlist.id == playlist.id).execute()
-                return True
+            # check for duplicates and the song count limit, once for the whole batch
+            present = dict()
+            for chunk in chunked(song_ids, MAX_VARIABLES - 1):
+                present.update(Link.select(Link.song, Link.id)
+                               .where(Link.playlist == playlist.id, Link.song << chunk).tuples())
+            count = fastpath.count_user_songs(self._database, user_id)
+            remaining = max(self._config_max_songs - count, 0)
+
+            new_songs = [song_id for song_id in song_ids if song_id not in present]
+            truncated = len(new_songs) > remaining
+            rejected = 0
+            if truncated:
+                messages.append('You\'ve reached the song count limit for your playlists')
+                rejected = len(new_songs) - remaining
+                accepted = set(new_songs[:remaining])
+                songs = [song for song in songs if song[0] in present or song[0] in accepted]
+                new_songs = new_songs[:remaining]
+
+            # compose "already present message"
+            present_message = 'The song [{}] {} was already present in your playlist.'
+            if prepend:
+                present_message += ' It was moved to the front.'
+            linked = {song_id for song_id, title in songs}
+            seen = set()
+            for song_id, title in input_songs:
+                if song_id in linked and (song_id in present or song_id in seen):
+                    messages.append(present_message.format(song_id, title))
+                seen.add(song_id)
+
+            if prepend:
+                # the whole batch (including the songs already present) forms a new front of the playlist
+                position = fastpath.get_front_position(self._database, playlist.id) - len(songs) + 1
+                rows = list()
+                moves = list()
+                for song_id, title in songs:
+                    if song_id in present:
+                        moves.append((present[song_id], position))
+                    else:
+                        rows.append((playlist.id, song_id, position))
+                    position += 1
+                # links already present are moved by a single statement (per chunk)
+                for chunk in chunked(moves, MAX_VARIABLES // 3):
+                    Link.update(position=case(Link.id, chunk)) \
+                        .where(Link.id << [link_id for link_id, position in chunk]).execute()
+            else:
+                position = fastpath.get_back_position(self._database, playlist.id)
+                rows = [(playlist.id, song_id, position + offset) for offset, song_id in enumerate(new_songs)]
+
+            fastpath.insert_links(self._database, rows)
+            fastpath.update_song_counts(self._database, playlist.id, len(rows))
+
+        return len(rows), rejected, truncated
@@ -1,9 +1,14 @@
+from datetime import date, datetime, timedelta
+
 from database.common import *
 
 
 class SongInterface(DBInterface, DBSongUtil):
-    def __init__(self, loop):
+    def __init__(self, loop, config):
         DBInterface.__init__(self, loop)
+        self._credits = CreditPolicy(config)
+        # full-text index may be missing if not supported by the SQLite library
+        self._full_text = 'song_fts' in self._database.get_tables()
 
     #
     # Interface methods
@@ -12,14 +17,28 @@ class SongInterface(DBInterface, DBSongUtil):
     def blacklist(self, song_id):
         if Song.update(is_blacklisted=True).where(Song.id == song_id, ~Song.is_blacklisted).execute() != 1:
             raise ValueError('Song [{}] does not exist or is blacklisted already'.format(song_id))
+        self._autoplaylist.invalidate((song_id,))
+        self._cache.invalidate(('song', song_id))
 
     @in_executor
     def permit(self, song_id):  # intentionally kept as an instance method
         if Song.update(is_blacklisted=False).where(Song.id == song_id, Song.is_blacklisted).execute() != 1:
             raise ValueError('Song [{}] does not exist or is not blacklisted'.format(song_id))
+        self._autoplaylist.invalidate((song_id,))
+        self._cache.invalidate(('song', song_id))
 
-    @in_executor
+    @in_read_executor
     def search(self, keywords, limit):
+        if self._full_text and keywords:
+            # every keyword is used as a prefix, all of them must match, best matches first
+            expression = ' '.join('"{}"*'.format(keyword.replace('"', '""')) for keyword in keywords)
+            total = self._database.execute_sql('SELECT COUNT(*) FROM song_fts WHERE song_fts MATCH ?;',
+                                               (expression,)).fetchone()[0]
+            cursor = self._database.execute_sql('SELECT song.id, song.title FROM song_fts JOIN song '
+                                                '  ON song.id == song_fts.rowid WHERE song_fts MATCH ? '
+                                                '  ORDER BY song_fts.rank LIMIT ?;', (expression, limit))
+            return cursor.fetchall(), total
+
         query = Song.select(Song.id, Song.title)
         for keyword in keywords:
             keyword = '%{}%'.format(keyword)
@@ -30,45 +49,25 @@ class SongInterface(DBInterface, DBSongUtil):
             result.append((row.id, row.title))
         return result, total
 
-    @in_executor
-    def get_info(self, song_id):
-        try:
-            result = Song.select().where(Song.id == song_id).dicts().get()
-        except Song.DoesNotExist as e:
-            raise ValueError('Song [{}] cannot be found in the database'.format(song_id)) from e
-        # put url instead of unique uri into the result dictionary
-        result['url'] = self._make_url(result.pop('uuri'))
-        # remove duplicated_id
-        duplicate_id = result.pop('duplicate')
-        # add total counts
-        result['total_listener_count'] = result['listener_count']
-        result['total_skip_vote_count'] = result['skip_vote_count']
-        # handle duplicates
-        result['duplicates'] = None
-        result['duplicated_by'] = list()
-
-        if duplicate_id is not None:
-            song = Song.select(Song.id, Song.title, Song.listener_count, Song.skip_vote_count) \
-                .where(Song.id == duplicate_id).tuples().get()
-            result['duplicates'] = song[0:2]
-            result['total_listener_count'] += song[2]
-            result['total_skip_vote_count'] += song[3]
-
-        duplicate_query = Song.select(Song.id, Song.title, Song.listener_count, Song.skip_vote_count) \
-            .where(Song.duplicate == song_id).tuples()
-        for song in duplicate_query:
-            result['duplicated_by'].append(song[0:2])
-            result['total_listener_count'] += song[2]
-            result['total_skip_vote_count'] += song[3]
-
+    async def get_info(self, song_id):
+        # information is cached without the credits renewed in the meantime, these are computed on every call
+        result = dict(await self._cache.get(('song_info', song_id), self._get_info, song_id, groups=self._info_groups))
+        result['credit_count'] = self._credits.available(result['credit_count'], result.pop('credit_timestamp'),
+                                                         datetime.now())
         return result
 
     @in_executor
     def merge(self, source_id, target_id):
         if source_id == target_id:
             # this is effectively a "split" call
-            if Song.update(duplicate=None).where(Song.id == source_id).execute() != 1:
-                raise ValueError('Song [{}] cannot be found in the database'.format(source_id))
+            with self._database.atomic():
+                # former root loses the counts of the song, so it has to be checked for the automatic playlist too
+                affected = [source_id] + [root_id for root_id, in Song.select(Song.duplicate)
+                                          .where(Song.id == source_id, Song.duplicate.is_null(False)).tuples()]
+                if Song.update(duplicate=None).where(Song.id == source_id).execute() != 1:
+                    raise ValueError('Song [{}] cannot be found in the database'.format(source_id))
+            self._autoplaylist.invalidate(affected)
+            self._cache.invalidate(('songs',))
         else:
             with self._database.atomic():
                 try:
@@ -78,21 +77,28 @@ class SongInterface(DBInterface, DBSongUtil):
 
                 if target_song.duplicate_id == source_id:
                     # we're "reassigning" the duplicate flags
-                    target_song.duplicate_id = None
-                    target_song.save()
+                    Song.update(duplicate=None).where(Song.id == target_id).execute()
                 elif target_song.duplicate_id is not None:
                     # if a target is duplicate, we will update to duplicate_id instead
                     target_id = target_song.duplicate_id
+                # remember the songs affected for the automatic playlist, former root included
+                affected = list()
+                for song_id, canonical_id in Song.select(Song.id, Song.canonical).where(
+                        (Song.id == source_id) | (Song.duplicate == source_id)).tuples():
+                    affected += [song_id, canonical_id]
                 if Song.update(duplicate=target_id).where(
                                 (Song.id == source_id) | (Song.duplicate == source_id)).execute() == 0:
                     raise ValueError('Song [{}] cannot be found in the database'.format(source_id))
+            self._autoplaylist.invalidate(affected + [target_song.id])
+            self._cache.invalidate(*[('song', song_id) for song_id in affected + [target_id, target_song.id]])
 
     @in_executor
     def rename(self, song_id, new_title):
         if Song.update(title=new_title).where(Song.id == song_id).execute() != 1:
             raise ValueError('Song [{}] cannot be found in the database'.format(song_id))
+        self._cache.invalidate(('song', song_id))
 
-    @in_executor
+    @in_read_executor
     def list_failed(self, limit):
         query = Song.select(Song.id, Song.title).where(Song.has_failed, Song.duplicate >> None)
         total = query.count()
@@ -108,6 +114,71 @@ class SongInterface(DBInterface, DBSongUtil):
             # apply only to a song specified
             if query.where(Song.id == song_id).execute() != 1:
                 raise ValueError('Song [{}] cannot be found in the database'.format(song_id))
+            self._autoplaylist.invalidate((song_id,))
+            self._cache.invalidate(('song', song_id))
         else:
-            # clear the flag for all the songs
+            # clear the flag for all the songs, the automatic playlist pool has to be rebuilt
             query.where(Song.duplicate >> None).execute()
+            self._autoplaylist.invalidate()
+            self._cache.invalidate(('songs',))
+
+    @in_read_executor
+    def history(self, limit):
+        # most recent plays first, returns (song_id, title, started, duration, listener_count, end_reason) tuples
+        return list(PlayHistory.select(PlayHistory.song_id, Song.title, PlayHistory.started, PlayHistory.duration,
+                                       PlayHistory.listener_count, PlayHistory.end_reason)
+                    .join(Song, on=(PlayHistory.song_id == Song.id))
+                    .order_by(PlayHistory.started.desc(), PlayHistory.id.desc()).limit(limit).tuples())
+
+    @in_read_executor
+    def top(self, days, limit):
+        # most played songs over the given number of days (today included), from the daily statistics
+        # returns (song_id, title, play_count, skip_count) tuples
+        play_count = peewee.fn.SUM(DailyPlayStats.play_count)
+        return list(DailyPlayStats.select(DailyPlayStats.song_id, Song.title, play_count,
+                                          peewee.fn.SUM(DailyPlayStats.skip_count))
+                    .join(Song, on=(DailyPlayStats.song_id == Song.id))
+                    .where(DailyPlayStats.day > date.today() - timedelta(days=days))
+                    .group_by(DailyPlayStats.song_id).order_by(play_count.desc(), DailyPlayStats.song_id)
+                    .limit(limit).tuples())
+
+    #
+    # Internally used methods
+    #
+    @in_read_executor
+    def _get_info(self, song_id):
+        canonical = Song.alias()
+        try:
+            result = Song.select(Song, canonical.title.alias('canonical_title'),
+                                 canonical.total_listener_count.alias('group_listener_count'),
+                                 canonical.total_skip_vote_count.alias('group_skip_vote_count')) \
+                .join(canonical, on=(Song.canonical == canonical.id)).where(Song.id == song_id).dicts().get()
+        except Song.DoesNotExist as e:
+            raise ValueError('Song [{}] cannot be found in the database'.format(song_id)) from e
+        # put url instead of unique uri into the result dictionary
+        result['url'] = self._make_url(result.pop('uuri'))
+        # total counts are aggregated on the canonical song
+        result.pop('duplicate')
+        canonical_id = result.pop('canonical')
+        canonical_title = result.pop('canonical_title')
+        result['total_listener_count'] = result.pop('group_listener_count')
+        result['total_skip_vote_count'] = result.pop('group_skip_vote_count')
+        # handle duplicates
+        result['duplicates'] = None
+        result['duplicated_by'] = list()
+
+        if canonical_id != song_id:
+            result['duplicates'] = canonical_id, canonical_title
+        else:
+            result['duplicated_by'] = list(Song.select(Song.id, Song.title)
+                                           .where(Song.canonical == song_id, Song.id != song_id).tuples())
+
+        return result
+
+    @staticmethod
+    def _info_groups(result):
+        # information includes the titles and counts of the related songs
+        song_ids = [result['id']] + [song_id for song_id, title in result['duplicated_by']]
+        if result['duplicates'] is not None:
+            song_ids.append(result['duplicates'][0])
+        return [('song', song_id) for song_id in song_ids] + [('songs',)]
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+#
+# Portable playlist formats, used by PlaylistInterface.export_songs and PlaylistInterface.import_songs
+#
+# Playlists are written either as JSON Lines (one {"uuri", "title", "duration"} object per song) or as an extended M3U
+# (#EXTINF line with the duration and title, followed by the song URL). Both are processed line by line by generators,
+# so the whole playlist is never held in memory. Songs are imported using the stored metadata, songs without it (or
+# with an unknown duration of -1) are resolved by the extractor.
+#
+# Can be also used from the command line over the database file, run from the repository root:
+#   python3 -m database.transfer export <user_id> <playlist_name> [file]
+#   python3 -m database.transfer import <user_id> <playlist_name> [file]
+# Standard output / input is used if the file is not given. Format is chosen by the file extension (.m3u, .m3u8) or
+# given explicitly with --format.
+#
+import argparse
+import asyncio
+import configparser
+import json
+import sys
+
+from database.common import *
+
+FORMATS = ('jsonl', 'm3u')
+
+
+def format_from_name(filename):
+    return 'm3u' if filename.lower().endswith(('.m3u', '.m3u8')) else 'jsonl'
+
+
+def dump(songs, song_format):
+    # songs are (uuri, title, duration) tuples, generates lines of the output
+    if song_format == 'm3u':
+        yield '#EXTM3U\n'
+        for uuri, title, duration in songs:
+            yield '#EXTINF:{},{}\n'.format(duration, ' '.join(title.splitlines()))
+            yield DBSongUtil._make_url(uuri) + '\n'
+    else:
+        for uuri, title, duration in songs:
+            yield json.dumps({'uuri': uuri, 'title': title, 'duration': duration}, ensure_ascii=False) + '\n'
+
+
+def load(lines, song_format):
+    # generates (uuri, title, duration) tuples, title and duration are None if not present in the input
+    # malformed entries are reported as ValueError instances instead, so the rest of the input can be processed
+    if song_format == 'm3u':
+        yield from _load_m3u(lines)
+    else:
+        yield from _load_jsonl(lines)
+
+
+def _load_jsonl(lines):
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+            yield _make_entry(entry['uuri'], entry.get('title'), entry.get('duration'))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            yield ValueError('Line {} is not a valid song entry: {}'.format(number, str(e)))
+
+
+def _load_m3u(lines):
+    title = duration = None
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if line.startswith('#EXTINF:'):
+            duration, _, title = line[8:].partition(',')
+            # non-positive duration (usually -1) stands for an unknown one
+            if duration.strip().lstrip('-').isdigit() and int(duration) <= 0:
+                title = duration = None
+            continue
+        if not line or line.startswith('#'):
+            continue
+        try:
+            uuri = DBSongUtil._make_uuri(line)
+            if uuri is None:
+                raise ValueError('unsupported URL')
+            yield _make_entry(uuri, title or None, int(duration) if duration else None)
+        except ValueError as e:
+            yield ValueError('Line {} is not a valid song entry: {}'.format(number, str(e)))
+        title = duration = None
+
+
+def _make_entry(uuri, title, duration):
+    # unique URI must survive the conversion to the URL and back, metadata are either complete or missing
+    try:
+        valid = DBSongUtil._make_uuri(DBSongUtil._make_url(uuri)) == uuri
+    except (KeyError, IndexError, AttributeError):
+        valid = False
+    if not valid:
+        raise ValueError('invalid unique URI {}'.format(uuri))
+    if title is None or duration is None:
+        return uuri, None, None
+    if not isinstance(title, str) or not title or not isinstance(duration, int) or duration <= 0:
+        raise ValueError('invalid title or duration')
+    return uuri, title, duration
+
+
+#
+# Command line interface
+#
+async def _run(interface, arguments, song_format, file):
+    if arguments.operation == 'export':
+        playlist_name, count = await interface.export_songs(arguments.user_id, arguments.playlist_name, file,
+                                                            song_format)
+        print('{} song(s) exported from {}'.format(count, playlist_name), file=sys.stderr)
+    else:
+        if not await interface.exists(arguments.user_id, arguments.playlist_name):
+            await interface.create(arguments.user_id, arguments.playlist_name)
+        playlist_name, inserted, failed, truncated, messages = await interface.import_songs(
+            arguments.user_id, arguments.playlist_name, file, song_format)
+        for message in messages:
+            print(message, file=sys.stderr)
+        print('{} song(s) imported to {}, {} failed{}'.format(inserted, playlist_name, failed,
+                                                              ', song count limit reached' if truncated else ''),
+              file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports and imports DdmBot playlists')
+    parser.add_argument('-c', '--config-file', default='config.ini')
+    parser.add_argument('-f', '--format', choices=FORMATS, help='defaults to the one given by the file extension')
+    parser.add_argument('operation', choices=('export', 'import'))
+    parser.add_argument('user_id', type=int)
+    parser.add_argument('playlist_name')
+    parser.add_argument('file', nargs='?', default='-')
+    arguments = parser.parse_args()
+
+    config = configparser.ConfigParser(default_section='ddmbot')
+    if not config.read(arguments.config_file):
+        parser.error('Failed to read the configuration file {}'.format(arguments.config_file))
+    song_format = arguments.format or format_from_name(arguments.file)
+    if arguments.file == '-':
+        file = sys.stdout if arguments.operation == 'export' else sys.stdin
+    elif arguments.operation == 'export':
+        file = open(arguments.file, 'w', encoding='utf-8')
+    else:
+        file = open(arguments.file, encoding='utf-8', errors='replace')
+
+    # imported here, the interface is using this module
+    import database.playlist
+
+    initialize(config['ddmbot']['db_file'])
+    loop = asyncio.get_event_loop()
+    try:
+        interface = database.playlist.PlaylistInterface(loop, config['ddmbot'])
+        loop.run_until_complete(_run(interface, arguments, song_format, file))
+    finally:
+        close()
+        loop.close()
+        if file not in (sys.stdin, sys.stdout):
+            file.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,7 @@ import discord
 import discord.ext.commands as dec
 
 import commandhandler
+import database.backup
 import database.bot
 import database.common
 import helpformatter
@@ -91,6 +92,7 @@ class DdmBot:
 
         # future runtime objects -- initialized to None
         self._database = None
+        self._backup = None
         self._player = None
         self._server = None
         self._stream = None
@@ -115,7 +117,8 @@ class DdmBot:
     #
     def run(self):
         try:
-            self._database = database.bot.BotInterface(self._loop, self._config['ddmbot'])
+            self._database = database.bot.BotInterface(self._loop)
+            self._backup = database.backup.BackupInterface(self._loop, self._config['ddmbot'])
             self._stream = streamserver.StreamServer(self)
             self._player = player.Player(self)
             self._users = usermanager.UserManager(self)
@@ -129,8 +132,9 @@ class DdmBot:
             self._loop.run_until_complete(self._stream.init())
             self._loop.run_until_complete(self._client.login(self._config['discord']['token']))
 
-            self._bot_task = asyncio.gather(self._database.task_credit_renew(), self._users.task_check_timeouts(),
-                                            self._player.task_player_fsm(), self._client.connect(), loop=self._loop)
+            self._bot_task = asyncio.gather(self._users.task_check_timeouts(), self._users.task_notify_player(),
+                                            self._player.task_player_fsm(), self._backup.task_backup(),
+                                            self._client.connect(), loop=self._loop)
 
             try:
                 self._loop.run_until_complete(self._bot_task)
@@ -285,6 +289,10 @@ class DdmBot:
     def loop(self):
         return self._loop
 
+    @property
+    def backup(self):
+        return self._backup
+
     @property
     def client(self):
         return self._client
@@ -409,7 +417,12 @@ if __name__ == '__main__':
             # create a ddmbot instance
             ddmbot = DdmBot(arguments.config_file)
             # without a database there is no point in proceeding
-            database.common.initialize(ddmbot.config['ddmbot']['db_file'])
+            database.common.initialize(ddmbot.config['ddmbot']['db_file'],
+                                       read_workers=int(ddmbot.config['ddmbot']['db_read_workers']),
+                                       resolver_workers=int(ddmbot.config['ddmbot']['resolver_workers']),
+                                       cache_size=int(ddmbot.config['ddmbot']['read_cache_size']),
+                                       pragmas={name: ddmbot.config['ddmbot']['db_' + name]
+                                                for name in ('synchronous', 'cache_size', 'mmap_size', 'temp_store')})
 
             try:
                 ddmbot.run()
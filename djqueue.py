@@ -0,0 +1,143 @@
+import random
+
+
+class _Node:
+    __slots__ = ['discord_id', 'priority', 'size', 'left', 'right', 'parent']
+
+    def __init__(self, discord_id):
+        self.discord_id = discord_id
+        self.priority = random.random()
+        self.size = 1
+        self.left = None
+        self.right = None
+        self.parent = None
+
+
+# Ordered queue of the DJs
+#
+# Implemented as an implicit treap (randomized balanced tree ordered by the position) with a discord_id -> node index,
+# so the membership test is O(1) while removal, insertion at any position, position lookup and rotation are all
+# O(log n). Parent links are used to find the position of a node. Snapshot of the order is kept until the queue is
+# modified, so repeated reads for the status message do not copy the queue. Methods follow collections.deque, which
+# was used for the queue before, including the ValueError raised by remove() for a missing entry.
+class DjQueue:
+    def __init__(self):
+        self._root = None
+        self._nodes = dict()  # maps discord_id (int) -> _Node
+        self._snapshot = ()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, discord_id):
+        return discord_id in self._nodes
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def snapshot(self):
+        # returns an immutable tuple of the discord_ids in the queue order, shared until the queue is modified
+        if self._snapshot is None:
+            result = list()
+            self._collect(self._root, result)
+            self._snapshot = tuple(result)
+        return self._snapshot
+
+    def index(self, discord_id):
+        try:
+            node = self._nodes[discord_id]
+        except KeyError as e:
+            raise ValueError('{} is not in the queue'.format(discord_id)) from e
+        position = self._size(node.left)
+        while node.parent is not None:
+            if node is node.parent.right:
+                position += self._size(node.parent.left) + 1
+            node = node.parent
+        return position
+
+    def append(self, discord_id):
+        self.insert(len(self._nodes), discord_id)
+
+    def insert(self, position, discord_id):
+        # position is clamped to the queue boundaries
+        if discord_id in self._nodes:
+            raise ValueError('{} is in the queue already'.format(discord_id))
+        position = min(max(position, 0), len(self._nodes))
+        node = _Node(discord_id)
+        self._nodes[discord_id] = node
+        left, right = self._split(self._root, position)
+        self._set_root(self._merge(self._merge(left, node), right))
+
+    def remove(self, discord_id):
+        position = self.index(discord_id)
+        del self._nodes[discord_id]
+        left, right = self._split(self._root, position)
+        _, right = self._split(right, 1)
+        self._set_root(self._merge(left, right))
+
+    def rotate(self):
+        # moves the first DJ to the end of the queue and returns it
+        if self._root is None:
+            raise IndexError('rotate from an empty queue')
+        first, rest = self._split(self._root, 1)
+        self._set_root(self._merge(rest, first))
+        return first.discord_id
+
+    def clear(self):
+        self._nodes.clear()
+        self._set_root(None)
+
+    #
+    # Internally used methods
+    #
+    def _set_root(self, root):
+        if root is not None:
+            root.parent = None
+        self._root = root
+        self._snapshot = None
+
+    @staticmethod
+    def _size(node):
+        return node.size if node is not None else 0
+
+    @classmethod
+    def _update(cls, node):
+        node.size = cls._size(node.left) + cls._size(node.right) + 1
+        if node.left is not None:
+            node.left.parent = node
+        if node.right is not None:
+            node.right.parent = node
+
+    @classmethod
+    def _split(cls, node, count):
+        # splits the tree into the first count nodes and the rest, parent links of the returned roots are not reset
+        if node is None:
+            return None, None
+        if cls._size(node.left) >= count:
+            left, node.left = cls._split(node.left, count)
+            cls._update(node)
+            return left, node
+        node.right, right = cls._split(node.right, count - cls._size(node.left) - 1)
+        cls._update(node)
+        return node, right
+
+    @classmethod
+    def _merge(cls, left, right):
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = cls._merge(left.right, right)
+            cls._update(left)
+            return left
+        right.left = cls._merge(left, right.left)
+        cls._update(right)
+        return right
+
+    @classmethod
+    def _collect(cls, node, result):
+        while node is not None:
+            cls._collect(node.left, result)
+            result.append(node.discord_id)
+            node = node.right
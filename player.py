@@ -3,7 +3,6 @@ import asyncio
 import enum
 import errno
 import fcntl
-import functools
 import logging
 import os
 import shlex
@@ -16,7 +15,8 @@ from math import ceil
 import discord.utils
 import youtube_dl
 
-from database.player import UnavailableSongError, PlayerInterface
+from database.maintenance import MaintenanceInterface
+from database.player import UnavailableSongError, PlayEndReason, PlayerInterface
 
 # set up the logger
 log = logging.getLogger('ddmbot.player')
@@ -58,6 +58,8 @@ class PcmProcessor(threading.Thread):
 
         self._next = next_callback
         self._end = threading.Event()
+        # voice output gate, set from the event loop by the UserManager -- atomicity provided by GIL
+        self._voice_output = False
 
     @property
     def volume(self):
@@ -67,6 +69,14 @@ class PcmProcessor(threading.Thread):
     def volume(self, value):
         self._volume = min(max(value, 0.0), 2.0)
 
+    @property
+    def voice_output(self):
+        return self._voice_output
+
+    @voice_output.setter
+    def voice_output(self, value):
+        self._voice_output = bool(value)
+
     def stop(self):
         self._end.set()
         self.join()
@@ -149,12 +159,14 @@ class PcmProcessor(threading.Thread):
                 output_congestion = False
 
             # and last but not least, discord output, this time, we can (should) omit partial frames or zero data
-            voice_client = self._bot.voice
-            if voice_client.is_connected() and data_len == self._frame_len:
-                # adjust the volume
-                data = audioop.mul(data, 2, self._volume)
-                # call the callback
-                voice_client.play_audio(data)
+            # the gate is checked every frame, so the first voice listener gets the very next frame
+            if self._voice_output and data_len == self._frame_len:
+                voice_client = self._bot.voice
+                if voice_client.is_connected():
+                    # adjust the volume
+                    data = audioop.mul(data, 2, self._volume)
+                    # call the callback
+                    voice_client.play_audio(data)
 
             # calculate next transmission time
             next_time = start_time + self._frame_period * loops
@@ -190,9 +202,6 @@ class Player:
         self._switch_state = asyncio.Event(loop=bot.loop)
         self._auto_transition_task = None
 
-        self._ytdl = youtube_dl.YoutubeDL({'extract_flat': 'in_playlist', 'format': 'bestaudio/best', 'quiet': True,
-                                           'no_color': True})
-
         # state variables
         self._status_protection_count = 0
         self._apply_cooldown = True
@@ -201,6 +210,8 @@ class Player:
         self._stream_title = None
         self._status_message = None
         self._ffmpeg = None
+        self._stats_task = None
+        self._maintenance_task = None
 
         # create PCM thread
         self._pcm_thread = PcmProcessor(self._bot, self._playback_ended_callback)
@@ -210,12 +221,17 @@ class Player:
 
         # database interface
         self._database = PlayerInterface(bot.loop, bot.config['ddmbot'])
+        self._maintenance = MaintenanceInterface(bot.loop, bot.config['ddmbot'])
 
     #
     # Resource management wrappers
     #
     async def init(self):
         self._pcm_thread.start()
+        self._stats_task = self._bot.loop.create_task(self._database.task_flush_stats())
+        # database maintenance is only done while there is nothing being played
+        self._maintenance_task = self._bot.loop.create_task(
+            self._maintenance.task_maintenance(lambda: self.stopped or self.waiting))
         await self._transition_lock.acquire()
 
     async def cleanup(self):
@@ -226,6 +242,18 @@ class Player:
         if self._pcm_thread is not None:
             self._pcm_thread.stop()
 
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._maintenance_task
+
+        # apply the play statistics accumulated so far
+        if self._stats_task is not None:
+            self._stats_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._stats_task
+        await self._database.flush_stats()
+
     #
     # Properties reflecting the player's state
     #
@@ -298,6 +326,7 @@ class Player:
             # handle skip by the DJ
             if self._song_context.dj_id == user_id:
                 await self._bot.message('Song skipped by the DJ')
+                self._song_context.end(PlayEndReason.SKIPPED_BY_DJ)
                 self._switch_state.set()
                 return
 
@@ -311,6 +340,7 @@ class Player:
 
             if listeners and skip_voters >= self._config_skip_ratio * listeners:
                 await self._bot.message('Community voted to skip')
+                self._song_context.end(PlayEndReason.SKIPPED_BY_VOTE)
                 self._switch_state.set()
 
     async def force_skip(self):
@@ -319,6 +349,7 @@ class Player:
         async with self._transition_lock:
             if not self.playing:
                 raise RuntimeError('Skip can be performed only when playing a song in the DJ mode')
+            self._song_context.end(PlayEndReason.SKIPPED_BY_OPERATOR)
             self._switch_state.set()
 
     async def skip_unvote(self, user_id):
@@ -341,6 +372,14 @@ class Player:
     def volume(self, value):
         self._pcm_thread.volume = value
 
+    @property
+    def voice_output(self):
+        return self._pcm_thread.voice_output
+
+    @voice_output.setter
+    def voice_output(self, value):
+        self._pcm_thread.voice_output = value
+
     #
     # Status message reprint API
     #
@@ -490,9 +529,8 @@ class Player:
         return None
 
     async def _get_stream_info(self):
-        func = functools.partial(self._ytdl.extract_info, self._stream_url, download=False)
         try:
-            info = await self._bot.loop.run_in_executor(None, func)
+            info = await self._database.extract_stream(self._stream_url)
         except youtube_dl.DownloadError as e:
             await self._bot.message('Failed to obtain stream information: {}'.format(str(e)))
             return False
@@ -628,6 +666,7 @@ class Player:
                 nothing_to_play = False
                 self._song_context.update_listeners(listeners)
                 self._spawn_ffmpeg()
+                self._song_context.start()
 
             # update status message and ICY meta information
             if not (self.cooldown and nothing_to_play):
@@ -653,6 +692,7 @@ class Player:
             # update song stats
             if self.playing:
                 # we need to actually wait for this to ensure proper functionality of overplaying protection
+                # (only last played and credits are written right away, the counts are written behind)
                 await self._database.update_stats(self._song_context)
                 self._song_context = None
 
@@ -687,6 +727,8 @@ class Player:
         if self._transition_lock.locked():
             # assuming the FSM is doing a transition already
             return
+        if self.playing:
+            self._song_context.end(PlayEndReason.FINISHED)
         if self.playing or self.streaming:
             self._switch_state.set()
         if self.streaming and self._config_stream_end_transition:
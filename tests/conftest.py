@@ -0,0 +1,81 @@
+import asyncio
+import configparser
+import os
+import sqlite3
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# schema of the databases created before the versioned migrations were introduced (playlists as linked lists)
+BASELINE_SCHEMA = [
+    'CREATE TABLE "credittimestamp" ("id" INTEGER NOT NULL PRIMARY KEY, "last" DATETIME NOT NULL);',
+    'CREATE TABLE "user" ("id" BIGINT NOT NULL PRIMARY KEY, "active_playlist_id" INTEGER, '
+    '"play_count" INTEGER NOT NULL, "listen_count" INTEGER NOT NULL, "is_ignored" INTEGER NOT NULL, '
+    'FOREIGN KEY ("active_playlist_id") REFERENCES "playlist" ("id"));',
+    'CREATE INDEX "user_active_playlist_id" ON "user" ("active_playlist_id");',
+    'CREATE TABLE "playlist" ("id" INTEGER NOT NULL PRIMARY KEY, "user_id" BIGINT NOT NULL, '
+    '"name" VARCHAR(255) NOT NULL, "head_id" INTEGER, "repeat" INTEGER NOT NULL, UNIQUE(user_id, name));',
+    'CREATE INDEX "playlist_user_id" ON "playlist" ("user_id");',
+    'CREATE INDEX "playlist_head_id" ON "playlist" ("head_id");',
+    'CREATE TABLE "song" ("id" INTEGER NOT NULL PRIMARY KEY, "uuri" VARCHAR(255) NOT NULL, '
+    '"title" VARCHAR(255) NOT NULL, "duration" INTEGER NOT NULL, "is_blacklisted" INTEGER NOT NULL, '
+    '"last_played" DATETIME NOT NULL, "credit_count" INTEGER NOT NULL, "listener_count" INTEGER NOT NULL, '
+    '"skip_vote_count" INTEGER NOT NULL, "has_failed" INTEGER NOT NULL, "duplicate_id" INTEGER, '
+    'FOREIGN KEY ("duplicate_id") REFERENCES "song" ("id"));',
+    'CREATE UNIQUE INDEX "song_uuri" ON "song" ("uuri");',
+    'CREATE INDEX "song_duplicate_id" ON "song" ("duplicate_id");',
+    'CREATE TABLE "link" ("id" INTEGER NOT NULL PRIMARY KEY, "playlist_id" INTEGER NOT NULL, '
+    '"song_id" INTEGER NOT NULL, "next_id" INTEGER, FOREIGN KEY ("playlist_id") REFERENCES "playlist" ("id"), '
+    'FOREIGN KEY ("song_id") REFERENCES "song" ("id"), FOREIGN KEY ("next_id") REFERENCES "link" ("id"));',
+    'CREATE INDEX "link_playlist_id" ON "link" ("playlist_id");',
+    'CREATE INDEX "link_song_id" ON "link" ("song_id");',
+    'CREATE INDEX "link_next_id" ON "link" ("next_id");',
+]
+
+
+@pytest.fixture
+def config():
+    parser = configparser.ConfigParser(default_section='ddmbot')
+    parser.read(os.path.join(ROOT, 'config.ini'))
+    return parser['ddmbot']
+
+
+@pytest.fixture
+def loop():
+    # also set as the current one, so the asyncio helpers do not need the loop argument
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+@pytest.fixture
+def database_file(tmp_path):
+    return str(tmp_path / 'db.sqlite')
+
+
+@pytest.fixture
+def baseline_database(database_file):
+    # returns a function populating a baseline database with the given statements, the file is not opened by the bot
+    def create(*statements):
+        connection = sqlite3.connect(database_file)
+        try:
+            for statement in BASELINE_SCHEMA + list(statements):
+                connection.execute(statement)
+            connection.commit()
+        finally:
+            connection.close()
+        return database_file
+
+    return create
+
+
+@pytest.fixture
+def database(database_file):
+    # opened database with all the migrations applied, closed after the test
+    common = pytest.importorskip('database.common')
+    common.initialize(database_file, read_workers=2, resolver_workers=2)
+    yield common._database
+    common.close()
@@ -0,0 +1,83 @@
+import gzip
+import os
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+common = pytest.importorskip('database.common')
+backup = pytest.importorskip('database.backup')
+
+
+@pytest.fixture
+def interface(database, loop, config, tmp_path):
+    config['backup_directory'] = str(tmp_path / 'backups')
+    config['backup_keep'] = '2'
+    config['backup_batch_rows'] = '3'
+    config['backup_batch_pause'] = '0'
+    current_time = datetime.now()
+    common.Song.insert_many([{'uuri': 'yt:song{:07d}'.format(song_id), 'title': 'Song {}'.format(song_id),
+                              'duration': 200, 'last_played': current_time, 'credit_count': 1,
+                              'credit_timestamp': current_time} for song_id in range(1, 11)]).execute()
+    return backup.BackupInterface(loop, config)
+
+
+def restore(path, tmp_path):
+    # returns a connection to the decompressed snapshot
+    filename = str(tmp_path / 'restored.sqlite')
+    with gzip.open(path, 'rb') as source, open(filename, 'wb') as destination:
+        destination.write(source.read())
+    return sqlite3.connect(filename)
+
+
+@pytest.mark.parametrize('dump', [False, True])
+def test_snapshot(interface, loop, tmp_path, monkeypatch, dump):
+    if dump:
+        # SQLite library without VACUUM INTO
+        monkeypatch.setattr(backup.sqlite3, 'sqlite_version_info', (3, 26, 0))
+    elif sqlite3.sqlite_version_info < (3, 27, 0):
+        pytest.skip('SQLite library does not support VACUUM INTO')
+
+    path = loop.run_until_complete(interface.backup())
+    assert os.listdir(os.path.dirname(path)) == [os.path.basename(path)]
+    connection = restore(path, tmp_path)
+    try:
+        assert connection.execute('PRAGMA integrity_check;').fetchone()[0] == 'ok'
+        assert connection.execute('SELECT COUNT(*) FROM song;').fetchone()[0] == 10
+        versions = connection.execute('SELECT version FROM schemaversion ORDER BY version;').fetchall()
+        assert [version for version, in versions] == sorted(version for version, function in common._migrations)
+        # the full-text index is copied as well
+        if interface._database.execute_sql('SELECT name FROM sqlite_master WHERE name == \'song_fts\';').fetchone():
+            connection.execute('INSERT INTO song_fts (song_fts) VALUES (\'integrity-check\');')
+            assert connection.execute('SELECT rowid FROM song_fts WHERE song_fts MATCH \'"song" *\';').fetchall()
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize('dump', [False, True])
+def test_aborted_snapshot_is_removed(interface, loop, monkeypatch, dump):
+    if dump:
+        monkeypatch.setattr(backup.sqlite3, 'sqlite_version_info', (3, 26, 0))
+    elif sqlite3.sqlite_version_info < (3, 27, 0):
+        pytest.skip('SQLite library does not support VACUUM INTO')
+    interface._vacuum_steps = 1
+    # the abort is requested before the copy starts
+    interface._abort.set()
+    monkeypatch.setattr(interface._abort, 'clear', lambda: None)
+    with pytest.raises(RuntimeError):
+        loop.run_until_complete(interface.backup())
+    assert os.listdir(interface._config_directory) == []
+
+
+def test_rotation_keeps_the_newest(interface):
+    directory = interface._config_directory
+    os.makedirs(directory)
+    names = ['db-20240101-000000.sqlite.gz', 'db-20240301-000000.sqlite.gz', 'db-20240201-000000.sqlite.gz',
+             'other-20230101-000000.sqlite.gz', 'db-20230101-000000.txt']
+    for name in names:
+        open(os.path.join(directory, name), 'wb').close()
+
+    interface._rotate('db-')
+    # snapshots of other databases and unrelated files are left alone
+    assert sorted(os.listdir(directory)) == ['db-20230101-000000.txt', 'db-20240201-000000.sqlite.gz',
+                                             'db-20240301-000000.sqlite.gz', 'other-20230101-000000.sqlite.gz']
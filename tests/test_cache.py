@@ -0,0 +1,122 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from database.cache import ReadCache
+
+
+class Loader:
+    # counts the loads, values are the key with the load number
+    def __init__(self):
+        self.calls = 0
+
+    async def __call__(self, key):
+        self.calls += 1
+        return key, self.calls
+
+
+def get(cache, loop, loader, key, groups=()):
+    return loop.run_until_complete(cache.get(key, loader, key, groups=groups))
+
+
+def test_values_are_cached(loop):
+    cache, loader = ReadCache(4), Loader()
+    assert get(cache, loop, loader, 'a') == ('a', 1)
+    assert get(cache, loop, loader, 'a') == ('a', 1)
+    assert get(cache, loop, loader, 'b') == ('b', 2)
+    stats = cache.get_stats()
+    assert (stats['size'], stats['hits'], stats['misses']) == (2, 1, 2)
+
+
+def test_size_zero_disables_the_cache(loop):
+    cache, loader = ReadCache(), Loader()
+    assert get(cache, loop, loader, 'a') == ('a', 1)
+    assert get(cache, loop, loader, 'a') == ('a', 2)
+    assert cache.get_stats()['size'] == 0
+
+
+def test_group_invalidation(loop):
+    cache, loader = ReadCache(8), Loader()
+    get(cache, loop, loader, 'a', groups=['x'])
+    get(cache, loop, loader, 'b', groups=['x', 'y'])
+    get(cache, loop, loader, 'c', groups=['y'])
+    get(cache, loop, loader, 'd')
+
+    cache.invalidate('x')
+    assert get(cache, loop, loader, 'a') == ('a', 5)
+    assert get(cache, loop, loader, 'b') == ('b', 6)
+    assert get(cache, loop, loader, 'c') == ('c', 3)
+    assert get(cache, loop, loader, 'd') == ('d', 4)
+
+    # the values reloaded are stored without groups, only c is left in the group y
+    cache.invalidate('y')
+    assert get(cache, loop, loader, 'b') == ('b', 6)
+    assert get(cache, loop, loader, 'c') == ('c', 7)
+
+    cache.clear()
+    assert get(cache, loop, loader, 'd') == ('d', 8)
+
+
+def test_groups_computed_from_the_value(loop):
+    cache, loader = ReadCache(8), Loader()
+    get(cache, loop, loader, 'a', groups=lambda value: [('load', value[1])])
+    cache.invalidate(('load', 2))
+    assert get(cache, loop, loader, 'a') == ('a', 1)
+    cache.invalidate(('load', 1))
+    assert get(cache, loop, loader, 'a') == ('a', 2)
+
+
+def test_least_recently_used_are_evicted(loop):
+    cache, loader = ReadCache(2), Loader()
+    get(cache, loop, loader, 'a', groups=['x'])
+    get(cache, loop, loader, 'b', groups=['x'])
+    get(cache, loop, loader, 'a')
+    get(cache, loop, loader, 'c')
+    assert cache.get_stats()['evictions'] == 1
+    assert get(cache, loop, loader, 'a') == ('a', 1)
+    assert get(cache, loop, loader, 'b') == ('b', 4)
+    # evicted keys are dropped from their groups as well
+    assert sum(len(keys) for keys in cache._groups.values()) == 1
+
+
+def test_value_loaded_during_invalidation_is_not_stored(loop):
+    cache = ReadCache(4)
+    started, finish = asyncio.Event(), asyncio.Event()
+
+    async def slow_loader(key):
+        started.set()
+        await finish.wait()
+        return 'outdated'
+
+    async def invalidate():
+        await started.wait()
+        # a writer commits while the value is being loaded
+        cache.invalidate('x')
+        finish.set()
+
+    results = loop.run_until_complete(asyncio.gather(cache.get('a', slow_loader, 'a', groups=['x']), invalidate()))
+    assert results[0] == 'outdated'
+    assert cache.get_stats()['size'] == 0
+    assert get(cache, loop, Loader(), 'a') == ('a', 1)
+
+
+def test_playlist_listing_is_invalidated_by_insert(database, loop, config):
+    common = pytest.importorskip('database.common')
+    playlist = pytest.importorskip('database.playlist')
+    common._cache.reset(64)
+    current_time = datetime.now()
+    common.User.create(id=1)
+    common.Song.insert_many([{'uuri': 'yt:song{:07d}'.format(song_id), 'title': 'Song {}'.format(song_id),
+                              'duration': 200, 'last_played': current_time, 'credit_count': 1,
+                              'credit_timestamp': current_time} for song_id in range(1, 4)]).execute()
+    interface = playlist.PlaylistInterface(loop, config)
+
+    loop.run_until_complete(interface.insert(1, None, False, ['1', '2']))
+    listing = loop.run_until_complete(interface.show(1, 0, 10, None))
+    assert listing == ([(1, 'Song 1'), (2, 'Song 2')], 'default', 2)
+    assert loop.run_until_complete(interface.show(1, 0, 10, None)) is listing
+
+    loop.run_until_complete(interface.insert(1, None, True, ['3']))
+    assert loop.run_until_complete(interface.show(1, 0, 10, None)) == \
+        ([(3, 'Song 3'), (1, 'Song 1'), (2, 'Song 2')], 'default', 3)
@@ -0,0 +1,67 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+common = pytest.importorskip('database.common')
+
+START = datetime(2017, 5, 1, 12, 0, 0)
+DAY = timedelta(hours=24)
+
+
+@pytest.fixture
+def credits():
+    return common.CreditPolicy({'op_credit_cap': '5', 'op_credit_renew': '24'})
+
+
+def test_available(credits):
+    assert credits.cap == 5
+    assert credits.available(2, START, START) == 2
+    assert credits.available(2, START, START + DAY - timedelta(seconds=1)) == 2
+    assert credits.available(2, START, START + 2 * DAY) == 4
+    assert credits.available(2, START, START + 10 * DAY) == 5
+    # clock going backwards does not take credits away
+    assert credits.available(2, START, START - 3 * DAY) == 2
+
+
+def test_consume_keeps_the_period_in_progress(credits):
+    current_time = START + 2 * DAY + timedelta(hours=5)
+    assert credits.consume(1, START, current_time) == (2, START + 2 * DAY)
+    # nothing to renew yet
+    assert credits.consume(3, START, START + timedelta(hours=1)) == (2, START)
+    assert credits.consume(0, START, START) == (0, START)
+
+
+def test_consume_at_the_cap_starts_a_new_period(credits):
+    current_time = START + 4 * DAY + timedelta(hours=5)
+    assert credits.consume(1, START, current_time) == (4, current_time)
+    assert credits.consume(5, START, START) == (4, START)
+
+
+def test_credits_are_never_lost(credits):
+    # a credit is renewed after every full period since the last renewal, whatever the play times are
+    rng = random.Random(42)
+    credit_count, credit_timestamp = 5, START
+    current_time = START
+    for _ in range(1000):
+        current_time += timedelta(minutes=rng.randint(1, 24 * 60))
+        available = credits.available(credit_count, credit_timestamp, current_time)
+        assert 0 <= available <= credits.cap
+        assert credit_timestamp <= current_time
+        if available and rng.random() < 0.7:
+            credit_count, credit_timestamp = credits.consume(credit_count, credit_timestamp, current_time)
+            assert credits.available(credit_count, credit_timestamp, current_time) == available - 1
+
+
+def test_condition_matches_available(database, credits):
+    current_time = START + 10 * DAY
+    songs = [(0, current_time), (0, current_time - DAY + timedelta(seconds=1)), (0, current_time - DAY),
+             (1, current_time), (0, START)]
+    for song_id, (credit_count, credit_timestamp) in enumerate(songs, 1):
+        common.Song.create(id=song_id, uuri='yt:song{:07d}'.format(song_id), title='Song', duration=200,
+                           last_played=START, credit_count=credit_count, credit_timestamp=credit_timestamp)
+
+    selected = {song.id for song in common.Song.select().where(credits.condition(current_time))}
+    expected = {song_id for song_id, (credit_count, credit_timestamp) in enumerate(songs, 1)
+                if credits.available(credit_count, credit_timestamp, current_time)}
+    assert selected == expected == {3, 4, 5}
@@ -0,0 +1,77 @@
+import collections
+import random
+
+import pytest
+
+from djqueue import DjQueue
+
+
+def check(queue, reference):
+    assert len(queue) == len(reference)
+    assert bool(queue) == bool(reference)
+    assert list(queue) == list(reference)
+    assert queue.snapshot() == tuple(reference)
+    for position, discord_id in enumerate(reference):
+        assert discord_id in queue
+        assert queue.index(discord_id) == reference.index(discord_id) == position
+
+
+def test_matches_deque():
+    rng = random.Random(42)
+    queue, reference = DjQueue(), collections.deque()
+    for _ in range(3000):
+        operation = rng.random()
+        discord_id = rng.randrange(64)
+        if operation < 0.4:
+            if discord_id not in reference:
+                position = rng.randrange(len(reference) + 3)
+                queue.insert(position, discord_id)
+                reference.insert(position, discord_id)
+        elif operation < 0.5:
+            if discord_id not in reference:
+                queue.append(discord_id)
+                reference.append(discord_id)
+        elif operation < 0.8:
+            if discord_id in reference:
+                queue.remove(discord_id)
+                reference.remove(discord_id)
+            else:
+                with pytest.raises(ValueError):
+                    queue.remove(discord_id)
+        elif operation < 0.995:
+            if reference:
+                reference.rotate(-1)
+                assert queue.rotate() == reference[-1]
+        else:
+            queue.clear()
+            reference.clear()
+        check(queue, reference)
+
+
+def test_errors():
+    queue = DjQueue()
+    with pytest.raises(IndexError):
+        queue.rotate()
+    with pytest.raises(ValueError):
+        queue.index(1)
+    queue.append(1)
+    with pytest.raises(ValueError):
+        queue.insert(0, 1)
+    # positions are clamped to the queue boundaries
+    queue.insert(-5, 2)
+    queue.insert(10, 3)
+    assert queue.snapshot() == (2, 1, 3)
+
+
+def test_snapshot_is_shared_until_modified():
+    queue = DjQueue()
+    for discord_id in range(5):
+        queue.append(discord_id)
+    snapshot = queue.snapshot()
+    assert queue.snapshot() is snapshot
+    assert 3 in queue and queue.index(3) == 3
+    assert queue.snapshot() is snapshot
+
+    queue.rotate()
+    assert queue.snapshot() == (1, 2, 3, 4, 0)
+    assert snapshot == (0, 1, 2, 3, 4)
@@ -0,0 +1,36 @@
+import pytest
+
+common = pytest.importorskip('database.common')
+fastpath = pytest.importorskip('database.fastpath')
+
+# hot statements and the indexes they are expected to use
+HOT_QUERIES = [
+    ('front song', fastpath._select_front_song, (1,), ['link_playlist_id_position']),
+    ('rotation', fastpath._rotate_link, (1, 1), ['link_playlist_id_position']),
+    ('front position', fastpath._select_front_position, (1,), ['link_playlist_id_position']),
+    ('back position', fastpath._select_back_position, (1,), ['link_playlist_id_position']),
+    ('user song count', fastpath._count_user_songs, (1,), []),
+    ('active playlist', fastpath._select_active_playlist, (1,), []),
+    ('duplicate link check', 'SELECT id FROM link WHERE playlist_id == ? AND song_id == ?;', (1, 1),
+     ['link_playlist_id_song_id']),
+    ('duplicate resolution', 'SELECT id FROM song WHERE duplicate_id == ?;', (1,), ['song_duplicate_id']),
+    ('user playlist count', 'SELECT COUNT(*) FROM playlist WHERE user_id == ?;', (1,), ['playlist_user_id']),
+]
+
+
+@pytest.fixture
+def migrated_database(baseline_database):
+    common.initialize(baseline_database())
+    yield common._database
+    common.close()
+
+
+@pytest.mark.parametrize('sql, parameters, indexes', [query[1:] for query in HOT_QUERIES],
+                         ids=[query[0] for query in HOT_QUERIES])
+def test_query_plan(migrated_database, sql, parameters, indexes):
+    plan = [row[-1] for row in migrated_database.execute_sql('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()]
+    # every table is searched, none of them is scanned
+    assert not [step for step in plan if step.startswith('SCAN')], plan
+    assert [step for step in plan if step.startswith('SEARCH')], plan
+    for index in indexes:
+        assert [step for step in plan if 'INDEX {} '.format(index) in step], plan
@@ -0,0 +1,68 @@
+import types
+from datetime import date, datetime, timedelta
+
+import pytest
+
+common = pytest.importorskip('database.common')
+maintenance = pytest.importorskip('database.maintenance')
+
+
+@pytest.fixture
+def interface(database, loop, config):
+    return maintenance.MaintenanceInterface(loop, config)
+
+
+def test_report(interface, loop):
+    common.User.create(id=1)
+    report = loop.run_until_complete(interface.run())
+    assert maintenance.last_report() is report
+    assert set(report) == {'wal_before', 'history_pruned', 'song_counts_fixed', 'checkpoint_time',
+                           'checkpoint_complete', 'analyze', 'statistics_time', 'vacuum_time', 'total_time',
+                           'wal_after', 'timestamp'}
+    assert report['checkpoint_complete']
+    # WAL journal is truncated by the checkpoint, only the statistics are written after it
+    assert report['wal_after'] < report['wal_before']
+    assert (report['history_pruned'], report['song_counts_fixed']) == (0, 0)
+
+
+def test_analyze_is_scheduled(interface, loop, monkeypatch):
+    # only the maintenance is given the fake clock, the loop keeps the real one
+    clock = [1000.0]
+    monkeypatch.setattr(maintenance, 'time', types.SimpleNamespace(monotonic=lambda: clock[0]))
+    # no statistics yet, so the first run analyzes right away
+    assert loop.run_until_complete(interface.run())['analyze']
+    assert interface._has_statistics()
+    assert not loop.run_until_complete(interface.run())['analyze']
+
+    clock[0] += interface._config_analyze_interval
+    assert loop.run_until_complete(interface.run())['analyze']
+    assert not loop.run_until_complete(interface.run())['analyze']
+
+
+def test_song_counts_are_fixed(interface, loop):
+    common.User.create(id=1, song_count=5)
+    assert loop.run_until_complete(interface.run())['song_counts_fixed'] == 1
+    assert common.User.get(common.User.id == 1).song_count == 0
+
+
+def test_history_is_pruned(interface, loop):
+    now = datetime.now()
+    days = interface._config_history_retention.days
+    for song_id, age in ((1, days + 1), (2, days - 1), (3, 0)):
+        common.PlayHistory.create(song_id=song_id, dj_id=None, started=now - timedelta(days=age), duration=200,
+                                  listener_count=1, skip_vote_count=0, end_reason=0)
+    common.DailyPlayStats.create(day=date.today() - timedelta(days=days + 1), song_id=1, play_count=1, skip_count=0,
+                                 listener_count=1, skip_vote_count=0, duration=200)
+
+    assert loop.run_until_complete(interface.run())['history_pruned'] == 1
+    assert sorted(song_id for song_id, in common.PlayHistory.select(common.PlayHistory.song_id).tuples()) == [2, 3]
+    # daily statistics are kept
+    assert common.DailyPlayStats.select().count() == 1
+    assert loop.run_until_complete(interface.run())['history_pruned'] == 0
+
+
+def test_invalid_pragmas_are_refused(database_file):
+    for pragmas in ({'cache size': 10}, {'synchronous': 'NORMAL; DROP TABLE song'}):
+        with pytest.raises(ValueError):
+            common.initialize(database_file, pragmas=pragmas)
+    assert common._database.is_closed()
@@ -0,0 +1,101 @@
+import sqlite3
+
+import pytest
+
+common = pytest.importorskip('database.common')
+
+# two playlists stored as linked lists (1: 3 -> 1 -> 2, 2: 4), link 5 is unreachable, song 2 duplicates song 1
+BASELINE_DATA = [
+    'INSERT INTO credittimestamp (id, last) VALUES (1, \'2017-05-01 12:00:00\');',
+    'INSERT INTO "user" (id, active_playlist_id, play_count, listen_count, is_ignored) VALUES (10, 1, 0, 0, 0);',
+    'INSERT INTO "user" (id, active_playlist_id, play_count, listen_count, is_ignored) VALUES (11, NULL, 0, 0, 0);',
+    'INSERT INTO song (id, uuri, title, duration, is_blacklisted, last_played, credit_count, listener_count, '
+    '  skip_vote_count, has_failed, duplicate_id) VALUES '
+    '(1, \'yt:aaaaaaaaaaa\', \'First\', 100, 0, \'2017-04-01 00:00:00\', 3, 5, 1, 0, NULL), '
+    '(2, \'yt:bbbbbbbbbbb\', \'Second\', 200, 0, \'2017-04-01 00:00:00\', 2, 7, 2, 0, 1), '
+    '(3, \'yt:ccccccccccc\', \'Third\', 300, 0, \'2017-04-01 00:00:00\', 1, 0, 0, 0, NULL);',
+    'INSERT INTO playlist (id, user_id, name, head_id, repeat) VALUES (1, 10, \'default\', 3, 1), '
+    '(2, 10, \'other\', 4, 0);',
+    'INSERT INTO link (id, playlist_id, song_id, next_id) VALUES (1, 1, 1, 2), (2, 1, 2, NULL), (3, 1, 3, 1), '
+    '(4, 2, 3, NULL), (5, 2, 1, NULL);',
+]
+
+
+def reopen(filename):
+    common.close()
+    common.initialize(filename)
+
+
+def test_baseline_upgrade(baseline_database):
+    filename = baseline_database(*BASELINE_DATA)
+    common.initialize(filename)
+    try:
+        db = common._database
+        versions = [row[0] for row in db.execute_sql('SELECT version FROM schemaversion ORDER BY version;')]
+        assert versions == sorted(version for version, function in common._migrations)
+
+        # linked lists are converted to positions in the chain order, unreachable link is dropped
+        links = db.execute_sql('SELECT playlist_id, song_id FROM link ORDER BY playlist_id, position, id;').fetchall()
+        assert links == [(1, 3), (1, 1), (1, 2), (2, 3)]
+        assert db.execute_sql('SELECT COUNT(*) FROM link WHERE next_id IS NOT NULL;').fetchone()[0] == 0
+        assert db.execute_sql('SELECT COUNT(*) FROM playlist WHERE head_id IS NOT NULL;').fetchone()[0] == 0
+
+        # credits are valid at the last renewal time, the old table is dropped
+        assert 'credittimestamp' not in db.get_tables()
+        timestamps = {row[0] for row in db.execute_sql('SELECT credit_timestamp FROM song;')}
+        assert timestamps == {'2017-05-01 12:00:00'}
+
+        # duplicates are resolved to their roots, counts are aggregated there
+        songs = db.execute_sql('SELECT id, canonical_id, total_listener_count, total_skip_vote_count FROM song '
+                               'ORDER BY id;').fetchall()
+        assert songs == [(1, 1, 12, 3), (2, 1, 0, 0), (3, 3, 0, 0)]
+
+        # song counts are filled in
+        assert db.execute_sql('SELECT id, song_count FROM playlist ORDER BY id;').fetchall() == [(1, 3), (2, 1)]
+        assert db.execute_sql('SELECT id, song_count FROM "user" ORDER BY id;').fetchall() == [(10, 4), (11, 0)]
+
+        # play history fields are added to the journal
+        assert {'started', 'duration', 'end_reason'} <= set(common._get_columns('statsjournal'))
+    finally:
+        common.close()
+
+
+def test_migrations_are_applied_once(baseline_database):
+    filename = baseline_database(*BASELINE_DATA)
+    common.initialize(filename)
+    try:
+        applied = common._database.execute_sql('SELECT version, applied FROM schemaversion;').fetchall()
+        reopen(filename)
+        assert common._database.execute_sql('SELECT version, applied FROM schemaversion;').fetchall() == applied
+        links = common._database.execute_sql('SELECT id, position FROM link ORDER BY id;').fetchall()
+        assert [link_id for link_id, position in links] == [1, 2, 3, 4]
+    finally:
+        common.close()
+
+
+def test_fresh_database_matches_upgraded(baseline_database, tmp_path):
+    # every migration copes with the schema created from the models, both ways must end up with the same schema
+    def schema(filename):
+        connection = sqlite3.connect(filename)
+        try:
+            objects = connection.execute('SELECT type, name FROM sqlite_master WHERE name NOT LIKE \'sqlite_%\' '
+                                         '  AND name NOT LIKE \'song_fts_%\';').fetchall()
+            columns = {name: {row[1] for row in connection.execute('PRAGMA table_info("{}");'.format(name))}
+                       for object_type, name in objects if object_type == 'table'}
+            return set(objects), columns
+        finally:
+            connection.close()
+
+    upgraded = baseline_database()
+    common.initialize(upgraded)
+    common.close()
+    fresh = str(tmp_path / 'fresh.sqlite')
+    common.initialize(fresh)
+    common.close()
+
+    upgraded_objects, upgraded_columns = schema(upgraded)
+    fresh_objects, fresh_columns = schema(fresh)
+    # legacy columns (and their indexes) are only left in the upgraded databases
+    assert upgraded_objects - {('index', 'playlist_head_id'), ('index', 'link_next_id')} == fresh_objects
+    for table, columns in fresh_columns.items():
+        assert upgraded_columns[table] - {'head_id', 'next_id'} == columns
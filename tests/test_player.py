@@ -0,0 +1,151 @@
+import asyncio
+import threading
+from datetime import datetime
+
+import pytest
+
+common = pytest.importorskip('database.common')
+player = pytest.importorskip('database.player')
+
+USER_ID = 1
+
+
+class StubYoutubeDL:
+    def __init__(self, calls):
+        self._calls = calls
+
+    def extract_info(self, url, download=True, process=True):
+        self._calls.append((url, threading.current_thread()))
+        return {'title': 'Stub', 'duration': 200, 'url': 'http://localhost/{}.aac'.format(len(self._calls))}
+
+
+@pytest.fixture
+def extractions(monkeypatch):
+    # youtube_dl objects are created by the threads using them, calls are recorded with the thread
+    calls = list()
+    monkeypatch.setattr(common.DBSongUtil, '_get_ytdl', classmethod(lambda cls: StubYoutubeDL(calls)))
+    return calls
+
+
+@pytest.fixture
+def interface(database, loop, config):
+    current_time = datetime.now()
+    common.User.create(id=USER_ID)
+    playlist = common.Playlist.create(user=USER_ID, name='default')
+    common.User.update(active_playlist=playlist.id).where(common.User.id == USER_ID).execute()
+    for song_id in range(1, 4):
+        common.Song.create(id=song_id, uuri='yt:song{:07d}'.format(song_id), title='Song {}'.format(song_id),
+                           duration=200, last_played=datetime.utcfromtimestamp(0), credit_count=1,
+                           credit_timestamp=current_time)
+        common.Link.create(playlist=playlist.id, song=song_id, position=song_id)
+    return player.PlayerInterface(loop, config)
+
+
+def test_playback_extraction_is_not_queued_behind_the_resolver(interface, loop, extractions):
+    # occupy all the resolver workers, as a large import would
+    release = threading.Event()
+    blocked = [interface.run_in_resolver(release.wait) for _ in range(2)]
+    try:
+        context = loop.run_until_complete(asyncio.wait_for(interface.get_next_song(USER_ID), 5))
+        info = loop.run_until_complete(asyncio.wait_for(interface.extract_stream('http://localhost/stream'), 5))
+    finally:
+        release.set()
+        loop.run_until_complete(asyncio.gather(*blocked))
+
+    assert context.song_id == 1
+    assert context.song_url == 'http://localhost/1.aac'
+    assert info['url'] == 'http://localhost/2.aac'
+    assert [url for url, thread in extractions] == [common.DBSongUtil._make_url('yt:song0000001'),
+                                                    'http://localhost/stream']
+    # extraction is done by the playback worker, not by the event loop thread
+    assert all(thread is not threading.main_thread() for url, thread in extractions)
+    assert {stats['name'] for stats in common.executor_stats()} >= {'resolver', 'playback'}
+
+
+#
+# Statistics aggregator
+#
+@pytest.fixture
+def aggregator(database):
+    current_time = datetime.now()
+    for user_id in (10, 11, 12):
+        common.User.create(id=user_id)
+    # song 2 is a duplicate of song 1
+    for song_id, duplicate in ((1, None), (2, 1), (3, None)):
+        common.Song.create(id=song_id, uuri='yt:song{:07d}'.format(song_id), title='Song {}'.format(song_id),
+                           duration=200, last_played=current_time, credit_count=1, credit_timestamp=current_time,
+                           duplicate=duplicate)
+    return player.StatsAggregator(database, common._autoplaylist, common.ReadCache(16))
+
+
+def journal(aggregator, database, song_id, dj_id, listeners, skip_votes, started, duration, reason):
+    with database.atomic():
+        return aggregator.journal(song_id, dj_id, listeners, skip_votes, started, duration, reason)
+
+
+def test_flush_applies_counts_and_history(aggregator, database, loop):
+    started = datetime(2017, 5, 1, 12, 0, 0)
+    reason = player.PlayEndReason
+    entries = [journal(aggregator, database, 1, 10, {10, 11}, 1, started, 200, reason.FINISHED),
+               journal(aggregator, database, 2, 10, {11, 12}, 2, started, 50, reason.SKIPPED_BY_VOTE),
+               journal(aggregator, database, 3, None, {12}, 0, started, 10, reason.INTERRUPTED)]
+    for entry in entries:
+        aggregator.accumulate(entry)
+
+    async def load():
+        return 'cached'
+    cache = aggregator._cache
+    loop.run_until_complete(cache.get('info', load, groups=[('song', 1)]))
+
+    assert aggregator.flush() == 3
+    assert aggregator.flush() == 0
+
+    songs = common.Song.select(common.Song.id, common.Song.listener_count, common.Song.skip_vote_count,
+                               common.Song.total_listener_count).order_by(common.Song.id).tuples()
+    # totals are aggregated on the canonical song
+    assert list(songs) == [(1, 2, 1, 4), (2, 2, 2, 0), (3, 1, 0, 1)]
+    users = common.User.select(common.User.id, common.User.play_count, common.User.listen_count) \
+        .order_by(common.User.id).tuples()
+    assert list(users) == [(10, 2, 1), (11, 0, 2), (12, 0, 2)]
+    assert common.StatsJournal.select().count() == 0
+    assert common.PlayHistory.select().count() == 3
+
+    daily = common.DailyPlayStats.select(common.DailyPlayStats.song_id, common.DailyPlayStats.play_count,
+                                         common.DailyPlayStats.skip_count, common.DailyPlayStats.duration) \
+        .order_by(common.DailyPlayStats.song_id).tuples()
+    assert list(daily) == [(1, 1, 0, 200), (2, 1, 1, 50), (3, 1, 0, 10)]
+    # cached values depending on the counts are dropped
+    assert cache.get_stats()['size'] == 0
+
+
+def test_daily_statistics_accumulate(aggregator, database):
+    started = datetime(2017, 5, 1, 12, 0, 0)
+    for duration in (100, 150):
+        aggregator.accumulate(journal(aggregator, database, 3, 10, {10}, 0, started, duration,
+                                      player.PlayEndReason.SKIPPED_BY_DJ))
+        aggregator.flush()
+    aggregator.accumulate(journal(aggregator, database, 3, 10, {10}, 0, started.replace(day=2), 200,
+                                  player.PlayEndReason.FINISHED))
+    aggregator.flush()
+
+    daily = common.DailyPlayStats.select(common.DailyPlayStats.day, common.DailyPlayStats.play_count,
+                                         common.DailyPlayStats.skip_count, common.DailyPlayStats.duration) \
+        .order_by(common.DailyPlayStats.day).tuples()
+    assert [row[1:] for row in daily] == [(2, 2, 250), (1, 0, 200)]
+
+
+def test_journal_is_applied_after_a_crash(aggregator, database):
+    started = datetime(2017, 5, 1, 12, 0, 0)
+    # journaled, but the process ended before the entries were flushed
+    entries = [journal(aggregator, database, 1, 10, {11}, 0, started, 200, player.PlayEndReason.FINISHED)
+               for _ in range(2)]
+    aggregator.accumulate(entries[0])
+
+    recovered = player.StatsAggregator(database, common._autoplaylist, common.ReadCache(16))
+    # entries loaded from the journal are not counted twice
+    recovered.accumulate(entries[1])
+    assert recovered.flush() == 2
+    assert common.Song.get(common.Song.id == 1).listener_count == 2
+    assert common.User.get(common.User.id == 10).play_count == 2
+    assert common.PlayHistory.select().count() == 2
+    assert common.StatsJournal.select().count() == 0
@@ -0,0 +1,204 @@
+import asyncio
+import threading
+from datetime import datetime
+
+import pytest
+
+common = pytest.importorskip('database.common')
+playlist = pytest.importorskip('database.playlist')
+
+USER_ID = 1
+LIST_URL = 'https://www.youtube.com/playlist?list=PLstub'
+
+
+class StubYoutubeDL:
+    def __init__(self, calls):
+        self._calls = calls
+
+    def extract_info(self, url, download=True, process=True):
+        self._calls.append(url)
+        return {'extractor': 'youtube:playlist', 'entries': [
+            {'id': 'stubsong001', 'title': 'Stub 1', 'duration': 100},
+            {'id': 'stubsong002', 'title': 'Stub 2', 'duration': 200}]}
+
+
+class BlockingYoutubeDL:
+    # requests to youtube are blocked until released
+    def __init__(self, calls, release):
+        self._calls = calls
+        self._release = release
+
+    def extract_info(self, url, download=True, process=True):
+        self._calls.append(url)
+        if 'youtube' in url:
+            self._release.wait(5)
+        return {'title': url, 'duration': 100}
+
+
+@pytest.fixture
+def interface(database, loop, config):
+    common.User.create(id=USER_ID)
+    current_time = datetime.now()
+    common.Song.insert_many([{'uuri': 'yt:song{:07d}'.format(song_id), 'title': 'Song {}'.format(song_id),
+                              'duration': 200, 'last_played': current_time, 'credit_count': 1,
+                              'credit_timestamp': current_time} for song_id in range(1, 11)]).execute()
+    return playlist.PlaylistInterface(loop, config)
+
+
+def insert(interface, loop, prepend, *uris):
+    return loop.run_until_complete(interface.insert(USER_ID, None, prepend, list(uris)))
+
+
+def songs(name='default'):
+    query = common.Link.select(common.Link.song).join(common.Playlist) \
+        .where(common.Playlist.user == USER_ID, common.Playlist.name == name) \
+        .order_by(common.Link.position, common.Link.id)
+    return [link.song_id for link in query]
+
+
+def present(messages):
+    return [message for message in messages if 'already present' in message]
+
+
+def test_append_reports_repeated_songs(interface, loop):
+    name, inserted, failed, truncated, messages = insert(interface, loop, False, '1', '2', '1')
+    assert (inserted, failed, truncated) == (2, 0, False)
+    assert songs() == [1, 2]
+    assert present(messages) == ['The song [1] Song 1 was already present in your playlist.']
+
+    name, inserted, failed, truncated, messages = insert(interface, loop, False, '3', '2')
+    assert inserted == 1
+    assert songs() == [1, 2, 3]
+    assert present(messages) == ['The song [2] Song 2 was already present in your playlist.']
+
+
+def test_prepend_moves_present_songs(interface, loop):
+    insert(interface, loop, False, '1', '2', '3', '4')
+    name, inserted, failed, truncated, messages = insert(interface, loop, True, '3', '5', '3', '1', '6')
+    assert inserted == 2
+    # the batch forms the new front in the input order, first occurrences count
+    assert songs() == [3, 5, 1, 6, 2, 4]
+    assert len(present(messages)) == 3
+    assert all(message.endswith('It was moved to the front.') for message in present(messages))
+
+    # song counts are kept by the writers
+    assert common.Playlist.get(common.Playlist.name == 'default').song_count == 6
+
+
+def test_song_count_limit(interface, loop, config):
+    interface._config_max_songs = 3
+    name, inserted, failed, truncated, messages = insert(interface, loop, False, '1', '2', '1', '3', '4', '4')
+    assert (inserted, failed, truncated) == (3, 1, True)
+    assert songs() == [1, 2, 3]
+    # repeated songs over the limit are not reported as present
+    assert present(messages) == ['The song [1] Song 1 was already present in your playlist.']
+
+
+def test_list_expansion_is_cached(interface, loop, monkeypatch):
+    calls = list()
+    monkeypatch.setattr(common.DBSongUtil, '_get_ytdl', classmethod(lambda cls: StubYoutubeDL(calls)))
+
+    name, inserted, failed, truncated, messages = insert(interface, loop, False, LIST_URL)
+    assert (inserted, failed) == (2, 0)
+    # the same list is expanded from the cache the second time
+    name, inserted, failed, truncated, messages = insert(interface, loop, False, LIST_URL, '1')
+    assert (inserted, failed) == (1, 0), messages
+    assert len(present(messages)) == 2
+    assert calls == [LIST_URL]
+    assert [song.title for song in common.Song.select().join(common.Link).order_by(common.Link.position)] == \
+        ['Stub 1', 'Stub 2', 'Song 1']
+
+
+def test_busy_service_does_not_hold_the_resolver(database, loop, config, monkeypatch):
+    calls, release = list(), threading.Event()
+    monkeypatch.setattr(common.DBSongUtil, '_get_ytdl', classmethod(lambda cls: BlockingYoutubeDL(calls, release)))
+    common.User.create(id=USER_ID)
+    config['resolver_service_limit'] = '1'
+    interface = playlist.PlaylistInterface(loop, config)
+
+    youtube = ['https://www.youtube.com/watch?v={}'.format(letter * 11) for letter in 'abc']
+    soundcloud = 'https://soundcloud.com/artist/track'
+    task = loop.create_task(interface.insert(USER_ID, None, False, youtube + [soundcloud]))
+
+    async def soundcloud_requested():
+        while soundcloud not in calls:
+            await asyncio.sleep(0.01)
+
+    try:
+        # youtube requests waiting for the slot do not occupy the other resolver worker
+        loop.run_until_complete(asyncio.wait_for(soundcloud_requested(), 5))
+        assert calls == [youtube[0], soundcloud]
+    finally:
+        release.set()
+    name, inserted, failed, truncated, messages = loop.run_until_complete(task)
+    assert (inserted, failed) == (4, 0)
+    assert sorted(calls) == sorted(youtube + [soundcloud])
+
+
+def test_shuffle_keeps_the_songs(interface, loop):
+    insert(interface, loop, False, *[str(song_id) for song_id in range(1, 11)])
+    orders = set()
+    for _ in range(5):
+        loop.run_until_complete(interface.shuffle(USER_ID, None))
+        order = songs()
+        assert sorted(order) == list(range(1, 11))
+        orders.add(tuple(order))
+    assert len(orders) > 1
+
+    # songs are still appended and prepended around the shuffled ones
+    loop.run_until_complete(interface.pop(USER_ID, 10, None))
+    insert(interface, loop, False, '1', '2')
+    loop.run_until_complete(interface.shuffle(USER_ID, None))
+    insert(interface, loop, True, '3')
+    insert(interface, loop, False, '4')
+    assert songs()[0] == 3 and songs()[-1] == 4 and sorted(songs()[1:3]) == [1, 2]
+
+
+def test_pop_removes_the_front(interface, loop):
+    insert(interface, loop, False, '4', '5', '6', '7')
+    insert(interface, loop, True, '1', '2', '3')
+    assert songs() == [1, 2, 3, 4, 5, 6, 7]
+
+    assert loop.run_until_complete(interface.pop(USER_ID, 0, None)) == 0
+    assert loop.run_until_complete(interface.pop(USER_ID, 2, None)) == ('default', 2)
+    assert songs() == [3, 4, 5, 6, 7]
+    assert loop.run_until_complete(interface.pop(USER_ID, 4, None)) == ('default', 4)
+    assert songs() == [7]
+    assert loop.run_until_complete(interface.pop(USER_ID, 5, None)) == ('default', 1)
+    assert songs() == []
+    assert common.Playlist.get(common.Playlist.name == 'default').song_count == 0
+
+
+def counts():
+    playlists = dict(common.Playlist.select(common.Playlist.name, common.Playlist.song_count).tuples())
+    return playlists, common.User.get(common.User.id == USER_ID).song_count
+
+
+def test_song_counts_follow_the_links(interface, loop):
+    insert(interface, loop, False, '1', '2', '3', '4', '5')
+    insert(interface, loop, True, '6', '1')
+    loop.run_until_complete(interface.create(USER_ID, 'other'))
+    loop.run_until_complete(interface.insert(USER_ID, 'other', False, ['1', '7', '8']))
+    assert counts() == ({'default': 6, 'other': 3}, 9)
+
+    loop.run_until_complete(interface.pop(USER_ID, 2, None))
+    loop.run_until_complete(interface.pop_id(USER_ID, 7, 'other'))
+    with pytest.raises(LookupError):
+        loop.run_until_complete(interface.pop_id(USER_ID, 7, 'other'))
+    assert counts() == ({'default': 4, 'other': 2}, 6)
+
+    loop.run_until_complete(interface.clear(USER_ID, None))
+    assert counts() == ({'default': 0, 'other': 2}, 2)
+    loop.run_until_complete(interface.delete(USER_ID, 'other'))
+    assert counts() == ({'default': 0}, 0)
+    assert common.fix_song_counts() == 0
+
+
+def test_fix_song_counts(interface, loop):
+    insert(interface, loop, False, '1', '2', '3')
+    # links modified outside of the bot
+    common.Link.delete().where(common.Link.song == 2).execute()
+    common.Playlist.update(song_count=10).execute()
+    assert common.fix_song_counts() == 2
+    assert counts() == ({'default': 2}, 2)
+    assert common.fix_song_counts() == 0
@@ -0,0 +1,98 @@
+from datetime import datetime
+
+import pytest
+
+common = pytest.importorskip('database.common')
+song = pytest.importorskip('database.song')
+
+TITLES = ['Daft Punk - Around the World', 'Darude - Sandstorm', 'Around the Clock', 'Worldwide "quoted" title']
+
+
+@pytest.fixture
+def interface(database, loop, config):
+    current_time = datetime.now()
+    common.Song.insert_many([{'uuri': 'yt:song{:07d}'.format(song_id), 'title': title, 'duration': 200,
+                              'last_played': current_time, 'credit_count': 1, 'credit_timestamp': current_time}
+                             for song_id, title in enumerate(TITLES, 1)]).execute()
+    return song.SongInterface(loop, config)
+
+
+def search(interface, loop, *keywords):
+    songs, total = loop.run_until_complete(interface.search(list(keywords), 10))
+    assert total == len(songs)
+    return sorted(song_id for song_id, title in songs)
+
+
+def test_full_text_search(interface, loop):
+    if not interface._full_text:
+        pytest.skip('SQLite library does not support FTS5')
+    # keywords are prefixes, all of them must match, case is ignored
+    assert search(interface, loop, 'around') == [1, 3]
+    assert search(interface, loop, 'wor') == [1, 4]
+    assert search(interface, loop, 'arou', 'world') == [1]
+    assert search(interface, loop, 'sand') == [2]
+    assert search(interface, loop, 'storm') == []
+    # the query syntax is not interpreted
+    assert search(interface, loop, '"quoted"') == [4]
+    assert search(interface, loop, 'around', 'OR', 'sandstorm') == []
+    # unique URIs are indexed as well
+    assert search(interface, loop, 'song0000002') == [2]
+
+
+def test_full_text_index_follows_the_changes(interface, loop):
+    if not interface._full_text:
+        pytest.skip('SQLite library does not support FTS5')
+    loop.run_until_complete(interface.rename(2, 'Darude - Around'))
+    assert search(interface, loop, 'around') == [1, 2, 3]
+    assert search(interface, loop, 'sandstorm') == []
+
+    common.Song.delete().where(common.Song.id == 1).execute()
+    assert search(interface, loop, 'around') == [2, 3]
+    # the index stays consistent with the table
+    common._database.execute_sql('INSERT INTO song_fts (song_fts) VALUES (\'integrity-check\');')
+
+
+#
+# Automatic playlist pool
+#
+@pytest.fixture
+def player_interface(interface, loop, config):
+    player = pytest.importorskip('database.player')
+    # listener threshold of the automatic playlist is 5, song 4 is too long
+    for song_id, listener_count in ((1, 6), (2, 3), (3, 10), (4, 8)):
+        common.Song.update(listener_count=listener_count).where(common.Song.id == song_id).execute()
+    common.Song.update(duration=1000).where(common.Song.id == 4).execute()
+    common.Song.create(id=5, uuri='yt:song0000005', title='Song 5', duration=200, last_played=datetime.now(),
+                       credit_count=1, credit_timestamp=datetime.now(), listener_count=3)
+    return player.PlayerInterface(loop, config)
+
+
+def pool(player_interface):
+    # brings the pool up to date, it has to match the candidates selected from scratch
+    player_interface._refresh_autoplaylist()
+    candidates = sorted(song_id for song_id, in player_interface._candidate_query().tuples())
+    assert sorted(common._autoplaylist._songs) == candidates
+    return candidates
+
+
+def test_pool_follows_blacklist(interface, player_interface, loop):
+    assert pool(player_interface) == [1, 3]
+    loop.run_until_complete(interface.blacklist(3))
+    assert pool(player_interface) == [1]
+    loop.run_until_complete(interface.permit(3))
+    assert pool(player_interface) == [1, 3]
+
+
+def test_pool_follows_merge_and_split(interface, player_interface, loop):
+    assert pool(player_interface) == [1, 3]
+    # duplicates are represented by the canonical song, counts included
+    loop.run_until_complete(interface.merge(5, 2))
+    assert pool(player_interface) == [1, 2, 3]
+    loop.run_until_complete(interface.merge(3, 1))
+    assert pool(player_interface) == [1, 2]
+
+    # the former root loses the counts of the song split off
+    loop.run_until_complete(interface.merge(5, 5))
+    assert pool(player_interface) == [1]
+    loop.run_until_complete(interface.merge(3, 3))
+    assert pool(player_interface) == [1, 3]
@@ -0,0 +1,89 @@
+import io
+from datetime import datetime
+
+import pytest
+
+common = pytest.importorskip('database.common')
+playlist = pytest.importorskip('database.playlist')
+transfer = pytest.importorskip('database.transfer')
+
+USER_ID = 1
+SONGS = [('yt:aaaaaaaaaaa', 'First', 100), ('sc:artist:track', 'Second, with a comma', 200),
+         ('bc:artist:track', 'Third\nline', 300)]
+
+
+class StubYoutubeDL:
+    def __init__(self, calls):
+        self._calls = calls
+
+    def extract_info(self, url, download=True, process=True):
+        self._calls.append(url)
+        return {'title': 'Extracted', 'duration': 123}
+
+
+@pytest.mark.parametrize('song_format', transfer.FORMATS)
+def test_round_trip(song_format):
+    loaded = list(transfer.load(io.StringIO(''.join(transfer.dump(SONGS, song_format))), song_format))
+    # titles are kept on a single line
+    assert loaded == [('yt:aaaaaaaaaaa', 'First', 100), ('sc:artist:track', 'Second, with a comma', 200),
+                      ('bc:artist:track', 'Third line' if song_format == 'm3u' else 'Third\nline', 300)]
+
+
+def test_m3u_unknown_duration():
+    lines = ['#EXTM3U', '#EXTINF:-1,Unknown', 'https://www.youtube.com/watch?v=aaaaaaaaaaa',
+             '#EXTINF:0,Empty', 'https://www.youtube.com/watch?v=bbbbbbbbbbb',
+             'https://www.youtube.com/watch?v=ccccccccccc', '#EXTINF:42,Known', 'https://youtu.be/ddddddddddd']
+    assert list(transfer.load(lines, 'm3u')) == [('yt:aaaaaaaaaaa', None, None), ('yt:bbbbbbbbbbb', None, None),
+                                                 ('yt:ccccccccccc', None, None), ('yt:ddddddddddd', 'Known', 42)]
+
+
+def test_malformed_entries_are_reported():
+    lines = ['#EXTINF:abc,Title', 'https://www.youtube.com/watch?v=aaaaaaaaaaa', 'https://example.com/song',
+             '#EXTINF:10,', 'https://www.youtube.com/watch?v=bbbbbbbbbbb']
+    loaded = list(transfer.load(lines, 'm3u'))
+    assert [str(entry) for entry in loaded[:2]] == [
+        'Line 2 is not a valid song entry: invalid literal for int() with base 10: \'abc\'',
+        'Line 3 is not a valid song entry: unsupported URL']
+    # metadata are either complete or missing
+    assert loaded[2] == ('yt:bbbbbbbbbbb', None, None)
+
+    lines = ['{"uuri": "yt:aaaaaaaaaaa", "title": "First", "duration": 100}', '', 'not json',
+             '{"title": "No URI"}', '{"uuri": "xx:unknown"}', '{"uuri": "yt:bbbbbbbbbbb", "title": "", "duration": 1}',
+             '{"uuri": "yt:ccccccccccc", "duration": 10}']
+    loaded = list(transfer.load(lines, 'jsonl'))
+    assert loaded[0] == ('yt:aaaaaaaaaaa', 'First', 100)
+    assert [str(entry).split(':')[0] for entry in loaded[1:5]] == \
+        ['Line 3 is not a valid song entry', 'Line 4 is not a valid song entry', 'Line 5 is not a valid song entry',
+         'Line 6 is not a valid song entry']
+    assert loaded[5] == ('yt:ccccccccccc', None, None)
+
+
+def test_export_and_import(database, loop, config, monkeypatch):
+    calls = list()
+    monkeypatch.setattr(common.DBSongUtil, '_get_ytdl', classmethod(lambda cls: StubYoutubeDL(calls)))
+    common.User.create(id=USER_ID)
+    current_time = datetime.now()
+    common.Song.insert_many([{'uuri': uuri, 'title': title, 'duration': duration, 'last_played': current_time,
+                              'credit_count': 1, 'credit_timestamp': current_time}
+                             for uuri, title, duration in SONGS[:2]]).execute()
+    interface = playlist.PlaylistInterface(loop, config)
+    loop.run_until_complete(interface.insert(USER_ID, None, False, ['1', '2']))
+
+    output = io.StringIO()
+    assert loop.run_until_complete(interface.export_songs(USER_ID, None, output, 'm3u')) == ('default', 2)
+
+    # songs without the duration are resolved by the extractor and appended after the rest
+    lines = ['#EXTINF:-1,Unknown duration', 'https://www.youtube.com/watch?v=eeeeeeeeeee',
+             '#EXTINF:50,Imported', 'https://www.youtube.com/watch?v=fffffffffff'] + \
+        output.getvalue().splitlines() + ['garbage']
+    loop.run_until_complete(interface.create(USER_ID, 'copy'))
+    name, inserted, failed, truncated, messages = loop.run_until_complete(
+        interface.import_songs(USER_ID, 'copy', lines, 'm3u'))
+    assert (name, inserted, failed, truncated) == ('copy', 4, 1, False), messages
+    assert calls == ['https://www.youtube.com/watch?v=eeeeeeeeeee']
+
+    query = common.Song.select(common.Song.uuri, common.Song.title, common.Song.duration) \
+        .join(common.Link, on=(common.Link.song == common.Song.id)).join(common.Playlist) \
+        .where(common.Playlist.name == 'copy').order_by(common.Link.position, common.Link.id).tuples()
+    assert list(query) == [('yt:fffffffffff', 'Imported', 50)] + SONGS[:2] + \
+        [('yt:eeeeeeeeeee', 'Extracted', 123)]
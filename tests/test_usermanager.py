@@ -0,0 +1,205 @@
+import asyncio
+import types
+
+import pytest
+
+usermanager = pytest.importorskip('usermanager')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class StubBot:
+    def __init__(self, loop, config):
+        self.loop = loop
+        self.config = {'ddmbot': config}
+        self.player = types.SimpleNamespace(voice_output=False, users_changed=self.users_changed)
+        self.notifications = list()
+        self.stream = self
+        self.direct = None
+        self.whispers = list()
+        self.disconnected = list()
+
+    async def whisper_id(self, user_id, message):
+        self.whispers.append((user_id, message.splitlines()[0]))
+
+    async def disconnect(self, discord_id):
+        self.disconnected.append(discord_id)
+
+    async def users_changed(self, listeners, djs_present):
+        self.notifications.append((listeners, djs_present))
+        if listeners == {13}:
+            raise RuntimeError('Player failed')
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # the loop keeps the real time, only the user manager is given the fake one
+    clock = Clock()
+    monkeypatch.setattr(usermanager, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def bot(loop, config):
+    return StubBot(loop, config)
+
+
+@pytest.fixture
+def manager(bot, loop, clock):
+    manager = usermanager.UserManager(bot)
+    task = loop.create_task(manager.task_check_timeouts())
+    yield manager
+    task.cancel()
+    loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+
+
+def run(loop, coroutine):
+    return loop.run_until_complete(coroutine)
+
+
+def advance(loop, clock, manager, seconds):
+    # lets the timeout task handle the timers expired, together with the whispers it has sent
+    clock.now += seconds
+    manager._timers_changed.set()
+    for _ in range(5):
+        run(loop, asyncio.sleep(0))
+
+
+def test_token_expires(manager, loop, clock):
+    token = run(loop, manager.generate_token(1))
+    advance(loop, clock, manager, 299)
+    assert run(loop, manager.get_token_owner(token)) == 1
+    advance(loop, clock, manager, 1)
+    assert run(loop, manager.get_token_owner(token)) is None
+
+
+def test_dj_is_notified_and_removed(manager, bot, loop, clock):
+    run(loop, manager.add_listener(1, direct=False))
+    run(loop, manager.join_queue(1))
+    advance(loop, clock, manager, 2999)
+    assert bot.whispers == []
+    advance(loop, clock, manager, 1)
+    assert bot.whispers == [(1, 'You\'re about to be removed from the DJ queue due to inactivity.')]
+    advance(loop, clock, manager, 600)
+    assert bot.whispers[1:] == [(1, 'You have been removed from the DJ queue due to inactivity')]
+    assert 1 not in manager._queue
+    assert manager.is_listening(1)
+
+
+def test_activity_postpones_the_timeouts(manager, bot, loop, clock):
+    run(loop, manager.add_listener(1, direct=False))
+    run(loop, manager.join_queue(1))
+    for _ in range(10):
+        advance(loop, clock, manager, 2999)
+        run(loop, manager.refresh_activity(1))
+    for _ in range(1000):
+        run(loop, manager.refresh_activity(1))
+    assert bot.whispers == []
+    # the pending timer is kept and reschedules the listener once it expires, the heap does not grow
+    assert len(manager._timers) == 1
+
+    advance(loop, clock, manager, 3000)
+    run(loop, manager.refresh_activity(1))
+    advance(loop, clock, manager, 0)
+    assert [message for user_id, message in bot.whispers] == [
+        'You\'re about to be removed from the DJ queue due to inactivity.',
+        'Your inactivity timer has been reset successfully']
+    advance(loop, clock, manager, 3599)
+    assert 1 in manager._queue
+
+
+def test_leaving_the_queue_cancels_the_timer(manager, bot, loop, clock):
+    run(loop, manager.add_listener(1, direct=False))
+    run(loop, manager.join_queue(1))
+    run(loop, manager.leave_queue(1))
+    advance(loop, clock, manager, 10000)
+    assert bot.whispers == []
+    assert manager._listeners[1].timer is None
+
+    # moving into the queue schedules the timer again
+    run(loop, manager.move_listener(1, 5))
+    advance(loop, clock, manager, 3600)
+    assert 1 not in manager._queue
+
+
+def test_direct_listener_is_disconnected(manager, bot, loop, clock):
+    run(loop, manager.add_listener(1, direct=True))
+    run(loop, manager.add_listener(2, direct=True))
+    run(loop, manager.join_queue(2))
+    advance(loop, clock, manager, 3000)
+    advance(loop, clock, manager, 600)
+    # the DJ queue timeouts are shorter
+    assert bot.whispers == [(2, 'You\'re about to be removed from the DJ queue due to inactivity.'),
+                            (2, 'You have been removed from the DJ queue due to inactivity')]
+    assert manager.is_listening(2)
+    advance(loop, clock, manager, 3000)
+    assert [user_id for user_id, message in bot.whispers[2:]] == [1, 2]
+    assert all(message.startswith('You\'re about to be disconnected') for user_id, message in bot.whispers[2:])
+    advance(loop, clock, manager, 600)
+    assert bot.disconnected == [1, 2]
+    assert not manager.is_listening(1) and not manager.is_listening(2)
+
+
+def test_voice_output_follows_voice_listeners(manager, bot, loop):
+    run(loop, manager.add_listener(1, direct=True))
+    assert not bot.player.voice_output
+    run(loop, manager.add_listener(2, direct=False))
+    run(loop, manager.add_listener(3, direct=False))
+    assert bot.player.voice_output
+
+    run(loop, manager.remove_listener(2, direct=False))
+    assert bot.player.voice_output
+    # incompatible removes are ignored
+    run(loop, manager.remove_listener(3, direct=True))
+    assert bot.player.voice_output
+    run(loop, manager.remove_listener(3, direct=False))
+    assert not bot.player.voice_output
+
+    # direct listener switching to the voice channel
+    run(loop, manager.add_listener(1, direct=False))
+    assert bot.player.voice_output
+    assert bot.disconnected == [1]
+    run(loop, manager.remove_listener(1, direct=False))
+    assert not bot.player.voice_output
+    assert manager._voice_listeners == 0
+
+
+def test_player_notifications_are_coalesced(bot, loop, config):
+    config['users_notify_delay'] = '50'
+    manager = usermanager.UserManager(bot)
+    task = loop.create_task(manager.task_notify_player())
+    try:
+        # a burst of changes within the delay is delivered as a single update of the latest state
+        run(loop, manager.add_listener(1, direct=False))
+        run(loop, manager.add_listener(2, direct=True))
+        run(loop, manager.join_queue(1))
+        run(loop, asyncio.sleep(0.01))
+        run(loop, manager.add_listener(3, direct=False))
+        assert bot.notifications == []
+        run(loop, asyncio.sleep(0.1))
+        assert bot.notifications == [({1, 2, 3}, True)]
+
+        run(loop, manager.leave_queue(1))
+        run(loop, asyncio.sleep(0.1))
+        assert bot.notifications[1:] == [({1, 2, 3}, False)]
+        # nothing is sent without changes
+        run(loop, asyncio.sleep(0.1))
+        assert len(bot.notifications) == 2
+
+        # failing player does not stop the notifications
+        for discord_id in (1, 2, 3):
+            run(loop, manager.remove_listener(discord_id, direct=discord_id == 2))
+        run(loop, manager.add_listener(13, direct=False))
+        run(loop, asyncio.sleep(0.1))
+        run(loop, manager.add_listener(14, direct=False))
+        run(loop, asyncio.sleep(0.1))
+        assert bot.notifications[2:] == [({13}, False), ({13, 14}, False)]
+    finally:
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
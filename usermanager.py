@@ -1,28 +1,33 @@
-import collections
+import heapq
+import itertools
 import logging
 import string
 import random
-import datetime
+import time
 import asyncio
 from contextlib import suppress
 
 import discord.utils
 
+import djqueue
+
 # set up the logger
 log = logging.getLogger('ddmbot.usermanager')
 
 
 class ListenerInfo:
-    __slots__ = ['_last_activity', '_is_direct', 'notified_dj', 'notified_ds']
+    __slots__ = ['_last_activity', '_is_direct', 'notified_dj', 'notified_ds', 'timer', 'deadline']
 
     def __init__(self, *, direct):
-        self._last_activity = datetime.datetime.now()
+        self._last_activity = time.monotonic()
         self._is_direct = direct
         self.notified_dj = False
         self.notified_ds = False
+        self.timer = None  # generation of the timer scheduled, see UserManager._schedule
+        self.deadline = None  # deadline of the timer scheduled
 
     def refresh(self):
-        self._last_activity = datetime.datetime.now()
+        self._last_activity = time.monotonic()
         self.notified_dj = False
         self.notified_ds = False
 
@@ -38,11 +43,12 @@ class ListenerInfo:
 class UserManager:
     def __init__(self, bot):
         config = bot.config['ddmbot']
-        self._config_ds_token_timeout = datetime.timedelta(seconds=int(config['ds_token_timeout']))
-        self._config_ds_notify_time = datetime.timedelta(seconds=int(config['ds_notify_time']))
-        self._config_ds_remove_time = datetime.timedelta(seconds=int(config['ds_remove_time']))
-        self._config_dj_notify_time = datetime.timedelta(seconds=int(config['dj_notify_time']))
-        self._config_dj_remove_time = datetime.timedelta(seconds=int(config['dj_remove_time']))
+        self._config_ds_token_timeout = int(config['ds_token_timeout'])
+        self._config_ds_notify_time = int(config['ds_notify_time'])
+        self._config_ds_remove_time = int(config['ds_remove_time'])
+        self._config_dj_notify_time = int(config['dj_notify_time'])
+        self._config_dj_remove_time = int(config['dj_remove_time'])
+        self._config_notify_delay = int(config['users_notify_delay']) / 1000
 
         self._bot = bot
 
@@ -50,7 +56,14 @@ class UserManager:
 
         self._tokens = dict()  # maps token (string) -> (timestamp, user)
         self._listeners = dict()  # maps discord_id (int) -> ListenerInfo
-        self._queue = collections.deque()
+        self._voice_listeners = 0  # number of listeners connected using the discord voice channel
+        self._queue = djqueue.DjQueue()
+        self._changed = asyncio.Event(loop=bot.loop)  # player has to be notified about the listeners and the queue
+
+        # heap of (deadline, generation, handler, key) timers, key is either a token or a discord_id
+        self._timers = list()
+        self._timer_generation = itertools.count()
+        self._timers_changed = asyncio.Event(loop=bot.loop)  # earlier deadline was scheduled
 
     #
     # API for displaying information
@@ -58,7 +71,7 @@ class UserManager:
     async def get_display_info(self):
         async with self._lock:
             direct_listeners = {key for key, value in self._listeners.items() if value.is_direct}
-            return len(self._listeners), direct_listeners, list(self._queue)
+            return len(self._listeners), direct_listeners, self._queue.snapshot()
 
     def is_listening(self, discord_id):
         return discord_id in self._listeners
@@ -90,9 +103,7 @@ class UserManager:
         async with self._lock:
             if not self._queue:
                 return None
-            discord_id = self._queue.popleft()
-            self._queue.append(discord_id)
-            return discord_id
+            return self._queue.rotate()
 
     async def clear_queue(self):
         async with self._lock:
@@ -129,9 +140,12 @@ class UserManager:
                 # last combination is direct stream -> direct stream, there is nothing weird about that
 
             # now add the user to the listeners, rewriting previous entry if present
+            previous = self._listeners.get(discord_id)
             self._listeners[discord_id] = ListenerInfo(direct=direct)
+            self._update_voice_listeners(previous, self._listeners[discord_id])
+            self._schedule(discord_id)
 
-            self._bot.loop.create_task(self._bot.player.users_changed(set(self._listeners.keys()), bool(self._queue)))
+            self._users_changed()
 
     async def remove_listener(self, discord_id, *, direct):
         async with self._lock:
@@ -145,9 +159,9 @@ class UserManager:
             with suppress(ValueError):
                 self._queue.remove(discord_id)
             # remove the user from the listeners
-            self._listeners.pop(discord_id)
+            self._update_voice_listeners(self._listeners.pop(discord_id), None)
 
-            self._bot.loop.create_task(self._bot.player.users_changed(set(self._listeners.keys()), bool(self._queue)))
+            self._users_changed()
 
     async def join_queue(self, discord_id):
         async with self._lock:
@@ -156,8 +170,9 @@ class UserManager:
             if discord_id in self._queue:
                 return
             self._queue.append(discord_id)
+            self._schedule(discord_id)
 
-            self._bot.loop.create_task(self._bot.player.users_changed(set(self._listeners.keys()), bool(self._queue)))
+            self._users_changed()
 
     async def leave_queue(self, discord_id):
         async with self._lock:
@@ -165,8 +180,9 @@ class UserManager:
                 self._queue.remove(discord_id)
             except ValueError as e:
                 raise ValueError('You are not in the DJ queue') from e
+            self._schedule(discord_id)
 
-            self._bot.loop.create_task(self._bot.player.users_changed(set(self._listeners.keys()), bool(self._queue)))
+            self._users_changed()
 
     async def move_listener(self, discord_id, position):
         if position < 1:
@@ -180,18 +196,22 @@ class UserManager:
                 self._queue.remove(discord_id)
                 inserted = False
             self._queue.insert(position - 1, discord_id)
+            if inserted:
+                self._schedule(discord_id)
 
-            self._bot.loop.create_task(self._bot.player.users_changed(set(self._listeners.keys()), bool(self._queue)))
+            self._users_changed()
             return inserted, min(len(self._queue), position)
 
     async def generate_token(self, discord_id):
         # limit time spent in the critical section -- get the time and generate the token in advance
-        current_time = datetime.datetime.now()
+        current_time = time.monotonic()
         token = ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits) for _ in range(64))
         async with self._lock:
             # key collisions are possible, but should be negligible
             log.debug('Added token {} for user {}'.format(token, discord_id))
             self._tokens[token] = (current_time, discord_id)
+            self._add_timer(current_time + self._config_ds_token_timeout, next(self._timer_generation),
+                            self._token_expired, token)
             return token
 
     #
@@ -205,6 +225,37 @@ class UserManager:
                 if info.notified_dj or info.notified_ds:
                     self._whisper(discord_id, 'Your inactivity timer has been reset successfully')
                 info.refresh()
+                self._schedule(discord_id)
+
+    #
+    # Voice output gating
+    #
+    def _update_voice_listeners(self, removed, added):
+        # keep the voice listener count and let the player know if the voice channel output is needed at all
+        if removed is not None and not removed.is_direct:
+            self._voice_listeners -= 1
+        if added is not None and not added.is_direct:
+            self._voice_listeners += 1
+        self._bot.player.voice_output = self._voice_listeners > 0
+
+    #
+    # Player notification
+    #
+    def _users_changed(self):
+        # changes are only marked, the player is notified by the task_notify_player
+        self._changed.set()
+
+    async def task_notify_player(self):
+        # changes made in a burst (e.g. many users joining at once) are delivered to the player as a single update of
+        # the latest state, the delay gives the burst time to settle, changes made during the update are kept marked
+        while True:
+            await self._changed.wait()
+            await asyncio.sleep(self._config_notify_delay, loop=self._bot.loop)
+            self._changed.clear()
+            try:
+                await self._bot.player.users_changed(set(self._listeners.keys()), bool(self._queue))
+            except Exception:
+                log.exception('Failed to notify the player about the listener changes')
 
     #
     # Internal timeout checking task
@@ -213,59 +264,93 @@ class UserManager:
         self._bot.loop.create_task(self._bot.whisper_id(user_id, message))
 
     async def task_check_timeouts(self):
+        # sleeps until the earliest deadline, or until an earlier one is scheduled, only the timers expired are handled
         while True:
-            await asyncio.sleep(20, loop=self._bot.loop)
-            current_time = datetime.datetime.now()
-            # sets used to store users and tokens to remove
-            remove_tokens = set()
-            remove_djs = set()
-            remove_listeners = set()
+            self._timers_changed.clear()
+            timeout = self._timers[0][0] - time.monotonic() if self._timers else None
+            if timeout is None or timeout > 0:
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._timers_changed.wait(), timeout, loop=self._bot.loop)
+                continue
+
             async with self._lock:
-                # check all tokens
-                for token, (created, user) in self._tokens.items():
-                    if current_time - created > self._config_ds_token_timeout:
-                        remove_tokens.add(token)
-                # check all djs
-                for dj in self._queue:
-                    info = self._listeners[dj]
-                    time_diff = current_time - info.last_activity
-                    if time_diff > self._config_dj_remove_time:
-                        self._whisper(dj, 'You have been removed from the DJ queue due to inactivity')
-                        remove_djs.add(dj)
-                    elif time_diff > self._config_dj_notify_time and not info.notified_dj:
-                        log.info('DJ {} notified for being inactive'.format(dj))
-                        self._whisper(dj, 'You\'re about to be removed from the DJ queue due to inactivity.\n'
+                current_time = time.monotonic()
+                while self._timers and self._timers[0][0] <= current_time:
+                    deadline, generation, handler, key = heapq.heappop(self._timers)
+                    handler(key, generation, current_time)
+
+    #
+    # Timers, lock must be held
+    #
+    # Timers are never removed from the heap. Every listener has at most one valid timer, identified by the generation
+    # stored in its ListenerInfo. Rescheduling to an earlier deadline pushes a timer with a new generation, outdated
+    # ones are skipped once they expire. Later deadlines (e.g. after every message of the user) keep the valid timer,
+    # which only reschedules the listener once it expires, so the heap does not grow with the activity of the users.
+    #
+    def _add_timer(self, deadline, generation, handler, key):
+        heapq.heappush(self._timers, (deadline, generation, handler, key))
+        if self._timers[0][1] == generation:
+            self._timers_changed.set()
+
+    def _timeouts(self, discord_id, info):
+        # yields (notify, remove) times applying to the listener (direct stream, DJ queue), relative to the activity
+        if info.is_direct:
+            yield self._config_ds_notify_time if not info.notified_ds else None, self._config_ds_remove_time
+        if discord_id in self._queue:
+            yield self._config_dj_notify_time if not info.notified_dj else None, self._config_dj_remove_time
+
+    def _schedule(self, discord_id):
+        # (re)schedules the next timer of the listener, previously scheduled one is invalidated
+        info = self._listeners[discord_id]
+        deadlines = [info.last_activity + delay for timeouts in self._timeouts(discord_id, info)
+                     for delay in timeouts if delay is not None]
+        if not deadlines:
+            info.timer = None
+            return
+        deadline = min(deadlines)
+        if info.timer is not None and info.deadline <= deadline:
+            return
+        info.timer = next(self._timer_generation)
+        info.deadline = deadline
+        self._add_timer(deadline, info.timer, self._listener_expired, discord_id)
+
+    def _token_expired(self, token, generation, current_time):
+        log.info('Token {} has timed out'.format(token))
+        self._tokens.pop(token, None)
+
+    def _listener_expired(self, discord_id, generation, current_time):
+        info = self._listeners.get(discord_id)
+        if info is None or info.timer != generation:
+            return
+        info.timer = None
+
+        # the same sums as in _schedule, so the expired deadlines are always recognized
+        if info.is_direct:
+            if info.last_activity + self._config_ds_remove_time <= current_time:
+                log.info('Listener {} has timed out'.format(discord_id))
+                self._whisper(discord_id, 'You have been disconnected from the stream due to inactivity')
+                self._bot.loop.create_task(self._bot.stream.disconnect(discord_id))
+                with suppress(ValueError):
+                    self._queue.remove(discord_id)
+                self._update_voice_listeners(self._listeners.pop(discord_id), None)
+                self._users_changed()
+                return
+            if info.last_activity + self._config_ds_notify_time <= current_time and not info.notified_ds:
+                log.info('Listener {} notified for being inactive'.format(discord_id))
+                self._whisper(discord_id, 'You\'re about to be disconnected from the stream due to inactivity.\n'
                                           'Please reply to this message to prevent that.')
-                        info.notified_dj = True
-                # and all the direct listeners too
-                for listener, info in self._listeners.items():
-                    if not info.is_direct:
-                        continue
-                    time_diff = current_time - info.last_activity
-                    if time_diff > self._config_ds_remove_time:
-                        self._whisper(listener, 'You have been disconnected from the stream due to inactivity')
-                        remove_listeners.add(listener)
-                    elif time_diff > self._config_ds_notify_time and not info.notified_ds:
-                        log.info('Listener {} notified for being inactive'.format(listener))
-                        self._whisper(listener, 'You\'re about to be disconnected from the stream due to inactivity.\n'
-                                                'Please reply to this message to prevent that.')
-                        info.notified_ds = True
-
-                # now it is save to edit lists / dictionaries
-                for token in remove_tokens:
-                    log.info('Token {} has timed out'.format(token))
-                    self._tokens.pop(token)
-                for dj in remove_djs:
-                    log.info('DJ {} has timed out'.format(dj))
-                    self._queue.remove(dj)
-                for listener in remove_listeners:
-                    log.info('Listener {} has timed out'.format(listener))
-                    self._bot.loop.create_task(self._bot.stream.disconnect(listener))
-                    with suppress(ValueError):
-                        self._queue.remove(listener)
-                    self._listeners.pop(listener)
-
-            # now update the player
-            if remove_listeners or remove_djs:
-                self._bot.loop.create_task(self._bot.player.users_changed(set(self._listeners.keys()),
-                                                                          bool(self._queue)))
+                info.notified_ds = True
+
+        if discord_id in self._queue:
+            if info.last_activity + self._config_dj_remove_time <= current_time:
+                log.info('DJ {} has timed out'.format(discord_id))
+                self._whisper(discord_id, 'You have been removed from the DJ queue due to inactivity')
+                self._queue.remove(discord_id)
+                self._users_changed()
+            elif info.last_activity + self._config_dj_notify_time <= current_time and not info.notified_dj:
+                log.info('DJ {} notified for being inactive'.format(discord_id))
+                self._whisper(discord_id, 'You\'re about to be removed from the DJ queue due to inactivity.\n'
+                                          'Please reply to this message to prevent that.')
+                info.notified_dj = True
+
+        self._schedule(discord_id)